@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Compares the wall time of the occ calls made by the update-status and
+config-changed hooks, with and without the occ worker.
+
+Run as root on a nextcloud unit with the occ-worker config enabled:
+
+    sudo python3 scripts/occ-worker/benchmark.py --rounds 5
+
+The config-changed sequence writes back the current overwriteprotocol,
+so it does not change the running configuration.
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'src'))
+
+from occ import HookCache, Occ, OccWorker  # noqa: E402
+
+
+def update_status():
+    Occ.status()
+    Occ.status()
+
+
+def config_changed():
+    Occ.status()
+    Occ.config_system_get_trusted_domains()
+    protocol = Occ.config_system_get('overwriteprotocol').stdout.strip() or 'http'
+    batch = Occ.config_system_batch()
+    Occ.overwriteprotocol(protocol, batch)
+    batch.flush()
+
+
+HOOKS = {'update-status': update_status, 'config-changed': config_changed}
+
+
+def measure(hook, rounds):
+    timings = []
+    for _ in range(rounds):
+        # Every round is a new dispatch, nothing cached from the last one.
+        HookCache.invalidate()
+        start = time.monotonic()
+        hook()
+        timings.append(time.monotonic() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    if not OccWorker.available():
+        sys.exit("The occ worker is not running, enable it with: "
+                 "juju config nextcloud occ-worker=true")
+
+    worker_socket = OccWorker.socket_path
+    print(f"{'hook':<16}{'mode':<10}{'mean':>10}{'median':>10}{'min':>10}")
+    for name, hook in HOOKS.items():
+        results = {}
+        for mode, socket_path in [('spawn', '/nonexistent'), ('worker', worker_socket)]:
+            OccWorker.socket_path = socket_path
+            hook()  # warm up, lets a restarting worker come back.
+            timings = measure(hook, args.rounds)
+            results[mode] = statistics.mean(timings)
+            print(f"{name:<16}{mode:<10}{statistics.mean(timings):>9.3f}s"
+                  f"{statistics.median(timings):>9.3f}s{min(timings):>9.3f}s")
+        print(f"{name:<16}{'speedup':<10}{results['spawn'] / results['worker']:>9.1f}x")
+    OccWorker.socket_path = worker_socket
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+<?php
+/**
+ * Long lived occ worker, installed by the Nextcloud charm.
+ *
+ * Bootstraps Nextcloud once and then serves requests on a unix socket,
+ * one json line per connection:
+ *
+ *   {"argv": ["status", "--output=json"]}    runs an occ command
+ *   {"system_config": {"debug": false}}      SystemConfig::setValues()
+ *
+ * and answers with {"returncode": 0, "stdout": "..."}.
+ *
+ * When config.php, an overlay or version.php is changed on disk by someone
+ * else, the worker answers {"restart": true} and exits, systemd then starts
+ * a fresh one. The client falls back to spawning php in that case.
+ * Its own writes only restart it when installed or maintenance changed,
+ * since occ loads a different set of commands then.
+ *
+ * Usage: php occ-worker.php <socket> [<nextcloud root>]
+ */
+
+const MAX_REQUESTS = 500;
+
+$socketPath = $argv[1] ?? '/run/nextcloud-occ/occ.sock';
+$serverRoot = $argv[2] ?? '/var/www/nextcloud';
+
+define('OC_CONSOLE', 1);
+chdir($serverRoot);
+require_once $serverRoot . '/lib/base.php';
+
+use OC\Console\Application;
+use Symfony\Component\Console\Input\ArgvInput;
+use Symfony\Component\Console\Output\BufferedOutput;
+
+function fingerprint(string $serverRoot): string {
+	clearstatcache();
+	$files = glob($serverRoot . '/config/*config.php');
+	$files[] = $serverRoot . '/version.php';
+	$parts = [];
+	foreach ($files as $file) {
+		$parts[] = $file . ':' . @filemtime($file) . ':' . @filesize($file);
+	}
+	return implode('|', $parts);
+}
+
+function state(): string {
+	$config = \OC::$server->getSystemConfig();
+	return json_encode([$config->getValue('installed', false), $config->getValue('maintenance', false)]);
+}
+
+function reply($conn, array $data): void {
+	$payload = json_encode($data, JSON_INVALID_UTF8_SUBSTITUTE) . "\n";
+	while ($payload !== '') {
+		$written = fwrite($conn, $payload);
+		if ($written === false || $written === 0) {
+			break;
+		}
+		$payload = substr($payload, $written);
+	}
+	fclose($conn);
+}
+
+$application = \OC::$server->get(Application::class);
+$application->loadCommands(new ArgvInput(['occ', 'list']), new BufferedOutput());
+$application->setAutoExit(false);
+
+@unlink($socketPath);
+$server = stream_socket_server('unix://' . $socketPath, $errno, $errstr);
+if ($server === false) {
+	fwrite(STDERR, "Unable to listen on $socketPath: $errstr\n");
+	exit(1);
+}
+chmod($socketPath, 0600);
+
+$started = fingerprint($serverRoot);
+$state = state();
+for ($served = 0; $served < MAX_REQUESTS; $served++) {
+	$conn = @stream_socket_accept($server, -1);
+	if ($conn === false) {
+		continue;
+	}
+	$request = json_decode((string)fgets($conn), true);
+	if (!is_array($request) || fingerprint($serverRoot) !== $started) {
+		reply($conn, ['restart' => true]);
+		break;
+	}
+
+	$output = new BufferedOutput();
+	try {
+		if (isset($request['system_config'])) {
+			$changes = (array)$request['system_config'];
+			\OC::$server->getSystemConfig()->setValues($changes);
+			$results = [];
+			foreach ($changes as $key => $value) {
+				$results[$key] = $value === null ? 'deleted' : 'set';
+			}
+			$output->write(json_encode($results));
+			$code = 0;
+		} else {
+			$input = new ArgvInput(array_merge(['occ'], (array)$request['argv']));
+			$code = $application->run($input, $output);
+		}
+	} catch (\Throwable $e) {
+		$output->writeln($e->getMessage());
+		$code = 1;
+	}
+	reply($conn, ['returncode' => $code, 'stdout' => $output->fetch()]);
+
+	$current = fingerprint($serverRoot);
+	if ($current !== $started) {
+		// Commands like maintenance:mode change what occ loads, start over.
+		if (state() !== $state) {
+			break;
+		}
+		$started = $current;
+	}
+}
+
+fclose($server);
+@unlink($socketPath);
@@ -0,0 +1,330 @@
+"""
+Extraction of nextcloud archives: .tar.bz2, .tar.zst, .tar.xz and .tar.gz.
+
+The compression is detected from the magic bytes. Decompression runs in
+a multi-threaded tool when one is installed (lbzip2, zstd, xz -T0,
+pigz), the tar stream is read from its stdout.
+
+Without lbzip2 a bz2 archive is decompressed block-parallel in python.
+bz2 blocks are bit aligned and start with a 48 bit magic, each block is
+cut out and wrapped as a stream of its own, which is a valid bz2 stream
+whose combined crc is the block crc. The blocks are decompressed on a
+thread pool, bz2 releases the GIL, and fed to tarfile in order.
+"""
+import bz2
+import collections
+import gzip
+import io
+import logging
+import lzma
+import os
+import shutil
+import subprocess as sp
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = [
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x1f\x8b', 'gz'),
+]
+_HEAD_SIZE = max(len(magic) for magic, _ in _MAGIC)
+
+# Multi-threaded decompressors, the first installed one is used.
+DECOMPRESSORS = {
+    'bz2': [['lbzip2', '-d', '-c', '-n', '{threads}']],
+    'zst': [['zstd', '-d', '-c', '-q']],
+    'xz': [['xz', '-d', '-c', '-q', '-T0']],
+    'gz': [['pigz', '-d', '-c']],
+}
+
+_BZ2_BLOCK_MAGIC = 0x314159265359
+_BZ2_EOS_MAGIC = 0x177245385090
+_BZ2_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class ArchiveError(Exception):
+    """
+    The archive can't be extracted.
+    """
+
+
+def detect_format(head) -> str:
+    """
+    Compression format from the first bytes of an archive.
+    """
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    raise ArchiveError("Unsupported archive format, expected .tar.bz2, .tar.zst, .tar.xz or .tar.gz")
+
+
+def _threads() -> int:
+    return os.cpu_count() or 1
+
+
+def _decompressor(fmt) -> list:
+    for cmd in DECOMPRESSORS.get(fmt, []):
+        if shutil.which(cmd[0]):
+            return [arg.format(threads=_threads()) for arg in cmd]
+    return None
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Readable file object over an iterator of bytes.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+def _marker_patterns(magic):
+    """
+    Byte patterns of a 48 bit magic for each of the 8 bit offsets.
+    For offset k > 0 the 5 middle bytes are exact, the first and last
+    byte only match under the mask.
+    """
+    patterns = [(0, magic.to_bytes(6, 'big'), None)]
+    for k in range(1, 8):
+        window = (magic << (8 - k)).to_bytes(7, 'big')
+        patterns.append((k, window, (1 << (8 - k)) - 1))
+    return patterns
+
+
+_BZ2_MARKERS = [(kind, _marker_patterns(magic))
+                for kind, magic in [('block', _BZ2_BLOCK_MAGIC), ('eos', _BZ2_EOS_MAGIC)]]
+
+
+def _find_markers(buf, start) -> list:
+    """
+    Bit positions and kinds of bz2 block and end of stream magics that
+    begin at byte start or later and fit in buf.
+    """
+    found = []
+    for kind, patterns in _BZ2_MARKERS:
+        for k, window, low in patterns:
+            if low is None:
+                pos = buf.find(window, start)
+                while pos != -1:
+                    found.append((pos * 8, kind))
+                    pos = buf.find(window, pos + 1)
+                continue
+            middle = window[1:6]
+            pos = buf.find(middle, start + 1)
+            while pos != -1:
+                i = pos - 1
+                complete = i + 6 < len(buf)
+                if complete and buf[i] & low == window[0] and buf[i + 6] & ~low & 0xff == window[6]:
+                    found.append((i * 8 + k, kind))
+                pos = buf.find(middle, pos + 1)
+    return sorted(found)
+
+
+def _bz2_block_stream(buf, start, end) -> bytes:
+    """
+    Wraps the block at bits [start, end) of buf as a single block bz2 stream.
+    """
+    first, last = start // 8, (end + 7) // 8
+    nbits = end - start
+    bits = int.from_bytes(buf[first:last], 'big') >> (last * 8 - end)
+    bits &= (1 << nbits) - 1
+    # The block crc follows the block magic.
+    crc = (bits >> (nbits - 80)) & 0xffffffff
+    bits = (bits << 80) | (_BZ2_EOS_MAGIC << 32) | crc
+    nbits += 80
+    pad = -nbits % 8
+    return b'BZh9' + (bits << pad).to_bytes((nbits + pad) // 8, 'big')
+
+
+def _bz2_blocks(fileobj, chunk_size=_BZ2_CHUNK_SIZE):
+    """
+    Yields each block of a (multi stream) bz2 file as a bz2 stream of its own.
+    """
+    buf = b''
+    markers = []
+    scan_from = 0
+    eof = False
+    while not eof:
+        chunk = fileobj.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+        # The rescan finds a byte aligned marker at the end of the last
+        # buf again, only the markers after the known ones are new.
+        last = markers[-1][0] if markers else -1
+        markers += [marker for marker in _find_markers(buf, scan_from) if marker[0] > last]
+        # Markers starting before this were complete in buf.
+        scan_from = max(0, len(buf) - 6)
+        while len(markers) >= 2:
+            (start, kind), (end, _) = markers[0], markers[1]
+            if kind == 'block':
+                yield _bz2_block_stream(buf, start, end)
+            markers.pop(0)
+        cut = markers[0][0] // 8 if markers else scan_from
+        buf = buf[cut:]
+        scan_from -= cut
+        markers = [(pos - cut * 8, kind) for pos, kind in markers]
+    if not markers or markers[0][1] != 'eos':
+        raise ArchiveError("Truncated bz2 archive")
+
+
+def _bz2_parallel(fileobj, threads):
+    """
+    Decompressed data of a bz2 file, in order, with at most
+    2 * threads blocks in flight.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = collections.deque()
+        for block in _bz2_blocks(fileobj):
+            pending.append(pool.submit(bz2.decompress, block))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _python_stream(fmt, fileobj):
+    if fmt == 'bz2':
+        if _threads() == 1:
+            return bz2.BZ2File(fileobj)
+        return io.BufferedReader(_ChunkReader(_bz2_parallel(fileobj, _threads())), _BZ2_CHUNK_SIZE)
+    if fmt == 'xz':
+        return lzma.LZMAFile(fileobj)
+    if fmt == 'gz':
+        return gzip.GzipFile(fileobj=fileobj)
+    if zstandard is None:
+        raise ArchiveError("Extracting .tar.zst needs the zstd tool or the zstandard python package")
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+def _extract_tar(stream, dst):
+    with tarfile.open(fileobj=stream, mode='r|') as tfile:
+        tfile.extractall(path=dst)
+
+
+def _extract_with_tool(cmd, fileobj, dst):
+    """
+    Extracts the tar stream a decompressor writes to stdout. Real files
+    are passed as stdin, other file objects are fed from a thread.
+    """
+    try:
+        stdin = fileobj.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        stdin = None
+    else:
+        # The tool reads from the file descriptor, which a buffered file
+        # object has already read ahead on.
+        os.lseek(stdin, fileobj.tell(), os.SEEK_SET)
+    proc = sp.Popen(cmd, stdin=sp.PIPE if stdin is None else stdin, stdout=sp.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            shutil.copyfileobj(fileobj, proc.stdin, 1024 * 1024)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            proc.stdin.close()
+
+    feeder = None
+    if stdin is None:
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+    try:
+        _extract_tar(proc.stdout, dst)
+        # Drain the padding after the end of the tar.
+        while proc.stdout.read(1024 * 1024):
+            pass
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+        if feeder is not None:
+            feeder.join()
+    if errors:
+        raise errors[0]
+    if returncode != 0:
+        raise ArchiveError(f"{cmd[0]} failed with exit code {returncode}")
+
+
+class _Prepended(io.RawIOBase):
+    """
+    Puts already read bytes back in front of a file object.
+    """
+
+    def __init__(self, head, fileobj):
+        self._head = head
+        self._fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self._head:
+            if size is None or size < 0:
+                data, self._head = self._head + self._fileobj.read(), b''
+                return data
+            data, self._head = self._head[:size], self._head[size:]
+            return data
+        return self._fileobj.read(size)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def extract(fileobj, dst):
+    """
+    Extracts a compressed tar from a readable file object, e.g. a download.
+    """
+    head = fileobj.read(_HEAD_SIZE)
+    fmt = detect_format(head)
+    _extract(fmt, _Prepended(head, fileobj), dst)
+
+
+def extract_file(path, dst):
+    """
+    Extracts a compressed tar file.
+    """
+    with open(path, 'rb') as f:
+        fmt = detect_format(f.read(_HEAD_SIZE))
+        f.seek(0)
+        _extract(fmt, f, dst)
+
+
+def _extract(fmt, fileobj, dst):
+    dst = Path(dst)
+    cmd = _decompressor(fmt)
+    if cmd:
+        logger.info(f"Extracting {fmt} archive to {dst} with {' '.join(cmd)}")
+        _extract_with_tool(cmd, fileobj, dst)
+    else:
+        logger.info(f"Extracting {fmt} archive to {dst} in python")
+        _extract_tar(_python_stream(fmt, fileobj), dst)
@@ -0,0 +1,292 @@
+"""
+Local content addressed cache for nextcloud archives.
+
+Layout under CACHE_DIR:
+    objects/<sha256>     complete archives, named by their sha256
+    urls/<key>           sha256 of the archive last fetched from an url
+    partial/<key>        unfinished download of an url, <key>.json has
+                         the validators (ETag/Last-Modified) to resume it
+
+<key> is the sha256 of the url. Downloads are read as a stream, so the
+archive can be extracted while it is downloaded, and written to the
+partial file on the way. An interrupted download resumes with an HTTP
+Range request, also in a later hook. The cache is bounded in size, the
+least recently used objects are evicted first.
+
+requests and urllib3 are only imported by a Download, they are the most
+expensive imports of the charm and most hooks download nothing.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '/var/cache/nextcloud-charm'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class ArtifactError(Exception):
+    """
+    An artifact couldn't be downloaded or stored.
+    """
+
+
+def _url_key(url) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _range_total(response) -> int:
+    """
+    Full length from the Content-Range of a response, None if unknown.
+    """
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+class Download(io.RawIOBase):
+    """
+    Readable stream of a download that is also written to a partial file.
+
+    Bytes of an earlier interrupted attempt are replayed from the partial
+    file, the rest is requested with a Range header. Connection errors
+    while reading are resumed the same way, up to attempts times. A
+    partial file the server says is complete, e.g. of a hook killed
+    before commit(), is only replayed.
+    """
+
+    def __init__(self, cache, url, attempts=3, timeout=30):
+        self._cache = cache
+        self.url = url
+        self._attempts = attempts
+        self._timeout = timeout
+        key = _url_key(url)
+        self._partial = Path(cache.cache_dir, 'partial', key)
+        self._meta = Path(cache.cache_dir, 'partial', key + '.json')
+        self._partial.parent.mkdir(parents=True, exist_ok=True)
+        self._hash = hashlib.sha256()
+        self._response = None
+        self._replay = None
+        self._out = None
+        self._end = None
+        self.resumed_from = 0
+        self._start()
+
+    def _validators(self) -> dict:
+        try:
+            return json.loads(self._meta.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _request(self, offset):
+        headers = {}
+        validators = self._validators()
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            validator = validators.get('etag') or validators.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+        import requests
+        response = requests.get(self.url, headers=headers, stream=True,
+                                allow_redirects=True, timeout=self._timeout)
+        if offset and response.status_code == 416:
+            # Range Not Satisfiable, _start tells complete from stale.
+            return response
+        response.raise_for_status()
+        # Where the body ends, to tell a closed connection from the end.
+        length = response.headers.get('Content-Length')
+        start = offset if response.status_code == 206 else 0
+        self._end = start + int(length) if length else None
+        return response
+
+    def _start(self):
+        offset = self._partial.stat().st_size if self._partial.exists() else 0
+        self._response = self._request(offset)
+        if offset and self._response.status_code == 416:
+            total = _range_total(self._response)
+            self._response.close()
+            self._response = None
+            if total == offset:
+                logger.info(f"Download of {self.url} is complete in {self._partial}, replaying it")
+                self.resumed_from = self._end = offset
+                self._replay = open(self._partial, 'rb')
+                self._out = open(self._partial, 'ab')
+                return
+            logger.warning(f"Server rejected resuming {self.url} at {offset} bytes, downloading it again")
+            offset = 0
+            self._response = self._request(offset)
+        if offset and self._response.status_code == 206:
+            self.resumed_from = offset
+            self._replay = open(self._partial, 'rb')
+            logger.info(f"Resuming download of {self.url} at {offset} bytes")
+        else:
+            offset = 0
+        self._meta.write_text(json.dumps({'url': self.url,
+                                          'etag': self._response.headers.get('ETag'),
+                                          'last_modified': self._response.headers.get('Last-Modified')}))
+        self._out = open(self._partial, 'ab' if offset else 'wb')
+
+    def _resume(self):
+        offset = self._out.tell()
+        self._response = self._request(offset)
+        if self._response.status_code != 206:
+            raise ArtifactError(f"Can't resume {self.url} at {offset} bytes, the server doesn't support it")
+        logger.warning(f"Download of {self.url} interrupted at {offset} bytes, resumed.")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = b''
+        if self._replay is not None:
+            data = self._replay.read(len(b))
+            if not data:
+                self._replay.close()
+                self._replay = None
+        if not data:
+            data = self._read_network(len(b))
+            self._out.write(data)
+        self._hash.update(data)
+        b[:len(data)] = data
+        return len(data)
+
+    def _read_network(self, size):
+        import requests
+        import urllib3
+        if self._end is not None and self._out.tell() >= self._end:
+            return b''
+        error = None
+        for attempt in range(self._attempts):
+            try:
+                if self._response is None:
+                    self._resume()
+                data = self._response.raw.read(size)
+                if not data and self._end is not None and self._out.tell() < self._end:
+                    raise urllib3.exceptions.ProtocolError("Connection closed early")
+                return data
+            except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+                error = e
+                if self._response is not None:
+                    self._response.close()
+                    self._response = None
+        raise ArtifactError(f"Downloading {self.url} failed: {error}")
+
+    def drain(self) -> str:
+        """
+        Reads what the consumer left and returns the sha256 of the download.
+        """
+        while self.read(_CHUNK_SIZE):
+            pass
+        return self._hash.hexdigest()
+
+    def close(self):
+        if self._replay is not None:
+            self._replay.close()
+        if self._out is not None:
+            self._out.close()
+        if self._response is not None:
+            self._response.close()
+        super().close()
+
+    def commit(self) -> Path:
+        """
+        Moves the complete download into the cache.
+        """
+        digest = self.drain()
+        self.close()
+        return self._cache.store(self._partial, digest, self.url, meta=self._meta)
+
+    def discard(self):
+        """
+        Throws the download away, e.g. on a checksum mismatch.
+        """
+        self.close()
+        for path in [self._partial, self._meta]:
+            if path.exists():
+                path.unlink()
+
+
+class ArtifactCache:
+    """
+    Content addressed, size bounded cache of downloaded archives.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def object_path(self, digest) -> Path:
+        return Path(self.cache_dir, 'objects', digest)
+
+    def get(self, digest) -> Path:
+        """
+        Path of a cached object, None if it isn't cached.
+        Marks the object as recently used.
+        """
+        path = self.object_path(digest)
+        if not path.exists():
+            return None
+        os.utime(path)
+        return path
+
+    def lookup(self, url, checksum=None):
+        """
+        Returns (path, sha256) of a cached archive for url, or (None, None).
+        With a checksum any object with that sha256 is used, whatever url
+        it was fetched from.
+        """
+        digest = checksum.strip().lower() if checksum else None
+        if digest is None:
+            try:
+                digest = Path(self.cache_dir, 'urls', _url_key(url)).read_text().strip()
+            except OSError:
+                return None, None
+        path = self.get(digest)
+        return (path, digest) if path else (None, None)
+
+    def download(self, url, attempts=3) -> Download:
+        return Download(self, url, attempts=attempts)
+
+    def store(self, path, digest, url=None, meta=None) -> Path:
+        """
+        Moves the file at path into the cache as object digest.
+        """
+        target = self.object_path(digest)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, target)
+        os.utime(target)
+        if meta is not None and Path(meta).exists():
+            Path(meta).unlink()
+        if url:
+            index = Path(self.cache_dir, 'urls', _url_key(url))
+            index.parent.mkdir(parents=True, exist_ok=True)
+            index.write_text(digest)
+        self.evict(keep={digest})
+        return target
+
+    def evict(self, keep=()) -> list:
+        """
+        Removes least recently used objects until the cache fits in max_bytes.
+        :return: list of evicted digests.
+        """
+        objects_dir = Path(self.cache_dir, 'objects')
+        if not objects_dir.is_dir():
+            return []
+        entries = sorted((e.stat().st_mtime, e.stat().st_size, e.name) for e in os.scandir(objects_dir))
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, digest in entries:
+            if total <= self.max_bytes:
+                break
+            if digest in keep:
+                continue
+            self.object_path(digest).unlink()
+            total -= size
+            evicted.append(digest)
+            logger.info(f"Evicted {digest} from artifact cache")
+        return evicted
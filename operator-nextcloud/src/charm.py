@@ -9,7 +9,6 @@ import stat
 import socket
 from pathlib import Path
 import json
-import re
 from ops.charm import CharmBase
 from ops.main import main
 from ops.framework import StoredState
@@ -21,7 +20,17 @@ from ops.model import (
 )
 import utils
 import emojis
-from occ import Occ
+import config_sync
+from occ import Occ, HookCache
+from reconciler import SystemConfigReconciler
+import render
+import sysfacts
+import health
+import artifact_cache
+import releases
+import intents
+import profiler
+from upgrade import RollingUpgrade
 from interface_http import HttpProvider
 import interface_redis
 import interface_mount
@@ -34,13 +43,18 @@ logger = logging.getLogger(__name__)
 NEXTCLOUD_ROOT = os.path.abspath('/var/www/nextcloud')
 NEXTCLOUD_CONFIG_PHP = os.path.abspath('/var/www/nextcloud/config/config.php')
 NEXTCLOUD_CEPH_CONFIG_PHP = os.path.join(NEXTCLOUD_ROOT, 'config/ceph.config.php')
+NEXTCLOUD_CONFIG_DIR = os.path.join(NEXTCLOUD_ROOT, 'config')
+ONETIME_LOGIN = '/root/.onetimelogin'
 
 
+@profiler.profiled
 class NextcloudCharm(CharmBase):
     _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
+        # Cached occ results are only valid within one dispatch.
+        HookCache.invalidate()
         # Postgres
         self.database = DatabaseRequires(self, relation_name="database", database_name="nextcloud")
         # Haproxy
@@ -48,6 +62,8 @@ class NextcloudCharm(CharmBase):
         self.haproxy = HttpProvider(self, 'website', socket.getfqdn(), 80)
         # Redis
         self.redis = interface_redis.RedisClient(self, "redis")
+        # Rolling upgrades over the cluster relation
+        self.upgrade = RollingUpgrade(self)
 
         self._stored.set_default(nextcloud_datadir='/var/www/nextcloud/data/',
                                  nextcloud_fetched=False,
@@ -57,7 +73,19 @@ class NextcloudCharm(CharmBase):
                                  php_configured=False,
                                  ceph_configured=False,
                                  config_altered_on_disk=False,
-                                 redis_info=dict())
+                                 redis_info=dict(),
+                                 system_facts='',
+                                 archive_sha256='',
+                                 archive_source='',
+                                 permission_fingerprints=dict(),
+                                 config_generation=0,
+                                 intents=list(),
+                                 nextcloud_status='')
+        sysfacts.bind(self._stored)
+        health.bind(self._stored)
+        # Work that waits for nextcloud, drained at the end of every dispatch.
+        self.intents = intents.Intents(self._stored)
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
 
         event_bindings = {
             self.on.install: self._on_install,
@@ -92,28 +120,50 @@ class NextcloudCharm(CharmBase):
             self.on.maintenance_action: self._on_maintenance_action,
             self.on.set_trusted_domain_action: self._on_set_trusted_domain_action,
             self.on.get_admin_password_action: self._on_get_admin_password_action,
+            self.on.upgrade_action: self._on_upgrade_action,
+            self.on.rollback_action: self._on_rollback_action,
+            self.on.hook_profile_action: self._on_hook_profile_action,
         }
 
         for action, handler in action_bindings.items():
             self.framework.observe(action, handler)
 
+    def _offline_bundle(self):
+        """
+        Path of the offline-packages resource, None if it isn't attached.
+        """
+        try:
+            bundle = self.model.resources.fetch('offline-packages')
+        except Exception:
+            return None
+        if os.path.getsize(bundle) == 0:
+            return None
+        logger.info(f"Installing dependencies from the offline packages in {bundle}")
+        return bundle
+
     def _on_install(self, event):
         logger.debug(emojis.EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
         self.unit.status = MaintenanceStatus("installing dependencies...")
-        utils.install_apt_update()
-        utils.install_dependencies()
-        utils.install_backup_dependencies()
+        if utils.install_dependencies(self._offline_bundle()):
+            # Packages changed, so will php and its extensions.
+            sysfacts.refresh()
+        # A nextcloud extracted to /var/www/nextcloud by an older charm becomes a release.
+        releases.adopt()
         if not self._stored.nextcloud_fetched:
-            # Fetch nextcloud to /var/www/
+            # Fetch nextcloud to /var/www/nextcloud-releases/<version>
             try:
                 self.unit.status = MaintenanceStatus("installing (from resource).")
                 tarfile_path = self.model.resources.fetch('nextcloud-tarfile')
-                utils.extract_nextcloud(tarfile_path)
+                version, _ = utils.prepare_nextcloud_release(tarfile_path=tarfile_path)
             except Exception as e:
                 logger.debug("Extracting resources failed - trying network." + str(e))
                 self.unit.status = MaintenanceStatus("installing (from network).")
-                utils.fetch_and_extract_nextcloud(self.config.get('nextcloud-tarfile'))
-            utils.set_nextcloud_permissions(self)
+                tarfile_url = self.config.get('nextcloud-tarfile')
+                version, self._stored.archive_sha256 = utils.prepare_nextcloud_release(
+                    tarfile_url, self.config.get('nextcloud-tarfile-sha256'), mirrors=self._peer_archives())
+                self._stored.archive_source = tarfile_url
+            releases.switch(version)
+            utils.set_nextcloud_permissions(self, force=True)
             self.unit.status = MaintenanceStatus("installed")
             self._stored.nextcloud_fetched = True
 
@@ -121,32 +171,33 @@ class NextcloudCharm(CharmBase):
         """
         Trigger update of the cluster-relation data.
         """
-        logger.debug("Updating cluster relation data config.php on disk.")
+        logger.debug("Updating cluster relation data with config files on disk.")
         cluster_rel = self.model.relations['cluster'][0]
-        with open(NEXTCLOUD_CONFIG_PHP) as f:
-            nextcloud_config = f.read()
-            cluster_rel.data[self.app]['nextcloud_config'] = str(nextcloud_config)
+        config_sync.publish_config(cluster_rel.data[self.app], NEXTCLOUD_CONFIG_DIR)
 
     def _on_config_changed(self, event):
         """
         Any configuration change trigger a complete reconfigure of
-        the php and apache and also a restart of apache.
+        the php and apache. Apache is only reloaded or restarted if
+        that changed any of its files.
         :param event:
         :return:
         """
         logger.debug(emojis.EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        self._config_apache()
-        self._config_php()
+        changes = render.ChangeSet()
+        changes.merge(self._config_apache())
+        changes.merge(self._config_php())
+        # Only the system config keys that differ are written, in one go.
+        SystemConfigReconciler().reconcile(self._desired_system_config())
+
         if self.model.unit.is_leader():
-            self._config_overwriteprotocol()
-            self._config_overwritecliurl()
-            self._config_default_phone_region()
             self.updateClusterRelationData()
             # Untoggle this after we have ran updateClusterRelationData
             self._stored.config_altered_on_disk = False
 
-        self._config_debug()
-        sp.check_call(['systemctl', 'restart', 'apache2.service'])
+        changes.apply('apache2.service')
+        self._config_occ_worker()
+        self._share_archive()
         if self.config.get('backup-host') and self._stored.nextcloud_initialized and self._stored.database_available:
             self.unit.status = MaintenanceStatus("Configuring backup")
             utils.config_backup(self.config, self._stored.nextcloud_datadir, self._stored.dbhost,
@@ -158,6 +209,7 @@ class NextcloudCharm(CharmBase):
         logger.debug(emojis.EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
         logger.debug("!!!!!!!! I'm new nextcloud leader !!!!!!!!")
         self.update_config_php_trusted_domains()
+        self._share_archive()
 
     def update_config_php_trusted_domains(self):
         """
@@ -169,26 +221,48 @@ class NextcloudCharm(CharmBase):
         if not os.path.exists(NEXTCLOUD_CONFIG_PHP):
             return
 
+        batch = Occ.config_system_batch()
+        self._config_trusted_domains(batch)
+        SystemConfigReconciler().reconcile(batch)
+        self.updateClusterRelationData()
+
+    def _config_trusted_domains(self, batch):
+        """
+        Queues trusted domains with the ingress addresses of all peers.
+        """
         cluster_rel = self.model.relations['cluster'][0]
         rel_unit_ip = [cluster_rel.data[u]['ingress-address'] for u in cluster_rel.units]
         this_unit_ip = cluster_rel.data[self.model.unit]['ingress-address']
         rel_unit_ip.append(this_unit_ip)
-        Occ.update_trusted_domains_peer_ips(rel_unit_ip)
-        self.updateClusterRelationData()
+        Occ.update_trusted_domains_peer_ips(rel_unit_ip, batch)
+
+    def _desired_system_config(self):
+        """
+        Queues the desired value of every system config key managed
+        from charm config and relation data on a ConfigBatch.
+        """
+        batch = Occ.config_system_batch()
+        if self.model.unit.is_leader():
+            self._config_overwriteprotocol(batch)
+            self._config_overwritecliurl(batch)
+            self._config_default_phone_region(batch)
+            has_peers = bool(self.model.relations['cluster'])
+            if self._stored.nextcloud_initialized and has_peers and os.path.exists(NEXTCLOUD_CONFIG_PHP):
+                self._config_trusted_domains(batch)
+        self._config_debug(batch)
+        return batch
 
     def update_relation_ceph_config_php(self):
         if not os.path.exists(NEXTCLOUD_CEPH_CONFIG_PHP):
             return
-        cluster_rel = self.model.relations['cluster'][0]
-        with open(NEXTCLOUD_CEPH_CONFIG_PHP) as f:
-            ceph_config = f.read()
-            cluster_rel.data[self.app]['ceph_config'] = str(ceph_config)
+        self.updateClusterRelationData()
 
     def _on_cluster_relation_joined(self, event):
         logger.debug(emojis.EMOJI_CLOUD + sys._getframe().f_code.co_name)
+        self._share_archive()
         if self.model.unit.is_leader():
             if not self._stored.nextcloud_initialized:
-                event.defer()
+                self.intents.add(intents.TRUSTED_DOMAINS)
                 return
             self.framework.breakpoint('joined')
             self.update_config_php_trusted_domains()
@@ -199,26 +273,37 @@ class NextcloudCharm(CharmBase):
         Peers (non-leaders) pull in config from (cluster) relation and writes to local disk.
         """
         logger.debug(emojis.EMOJI_CLOUD + sys._getframe().f_code.co_name)
+        self.upgrade.step()
         if not self.model.unit.is_leader():
-            if 'nextcloud_config' not in event.relation.data[self.app]:
-                event.defer()
+            if not config_sync.is_published(event.relation.data[self.app]):
+                # Publishing it triggers another relation-changed.
                 return
 
-            nextcloud_config = event.relation.data[self.app]['nextcloud_config']
-            with open(NEXTCLOUD_CONFIG_PHP, "w") as f:
-                f.write(nextcloud_config)
+            if not self.upgrade.config_applies():
+                logger.info("Keeping config.php of the old release until this unit switches.")
+                return
+
+            # Only the keys and files that differ from the local ones are written.
+            databag = event.relation.data[self.app]
+            written = config_sync.apply(databag, NEXTCLOUD_CONFIG_DIR)
+            generation, changed = config_sync.apply_config(databag, NEXTCLOUD_CONFIG_DIR,
+                                                           self._stored.config_generation)
+            self._stored.config_generation = generation
+            if changed:
+                written.append(NEXTCLOUD_CONFIG_PHP)
+            if not written:
+                return
 
             # TODO: only create .ocdata file for debug since it scale out
             # will only work with a shared-fs like NFS.
             self._make_ocdata_for_occ()
 
-            if 'ceph_config' in event.relation.data[self.app]:
-                ceph_config = event.relation.data[self.app]['ceph_config']
-                with open(NEXTCLOUD_CEPH_CONFIG_PHP, "w") as f:
-                    f.write(ceph_config)
+            # Config was written behind the back of occ.
+            HookCache.invalidate()
 
-            # Set correct permissions
-            utils.set_nextcloud_permissions(self)
+            # Set correct permissions, only what was written here.
+            written += [str(self._stored.nextcloud_datadir), os.path.join(str(self._stored.nextcloud_datadir), '.ocdata')]
+            utils.set_nextcloud_file_permissions(written)
 
     def _on_cluster_relation_departed(self, event):
         logger.debug(emojis.EMOJI_CLOUD + sys._getframe().f_code.co_name)
@@ -243,8 +328,10 @@ class NextcloudCharm(CharmBase):
 
         # Leader gets to initialize and run crontabs
         if self.model.unit.is_leader() and not self._stored.nextcloud_initialized:
-            utils.set_nextcloud_permissions(self)
+            # occ maintenance:install writes the datadir as www-data.
+            utils.set_nextcloud_permissions(self, include_datadir=True)
             self._init_nextcloud()
+            health.invalidate()
             self._add_initial_trusted_domain()
             utils.setPrettyUrls()
             utils.installCrontab()
@@ -265,18 +352,68 @@ class NextcloudCharm(CharmBase):
 
     def _on_start(self, event):
         logger.debug(emojis.EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        if not self._is_nextcloud_installed():
-            logger.debug("Nextcloud not installed, defering start.")
-            event.defer()
+        if not self._nextcloud_ready():
+            logger.debug("Nextcloud not installed, starting once it is.")
+            self.intents.add(intents.START)
             return
+        self._start()
+
+    def _start(self):
         try:
             sp.check_call(['systemctl', 'restart', 'apache2.service'])
-            self._on_update_status(event)
+            self._on_update_status(None)
             utils.open_port('80')
         except sp.CalledProcessError as e:
             print(e)
             sys.exit(-1)
 
+    def _nextcloud_ready(self) -> bool:
+        """
+        True once nextcloud is installed. occ status only runs until the
+        charm initialized nextcloud, and at most once per dispatch.
+        """
+        if self._stored.nextcloud_initialized:
+            return True
+        if not self._stored.nextcloud_fetched:
+            return False
+        return bool(self._is_nextcloud_installed())
+
+    def _on_pre_commit(self, event):
+        """
+        Drains the pending intents, once per dispatch.
+        """
+        if not self.intents.pending():
+            return
+        self.intents.drain({
+            intents.START: self._intent_start,
+            intents.TRUSTED_DOMAINS: self._intent_trusted_domains,
+            intents.TRUSTED_PROXIES: self._intent_trusted_proxies,
+            intents.REDIS: self.redis.configure,
+        })
+
+    def _intent_start(self) -> bool:
+        if not self._nextcloud_ready():
+            return False
+        self._start()
+        return True
+
+    def _intent_trusted_domains(self) -> bool:
+        if not self.model.unit.is_leader():
+            # The new leader updates them in leader-elected.
+            return True
+        if not self._stored.nextcloud_initialized:
+            return False
+        self.update_config_php_trusted_domains()
+        return True
+
+    def _intent_trusted_proxies(self) -> bool:
+        if not self.model.unit.is_leader():
+            return True
+        if not self._nextcloud_ready():
+            return False
+        self.haproxy.sync_trusted_proxies()
+        return True
+
     def _on_datadir_storage_attached(self, event):
         """
         If this event is fired, we are told to use a custom datadir.
@@ -328,14 +465,77 @@ class NextcloudCharm(CharmBase):
         logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
         logger.warning("get-admin-password action invoked.")
 
-        if os.path.exists('/root/.onetimelogin'):
-            with open('/root/.onetimelogin', 'r') as f:
+        if os.path.exists(ONETIME_LOGIN):
+            with open(ONETIME_LOGIN, 'r') as f:
                 p = f.read()
                 event.set_results({"initial-admin-password": p})
-                os.remove('/root/.onetimelogin')
+                os.remove(ONETIME_LOGIN)
         else:
             event.set_results({"initial-admin-password": "NOT AVAILABLE"})
 
+    def _on_upgrade_action(self, event):
+        """
+        Starts a rolling upgrade of all units, see upgrade.py. The new
+        release is staged on every unit while the current one serves,
+        occ upgrade runs once on the leader and peers switch in batches.
+        Progress is reported in the unit status.
+        """
+        logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
+        if not self.model.unit.is_leader():
+            event.fail("Only the leader unit can run this action. Nothing was done.")
+            return
+        plan = self.upgrade.plan()
+        if plan.get('phase') in ('stage', 'upgrade', 'switch'):
+            event.fail(f"An upgrade to {plan['version']} is in progress: {plan['phase']}")
+            return
+        tarfile_url = event.params.get('tarfile') or self.config.get('nextcloud-tarfile')
+        checksum = event.params.get('sha256') or None
+        live = releases.current()
+        try:
+            version = self.upgrade.start(tarfile_url, checksum)
+        except (releases.ReleaseError, artifact_cache.ArtifactError, OSError) as e:
+            event.fail(f"Preparing the release failed, {live} is still live: {e}")
+            return
+        plan = self.upgrade.plan()
+        if plan['phase'] == 'failed':
+            event.fail(f"occ upgrade to {version} failed, the site stays in maintenance. "
+                       f"Restore the database and run the rollback action to go back to {live}.")
+            return
+        event.set_results({"version": version, "previous": live, "phase": plan['phase'],
+                           "switching": ",".join(plan['switch'])})
+
+    def _on_rollback_action(self, event):
+        """
+        Switches back to the release that was live before the last switch.
+        The database is not rolled back.
+        """
+        logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
+        live = releases.current()
+        try:
+            version = releases.rollback()
+        except releases.ReleaseError as e:
+            event.fail(str(e))
+            return
+        utils.reload_nextcloud_code()
+        event.set_results({"version": version, "previous": live})
+
+    def _on_hook_profile_action(self, event):
+        """
+        Percentiles of the recorded hook profiles per handler.
+        """
+        logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
+        records = profiler.read()
+        if event.params.get('last'):
+            records = records[-event.params['last']:]
+        handler = event.params.get('handler')
+        if handler and not handler.startswith('_on_'):
+            handler = '_on_' + handler.replace('-', '_')
+        summary = profiler.summarize(records, handler)
+        # Action result keys can't have underscores.
+        results = {name[len('_on_'):].replace('_', '-'): {k: str(v) for k, v in stats.items()}
+                   for name, stats in summary.items()}
+        event.set_results({"records": str(len(records)), "handlers": results})
+
     def _config_php(self):
         """
         Renders the phpmodule for nextcloud (nextcloud.ini)
@@ -349,16 +549,82 @@ class NextcloudCharm(CharmBase):
             'post_max_size': self.config.get('php_post_max_size'),
             'memory_limit': self.config.get('php_memory_limit')
         }
-        utils.config_php(phpmod_context, Path(self.charm_dir / 'templates'), 'nextcloud.ini.j2')
+        changes = utils.config_php(phpmod_context, Path(self.charm_dir / 'templates'), 'nextcloud.ini.j2')
         self._stored.php_configured = True
+        return changes
+
+    def _config_occ_worker(self):
+        """
+        Starts or stops the occ worker service from the occ-worker config.
+        The worker needs an installed nextcloud to bootstrap.
+        """
+        enable = self.config.get('occ-worker') and os.path.exists(NEXTCLOUD_CONFIG_PHP)
+        utils.config_occ_worker(enable, Path(self.charm_dir / 'templates'),
+                                'nextcloud-occ-worker.service.j2',
+                                Path(self.charm_dir / 'scripts/occ-worker/occ-worker.php'))
+
+    def _peer_archives(self) -> list:
+        """
+        (url, sha256) of the archives peers share for our nextcloud-tarfile,
+        the one the leader published first. Only peers that fetched the
+        same source, or have the configured checksum, are used.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if not cluster_rel:
+            return []
+        source = self.config.get('nextcloud-tarfile')
+        checksum = (self.config.get('nextcloud-tarfile-sha256') or '').strip().lower()
+        peers = sorted(cluster_rel.units, key=lambda u: u.name)
+        mirrors = []
+        for bag in [cluster_rel.data[self.app]] + [cluster_rel.data[u] for u in peers]:
+            url, sha256 = bag.get('archive-url'), bag.get('archive-sha256')
+            if not url or not sha256 or (url, sha256) in mirrors:
+                continue
+            if sha256 == checksum or (not checksum and bag.get('archive-source') == source):
+                mirrors.append((url, sha256))
+        return mirrors
+
+    def _share_archive(self):
+        """
+        Serves the fetched archive to peers and publishes where to get it,
+        the leader also in the application databag.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        sha256 = self._stored.archive_sha256
+        # The archive may have been evicted from the cache.
+        cached = sha256 and artifact_cache.ArtifactCache().get(sha256)
+        enable = bool(self.config.get('share-archive') and cached)
+        bind_address = None
+        if enable and cluster_rel:
+            bind_address = str(self.model.get_binding(cluster_rel).network.bind_address)
+        utils.config_archive_share(enable and bind_address is not None, bind_address,
+                                   Path(self.charm_dir / 'templates'), 'nextcloud-archive-share.service.j2')
+        if not cluster_rel:
+            return
+        published = {}
+        if enable and bind_address:
+            host = f'[{bind_address}]' if ':' in bind_address else bind_address
+            published = {'archive-url': f'http://{host}:{utils.ARCHIVE_SHARE_PORT}/{sha256}',
+                         'archive-sha256': sha256,
+                         'archive-source': self._stored.archive_source}
+        bags = [cluster_rel.data[self.unit]]
+        if self.unit.is_leader():
+            bags.append(cluster_rel.data[self.app])
+        for bag in bags:
+            for key in ['archive-url', 'archive-sha256', 'archive-source']:
+                if published.get(key):
+                    bag[key] = published[key]
+                elif key in bag:
+                    del bag[key]
 
     def _config_apache(self):
         """
         Configured apache
         """
         self.unit.status = MaintenanceStatus("config apache....")
-        utils.config_apache2(Path(self.charm_dir / 'templates'), 'nextcloud.conf.j2')
+        changes = utils.config_apache2(Path(self.charm_dir / 'templates'), 'nextcloud.conf.j2')
         self._stored.apache_configured = True
+        return changes
 
     def _init_nextcloud(self):
         """
@@ -369,9 +635,9 @@ class NextcloudCharm(CharmBase):
 
         # Generate a onetime password (retrieved by action)
         p = utils.generatePassword()
-        with open('/root/.onetimelogin', 'w+') as f:
+        with open(ONETIME_LOGIN, 'w+') as f:
             f.write(p)
-            os.chmod('/root/.onetimelogin', stat.S_IREAD)
+            os.chmod(ONETIME_LOGIN, stat.S_IREAD)
 
         # Collect database information from relation.
         db_data = self.fetch_postgres_relation_data()
@@ -421,6 +687,9 @@ class NextcloudCharm(CharmBase):
         if not self._stored.nextcloud_fetched:
             self.unit.status = BlockedStatus("Nextcloud not fetched.")
 
+        elif self.upgrade.in_progress():
+            self.unit.status = self.upgrade.status()
+
         elif not self._stored.nextcloud_initialized:
             self.unit.status = BlockedStatus("Nextcloud not initialized.")
 
@@ -439,34 +708,36 @@ class NextcloudCharm(CharmBase):
             # For now - it will be visual.
             self.unit.status = WaitingStatus("Warning: Local changes to config.php")
         else:
-            try:
-                v = self._nextcloud_version()
+            # status.php, occ only if apache doesn't serve it.
+            status = health.status()
+            if status is None:
+                self.unit.status = WaitingStatus("Nextcloud answers neither on status.php nor occ.")
+            elif status['maintenance']:
+                self.unit.status = MaintenanceStatus(f"{status['version']} in maintenance mode")
+            elif status['source'] != 'http':
+                self.unit.status = BlockedStatus(f"{status['version']} not served by apache: {status['error']}")
+            else:
                 if self.model.unit.is_leader():
                     # Only leader need to set app version
-                    self.unit.set_workload_version(v)
-                    # Set the active status to the running version.
-                    self.unit.status = ActiveStatus(v + " " + emojis.EMOJI_CLOUD)
-                else:
-                    self.unit.status = ActiveStatus(v + " " + emojis.EMOJI_CLOUD)
-            except Exception as e:
-                logger.error("Failed query Nextcloud occ for status: ", e)
-                sys.exit(-1)
+                    self.unit.set_workload_version(status['version'])
+                # Set the active status to the running version.
+                self.unit.status = ActiveStatus(status['version'] + " " + emojis.EMOJI_CLOUD)
 
     def _on_redis_available(self, event):
         """
-        When redis is available, apache needs a restart.
+        When redis is available, apache needs a reload if the session handler changed.
         /var/www/nextcloud/config/redis.config.php - modified
         /etc/php/X.Y/mods-available/redis_session.ini - modified
         """
-        sp.run(['systemctl', 'restart', 'apache2.service'])
+        self.redis.changes.apply('apache2.service')
 
     def _on_redis_broken(self, event):
         """
-        When redis integration removed, apache needs a restart.
+        When redis integration removed, apache needs a reload if the session handler was removed.
         /var/www/nextcloud/config/redis.config.php - removed
         /etc/php/X.Y/mods-available/redis_session.ini - removed
         """
-        sp.run(['systemctl', 'restart', 'apache2.service'])
+        self.redis.changes.apply('apache2.service')
 
     def _on_set_trusted_domain_action(self, event):
         domain = event.params['domain']
@@ -497,11 +768,11 @@ class NextcloudCharm(CharmBase):
 
         # Set new datadir
         cmd = "sudo -u www-data php occ config:system:set datadirectory --value=/media/nextcloud/data/"
-        sp.run(cmd.split(), cwd="/var/www/nextcloud/")
+        sp.run(cmd.split(), cwd=NEXTCLOUD_ROOT)
 
         # Cleanup cache
         cmd = "sudo -u www-data php occ files:cleanup"
-        sp.run(cmd.split(), cwd="/var/www/nextcloud/")
+        sp.run(cmd.split(), cwd=NEXTCLOUD_ROOT)
 
         # sudo -u www-data php /path/to/nextcloud/occ maintenance:mode --off
         Occ.maintenance_mode(enable=False)
@@ -527,37 +798,37 @@ class NextcloudCharm(CharmBase):
             self.unit.status = MaintenanceStatus("ceph config complete.")
             self.update_relation_ceph_config_php()
 
-    def _config_overwriteprotocol(self):
+    def _config_overwriteprotocol(self, batch=None):
         """
         Configures nextcloud overwriteprotocol to http or https.
         :return:
         """
         if self._stored.nextcloud_initialized:
-            Occ.overwriteprotocol(self.config.get('overwriteprotocol'))
+            Occ.overwriteprotocol(self.config.get('overwriteprotocol'), batch)
 
-    def _config_debug(self):
+    def _config_debug(self, batch=None):
         """
         Configures nextcloud system:debug from config value.
         :return:
         """
         if self._stored.nextcloud_initialized:
-            Occ.setDebug(self.config.get('debug'))
+            Occ.setDebug(self.config.get('debug'), batch)
 
-    def _config_overwritecliurl(self):
+    def _config_overwritecliurl(self, batch=None):
         """
         Configures nextcloud overwrite-cli-url config value.
         :return:
         """
         if self._stored.nextcloud_initialized:
-            Occ.overwriteCliUrl(self.config.get('overwrite-cli-url'))
+            Occ.overwriteCliUrl(self.config.get('overwrite-cli-url'), batch)
 
-    def _config_default_phone_region(self):
+    def _config_default_phone_region(self, batch=None):
         """
         Configures nextcloud overwriteprotocol to http or https.
         :return:
         """
         if self._stored.nextcloud_initialized:
-            Occ.defaultPhoneRegion(self.config.get('default-phone-region'))
+            Occ.defaultPhoneRegion(self.config.get('default-phone-region'), batch)
 
     def _make_ocdata_for_occ(self):
         """
@@ -569,21 +840,10 @@ class NextcloudCharm(CharmBase):
         if not self._stored.nextcloud_datadir.joinpath('.ocdata').exists():
             self._stored.nextcloud_datadir.joinpath('.ocdata').touch()
 
-    def _is_nextcloud_installed(self):
-        status = Occ.status()
-        logger.debug(status)
-        try:
-            match = re.findall(r'\{.*?\}', status.stdout)
-            return json.loads(match[0])['installed']
-        except IndexError:
-            return False
-        except Exception as e:
-            print("Failed determining installation status: ", e)
-            sys.exit(-1)
-
-    def _nextcloud_version(self):
-        logger.debug("Determined nextcloud version: " + json.loads(Occ.status().stdout)['version'])
-        return json.loads(Occ.status().stdout)['version']
+    def _is_nextcloud_installed(self) -> bool:
+        status = health.status()
+        logger.debug(f"Nextcloud status: {status}")
+        return bool(status and status['installed'])
 
     def _checkLogConfigDiff(self):
         """
@@ -592,18 +852,16 @@ class NextcloudCharm(CharmBase):
         """
         cluster_rel = self.model.relations['cluster'][0]
         try:
-            if 'nextcloud_config' in cluster_rel.data[self.app]:
-                with open(NEXTCLOUD_CONFIG_PHP) as f:
-                    nextcloud_config = f.read()
-                    if cluster_rel.data[self.app]['nextcloud_config'] == str(nextcloud_config):
-                        logger.info("No manual/local changes to nextcloud config.php detected.")
-                    else:
-                        # Toggle this information. Resolve it within config_changed.
-                        self._stored.config_altered_on_disk = True
-                        logger.warning("Manual/local changes to config.php detected, \
-                                       will be overwritten by config updates!")
+            if config_sync.is_published(cluster_rel.data[self.app]):
+                if not config_sync.config_differs(cluster_rel.data[self.app], NEXTCLOUD_CONFIG_DIR):
+                    logger.info("No manual/local changes to nextcloud config.php detected.")
+                else:
+                    # Toggle this information. Resolve it within config_changed.
+                    self._stored.config_altered_on_disk = True
+                    logger.warning("Manual/local changes to config.php detected, \
+                                   will be overwritten by config updates!")
             else:
-                logger.info("nextcloud_config key not found in cluster_rel.data.")
+                logger.info("No published config found in cluster_rel.data.")
         except KeyError:
             logger.error("Error accessing cluster_rel.data dictionary.")
 
@@ -0,0 +1,220 @@
+"""
+Propagation of the leader's nextcloud config to peers.
+
+config.php is published as a versioned key/value document under DOC_KEY:
+
+    {"generation": 42, "changed": ["trusted_domains"], "values": {...}}
+
+The generation is raised with every change and "changed" lists the keys
+that differ from the previous generation. A peer that applied the
+previous generation only looks at those keys, one further behind diffs
+all keys, and generations older than the applied one are rejected.
+Only the keys that differ are changed in the local config.php. The last
+generation is also kept under GENERATION_KEY, so it keeps rising when
+the document was dropped in between.
+
+The shared overlays, and config.php when it can't be parsed as literal
+php, are published as files under KEY:
+
+    {"ceph.config.php": {"sha256": "<hex>", "payload": "<base64 of zlib>"}}
+
+Peers compare each sha256 with the file they have and only decode and
+write the files that differ, so an unchanged config costs a hash of the
+local file.
+"""
+import base64
+import hashlib
+import json
+import logging
+import zlib
+from pathlib import Path
+import nextcloud_config
+import render
+
+logger = logging.getLogger(__name__)
+
+KEY = 'config_files'
+DOC_KEY = 'config_doc'
+GENERATION_KEY = 'config_generation'
+
+# Overlays that are the same on every unit, unlike e.g. redis.config.php
+# which each unit renders from its own redis relation.
+SHARED_FILES = ['ceph.config.php']
+
+_MISSING = object()
+
+# Keys of the raw config payloads published by earlier charm revisions.
+LEGACY_KEYS = ['nextcloud_config', 'ceph_config']
+
+
+def sha256(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def encode(data) -> dict:
+    return {'sha256': sha256(data),
+            'payload': base64.b64encode(zlib.compress(data, 9)).decode()}
+
+
+def decode(entry) -> bytes:
+    """
+    Content of a published entry, verified against its hash.
+    """
+    data = zlib.decompress(base64.b64decode(entry['payload']))
+    if sha256(data) != entry['sha256']:
+        raise ValueError("Config payload doesn't match its sha256")
+    return data
+
+
+def _local_sha256(path) -> str:
+    try:
+        return sha256(Path(path).read_bytes())
+    except FileNotFoundError:
+        return None
+
+
+def published(databag) -> dict:
+    return json.loads(databag.get(KEY) or '{}')
+
+
+def publish(databag, config_dir, names=SHARED_FILES) -> bool:
+    """
+    Publishes the files in config_dir, files that don't exist are left out.
+    The data bag is only written if a file changed.
+    :return: True if it was written.
+    """
+    files = {}
+    for name in names:
+        try:
+            files[name] = encode(Path(config_dir, name).read_bytes())
+        except FileNotFoundError:
+            continue
+    for key in LEGACY_KEYS:
+        if key in databag:
+            del databag[key]
+    current = published(databag)
+    if {n: e['sha256'] for n, e in current.items()} == {n: e['sha256'] for n, e in files.items()}:
+        return False
+    databag[KEY] = json.dumps(files, sort_keys=True)
+    logger.info("Published config files: " + ", ".join(sorted(files)))
+    return True
+
+
+def differing(databag, config_dir) -> list:
+    """
+    Names of the published files whose local copy differs.
+    """
+    return [name for name, entry in sorted(published(databag).items())
+            if _local_sha256(Path(config_dir, name)) != entry['sha256']]
+
+
+def apply(databag, config_dir) -> list:
+    """
+    Writes the published files that differ from the local ones.
+    :return: paths of the written files.
+    """
+    files = published(databag)
+    written = []
+    for name in differing(databag, config_dir):
+        target = Path(config_dir, name)
+        render.write_file(target, decode(files[name]), mode=0o640)
+        written.append(str(target))
+    if written:
+        logger.info("Applied config files from the leader: " + ", ".join(written))
+    return written
+
+
+def is_published(databag) -> bool:
+    return DOC_KEY in databag or KEY in databag
+
+
+def _values(path) -> dict:
+    """
+    The parsed config.php as it looks after a round trip through json.
+    """
+    return json.loads(json.dumps(nextcloud_config.read_file(str(path))))
+
+
+def document(databag) -> dict:
+    return json.loads(databag.get(DOC_KEY) or '{}')
+
+
+def publish_config(databag, config_dir) -> bool:
+    """
+    Publishes config.php as the next generation of the key/value
+    document, if any key changed. A config.php that can't be parsed is
+    published as a file instead.
+    :return: True if the data bag was written.
+    """
+    path = Path(config_dir, 'config.php')
+    try:
+        values = _values(path)
+    except nextcloud_config.ConfigPhpError as e:
+        logger.warning(f"Publishing config.php as file, it can't be parsed: {e}")
+        if DOC_KEY in databag:
+            del databag[DOC_KEY]
+        return publish(databag, config_dir, ['config.php'] + SHARED_FILES)
+    published_files = publish(databag, config_dir)
+    doc = document(databag)
+    old = doc.get('values', {})
+    if doc and old == values:
+        return published_files
+    changed = sorted(k for k in set(old) | set(values) if old.get(k, _MISSING) != values.get(k, _MISSING))
+    # Peers reject generations below the one they applied, it never goes back.
+    generation = max(doc.get('generation', 0), int(databag.get(GENERATION_KEY) or 0)) + 1
+    databag[DOC_KEY] = json.dumps({'generation': generation, 'changed': changed, 'values': values},
+                                  sort_keys=True)
+    databag[GENERATION_KEY] = str(generation)
+    logger.info(f"Published config generation {generation}, changed: {', '.join(changed)}")
+    return True
+
+
+def config_differs(databag, config_dir) -> bool:
+    """
+    True if the local config.php differs from the published one.
+    """
+    doc = document(databag)
+    if not doc:
+        return 'config.php' in differing(databag, config_dir)
+    try:
+        return _values(Path(config_dir, 'config.php')) != doc['values']
+    except (OSError, nextcloud_config.ConfigPhpError):
+        return True
+
+
+def apply_config(databag, config_dir, applied) -> tuple:
+    """
+    Changes the keys of the local config.php that differ from the
+    published generation, if it is newer than applied.
+    :return: (generation now applied, True if config.php was written)
+    """
+    doc = document(databag)
+    if not doc:
+        return applied, False
+    generation = doc['generation']
+    if generation < applied:
+        logger.warning(f"Rejecting stale config generation {generation}, {applied} is applied.")
+        return applied, False
+    if generation == applied:
+        return applied, False
+    values = doc['values']
+    path = Path(config_dir, 'config.php')
+    try:
+        current = _values(path)
+        keys = doc['changed'] if generation == applied + 1 else set(current) | set(values)
+    except (FileNotFoundError, nextcloud_config.ConfigPhpError) as e:
+        logger.info(f"Replacing local config.php: {e}")
+        current = {}
+        keys = set(values)
+    delta = {k: values.get(k, _MISSING) for k in keys if current.get(k, _MISSING) != values.get(k, _MISSING)}
+    if not delta:
+        return generation, False
+    config = dict(current)
+    for key, value in delta.items():
+        if value is _MISSING:
+            config.pop(key, None)
+        else:
+            config[key] = value
+    render.write_file(path, nextcloud_config.dump(config), mode=0o640)
+    logger.info(f"Applied config generation {generation}, keys: {', '.join(sorted(delta))}")
+    return generation, True
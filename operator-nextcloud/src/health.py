@@ -0,0 +1,153 @@
+"""
+Nextcloud status from its web tier.
+
+status() asks the status.php apache serves, with one GET on a kept
+alive connection. That costs a few milliseconds instead of booting php
+for occ status, and it tells whether the web tier actually serves
+nextcloud. occ status is only asked when the GET fails.
+
+The result is kept in StoredState for TTL seconds, or until config.php
+changes: installing, maintenance mode, upgrades and switching releases
+all write it.
+"""
+import http.client
+import json
+import logging
+import os
+import re
+import time
+from urllib.parse import urlsplit
+import nextcloud_config
+from occ import Occ
+
+logger = logging.getLogger(__name__)
+
+STATUS_URL = 'http://localhost/status.php'
+TIMEOUT = 2
+TTL = 60
+
+_FIELDS = ['installed', 'maintenance', 'needsDbUpgrade', 'version', 'versionstring']
+
+_stored = None
+_connection = None
+
+
+def bind(stored) -> None:
+    """
+    Keep the status in stored, a StoredState with a nextcloud_status string.
+    """
+    global _stored
+    _stored = stored
+
+
+def close() -> None:
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+
+def _connect(url, timeout) -> tuple:
+    """
+    :return: (connection, True if it was kept alive from an earlier GET)
+    """
+    global _connection
+    parts = urlsplit(url)
+    address = (parts.hostname, parts.port or http.client.HTTP_PORT)
+    if _connection is not None and (_connection.host, _connection.port) == address:
+        return _connection, True
+    close()
+    _connection = http.client.HTTPConnection(*address, timeout=timeout)
+    return _connection, False
+
+
+def parse(data) -> dict:
+    """
+    The fields of a status.php or occ status reply the charm uses.
+    """
+    if not isinstance(data, dict) or 'installed' not in data:
+        raise ValueError(f"Not a nextcloud status: {data!r}")
+    return {field: data.get(field) for field in _FIELDS}
+
+
+def fetch(url=None, timeout=TIMEOUT) -> dict:
+    """
+    GETs status.php. A kept alive connection the server closed in the
+    meantime is retried once on a new one.
+    Raises OSError, http.client.HTTPException or ValueError.
+    """
+    url = url or STATUS_URL
+    while True:
+        connection, reused = _connect(url, timeout)
+        try:
+            connection.request('GET', urlsplit(url).path or '/', headers={'Accept': 'application/json'})
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            close()
+            if reused:
+                continue
+            raise
+        if response.status != 200:
+            raise http.client.HTTPException(f"{url} returned {response.status} {response.reason}")
+        return parse(json.loads(body))
+
+
+def occ_status() -> dict:
+    """
+    The status from occ, the json may come after php warnings.
+    Raises ValueError if occ didn't give one.
+    """
+    cp = Occ.status()
+    match = re.search(r'\{.*?\}', cp.stdout or '')
+    if cp.returncode != 0 or not match:
+        raise ValueError(f"occ status failed: {(cp.stdout or '') + (cp.stderr or '')}")
+    return parse(json.loads(match.group()))
+
+
+def _config_key() -> list:
+    try:
+        st = os.stat(os.path.join(nextcloud_config.CONFIG_DIR, 'config.php'))
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _cached(now) -> dict:
+    if _stored is None or not _stored.nextcloud_status:
+        return None
+    cached = json.loads(_stored.nextcloud_status)
+    if not 0 <= now - cached['checked'] < TTL or cached['config'] != _config_key():
+        return None
+    return cached
+
+
+def invalidate() -> None:
+    if _stored is not None:
+        _stored.nextcloud_status = ''
+
+
+def status() -> dict:
+    """
+    The nextcloud status with the fields of parse() and
+        source  'http', or 'occ' if status.php failed
+        error   why status.php failed, None if it didn't
+    None if neither status.php nor occ answered.
+    """
+    now = time.time()
+    cached = _cached(now)
+    if cached is not None:
+        return cached
+    try:
+        result = dict(fetch(), source='http', error=None)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        logger.warning(f"{STATUS_URL} failed, asking occ: {e}")
+        try:
+            result = dict(occ_status(), source='occ', error=str(e) or type(e).__name__)
+        except ValueError as occ_error:
+            logger.error(f"Unable to determine the nextcloud status: {occ_error}")
+            return None
+    result.update(checked=now, config=_config_key())
+    if _stored is not None:
+        _stored.nextcloud_status = json.dumps(result)
+    return result
@@ -0,0 +1,246 @@
+"""
+Idempotent package installation.
+
+The full package set of a distro is compared with what dpkg-query
+reports as installed, and only the missing packages are installed, in
+a single apt transaction. apt update only runs when packages are
+missing and the package index is older than INDEX_MAX_AGE. Python
+packages are checked against the dist-info dirs of the system python
+and the missing ones installed with one pip call.
+
+With an offline bundle (the offline-packages resource) everything is
+installed from it and the network is not used. The bundle is a tar with:
+    debs/*.deb      packages and their dependencies, optionally with a
+                    Packages(.gz) index to be used as a flat apt repository
+    wheels/*.whl    python packages
+"""
+import glob
+import logging
+import os
+import re
+import shutil
+import subprocess as sp
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Inspired by: https://github.com/nextcloud/vm/blob/master/nextcloud_install_production.sh
+PACKAGES = {
+    'bionic': ['apache2',
+               'libapache2-mod-php7.2',
+               'php7.2-gd',
+               'php7.2-json',
+               'php7.2-mysql',
+               'php7.2-pgsql',
+               'php7.2-curl',
+               'php7.2-mbstring',
+               'php7.2-intl',
+               'php7.2-imagick',
+               'php7.2-zip',
+               'php7.2-xml',
+               'php-apcu',
+               'php-redis',
+               'php-smbclient',
+               'lbzip2',
+               'zstd'],
+    'focal': ['apache2',
+              'libapache2-mod-php7.4',
+              'php7.4-fpm',
+              'php7.4-intl',
+              'php7.4-ldap',
+              'php7.4-imap',
+              'php7.4-gd',
+              'php7.4-pgsql',
+              'php7.4-curl',
+              'php7.4-xml',
+              'php7.4-zip',
+              'php7.4-mbstring',
+              'php7.4-soap',
+              'php7.4-json',
+              'php7.4-gmp',
+              'php7.4-bz2',
+              'php7.4-bcmath',
+              'php7.4-imagick',
+              'php-pear',
+              'php-apcu',
+              'php-redis',
+              'lbzip2',
+              'zstd'],
+    'jammy': "apache2 php8.1 libapache2-mod-php8.1 php8.1-curl php8.1-xml \
+              php8.1-pgsql php8.1-mbstring php8.1-gd php8.1-redis \
+              php8.1-intl php8.1-gmp php8.1-bcmath php8.1-imagick \
+              php8.1-zip php8.1-fpm php8.1-intl php8.1-ldap \
+              lbzip2 zstd".split(),
+}
+
+BACKUP_PACKAGES = ['pigz',
+                   'postgresql-client',
+                   'python3-pip']
+
+PIP_PACKAGES = ['pdpyras==4.4.0']
+
+# Where pip3 of the system python installs to.
+PIP_SITE_DIRS = ['/usr/local/lib/python3*/dist-packages', '/usr/lib/python3/dist-packages']
+
+# Written by apt after a successful update (update-notifier-common) and by us.
+APT_UPDATE_STAMPS = ['/var/lib/apt/periodic/update-success-stamp',
+                     '/var/lib/nextcloud-charm/apt-update-stamp']
+INDEX_MAX_AGE = 24 * 3600
+
+OFFLINE_DIR = '/var/lib/nextcloud-charm/offline'
+# apt options that leave out all configured sources.
+_NO_SOURCES = ['-o', 'Dir::Etc::SourceList=/dev/null', '-o', 'Dir::Etc::SourceParts=/dev/null']
+
+
+def packages_for(codename) -> list:
+    """
+    Full package set for a distro, without duplicates.
+    """
+    if codename not in PACKAGES:
+        raise RuntimeError("No valid series found to install package dependencies for")
+    return list(dict.fromkeys(PACKAGES[codename] + BACKUP_PACKAGES))
+
+
+def installed_packages(packages) -> set:
+    """
+    The packages dpkg reports as installed, in one dpkg-query call.
+    """
+    cp = sp.run(['dpkg-query', '-W', '-f=${Package}\t${db:Status-Abbrev}\n'] + list(packages),
+                stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True)
+    installed = set()
+    for line in cp.stdout.splitlines():
+        name, _, status = line.partition('\t')
+        if status.startswith('ii'):
+            installed.add(name.split(':')[0])
+    return installed
+
+
+def missing_packages(packages) -> list:
+    installed = installed_packages(packages)
+    return [p for p in packages if p not in installed]
+
+
+def index_fresh(max_age=INDEX_MAX_AGE) -> bool:
+    """
+    True if apt update ran successfully within max_age seconds.
+    """
+    stamps = [os.path.getmtime(p) for p in APT_UPDATE_STAMPS if os.path.exists(p)]
+    return bool(stamps) and time.time() - max(stamps) < max_age
+
+
+def apt_update():
+    sp.run(['sudo', 'apt-get', 'update'], check=True)
+    stamp = Path(APT_UPDATE_STAMPS[-1])
+    stamp.parent.mkdir(parents=True, exist_ok=True)
+    stamp.touch()
+
+
+def apt_install(packages):
+    command = ['sudo', 'DEBIAN_FRONTEND=noninteractive', 'apt-get', 'install', '-y']
+    sp.run(command + list(packages), check=True)
+
+
+def _normalize(name) -> str:
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def pip_installed(requirement) -> bool:
+    """
+    True if a name==version requirement has a dist-info in the system python.
+    A requirement without version only needs the package.
+    """
+    name, _, version = requirement.partition('==')
+    wanted = _normalize(name)
+    for site_dir in PIP_SITE_DIRS:
+        for dist_info in glob.glob(os.path.join(site_dir, '*.dist-info')):
+            dist_name, _, dist_version = os.path.basename(dist_info)[:-len('.dist-info')].partition('-')
+            if _normalize(dist_name) == wanted and (not version or dist_version == version):
+                return True
+    return False
+
+
+def pip_install(requirements):
+    sp.run(['sudo', 'pip3', 'install'] + list(requirements), check=True)
+
+
+def unpack_offline(bundle, offline_dir=OFFLINE_DIR) -> Path:
+    """
+    Unpacks an offline bundle, unless this bundle already is unpacked.
+    :return: the directory with debs/ and wheels/.
+    """
+    st = os.stat(bundle)
+    source = f"{st.st_size}:{st.st_mtime_ns}"
+    offline_dir = Path(offline_dir)
+    marker = Path(offline_dir, '.source')
+    if marker.exists() and marker.read_text() == source:
+        return offline_dir
+    shutil.rmtree(offline_dir, ignore_errors=True)
+    offline_dir.mkdir(parents=True)
+    import tarfile
+    with tarfile.open(bundle, 'r:*') as tfile:
+        tfile.extractall(path=offline_dir)
+    marker.write_text(source)
+    logger.info(f"Unpacked offline packages {bundle} to {offline_dir}")
+    return offline_dir
+
+
+def apt_install_offline(packages, offline_dir):
+    """
+    Installs packages from the debs of an offline bundle only. A bundle
+    with a Packages index is used as the only apt source, otherwise all
+    its debs are given to apt to resolve dependencies among them.
+    The lists and caches of the bundle source are kept in offline_dir,
+    apt-get update would otherwise drop the lists of the system sources.
+    """
+    debs = Path(offline_dir, 'debs').resolve()
+    command = ['sudo', 'DEBIAN_FRONTEND=noninteractive', 'apt-get']
+    if Path(debs, 'Packages').exists() or Path(debs, 'Packages.gz').exists():
+        sources = Path(offline_dir, 'sources.list')
+        sources.write_text(f"deb [trusted=yes] file:{debs} ./\n")
+        lists = Path(offline_dir, 'lists').resolve()
+        cache = Path(offline_dir, 'cache').resolve()
+        for partial in [Path(lists, 'partial'), Path(cache, 'archives', 'partial')]:
+            partial.mkdir(parents=True, exist_ok=True)
+        options = ['-o', f'Dir::Etc::SourceList={sources}', '-o', 'Dir::Etc::SourceParts=/dev/null',
+                   '-o', f'Dir::State::Lists={lists}', '-o', f'Dir::Cache={cache}']
+        sp.run(command + options + ['update'], check=True)
+        sp.run(command + options + ['install', '-y', '--no-download'] + list(packages), check=True)
+        return
+    files = sorted(str(p) for p in debs.glob('*.deb'))
+    sp.run(command + _NO_SOURCES + ['install', '-y', '--no-download'] + files, check=True)
+
+
+def pip_install_offline(requirements, offline_dir):
+    wheels = Path(offline_dir, 'wheels')
+    sp.run(['sudo', 'pip3', 'install', '--no-index', '--find-links', str(wheels)] + list(requirements),
+           check=True)
+
+
+def install(packages, pip_packages=(), offline_dir=None) -> bool:
+    """
+    Installs what is missing of packages and pip_packages.
+    With offline_dir, an unpacked offline bundle, only from there.
+    :return: True if anything was installed.
+    """
+    missing = missing_packages(packages)
+    if missing and offline_dir:
+        logger.info("Installing packages from the offline bundle: " + " ".join(missing))
+        apt_install_offline(missing, offline_dir)
+    elif missing:
+        if index_fresh():
+            logger.info("Package index is fresh, skipping apt update.")
+        else:
+            apt_update()
+        logger.info("Installing packages: " + " ".join(missing))
+        apt_install(missing)
+    missing_pip = [r for r in pip_packages if not pip_installed(r)]
+    if missing_pip and offline_dir:
+        logger.info("Installing python packages from the offline bundle: " + " ".join(missing_pip))
+        pip_install_offline(missing_pip, offline_dir)
+    elif missing_pip:
+        logger.info("Installing python packages: " + " ".join(missing_pip))
+        pip_install(missing_pip)
+    if not missing and not missing_pip:
+        logger.info("All packages already installed.")
+    return bool(missing or missing_pip)
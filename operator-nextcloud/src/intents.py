@@ -0,0 +1,70 @@
+"""
+Coalesced pending work, instead of deferred events.
+
+A deferred event is re-emitted on every following dispatch, and every
+re-emit repeats its readiness check, e.g. occ status. Handlers that
+can't act yet record an intent instead: a name for the work, kept once
+in StoredState no matter how many events asked for it. Pending intents
+are drained once per dispatch, at the end of it, and each one stays
+pending until its handler reports it done.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+START = 'start'
+TRUSTED_DOMAINS = 'trusted-domains'
+TRUSTED_PROXIES = 'trusted-proxies'
+REDIS = 'redis'
+
+
+class Intents:
+    """
+    Ordered set of intent names kept in a StoredState list attribute.
+    """
+
+    def __init__(self, stored, attribute='intents'):
+        self._stored = stored
+        self._attribute = attribute
+
+    def pending(self) -> list:
+        return list(getattr(self._stored, self._attribute))
+
+    def _set(self, names):
+        setattr(self._stored, self._attribute, list(names))
+
+    def add(self, name) -> bool:
+        """
+        Records an intent, once.
+        :return: True if it wasn't pending yet.
+        """
+        names = self.pending()
+        if name in names:
+            logger.debug(f"Intent {name} already pending.")
+            return False
+        self._set(names + [name])
+        logger.debug(f"Intent {name} recorded.")
+        return True
+
+    def discard(self, name):
+        self._set(n for n in self.pending() if n != name)
+
+    def drain(self, handlers) -> list:
+        """
+        Runs the handler of every pending intent, in the order they were
+        recorded. A handler returns True when the work is done, False to
+        keep it pending. Intents without a handler are dropped.
+        :return: the intents that were done.
+        """
+        done = []
+        for name in self.pending():
+            handler = handlers.get(name)
+            if handler is None:
+                logger.warning(f"No handler for intent {name}, dropping it.")
+                self.discard(name)
+                continue
+            if handler():
+                logger.debug(f"Intent {name} done.")
+                self.discard(name)
+                done.append(name)
+        return done
@@ -4,6 +4,7 @@
 from ops.framework import Object
 import logging
 import utils
+import intents
 
 
 class HttpProvider(Object):
@@ -37,14 +38,12 @@ class HttpProvider(Object):
         A joining reverse-proxy is added to the list of _trusted_proxies
         """
         if self.charm.model.unit.is_leader():
-            if not self.charm._is_nextcloud_installed():
-                logging.debug("Defering relation_joined until nextcloud is installed.")
-                event.defer()
+            if not self.charm._nextcloud_ready():
+                logging.debug("Syncing trusted proxies once nextcloud is installed.")
+                self.charm.intents.add(intents.TRUSTED_PROXIES)
                 return
             else:
-                raddr = event.relation.data[event.unit]['private-address']
-                logging.debug(f"Adding a trusted_proxy: {raddr}")
-                utils.addTrustedProxy(raddr)
+                self.sync_trusted_proxies()
 
     def _on_relation_changed(self, event):
         raddr = event.relation.data[event.unit]['private-address']
@@ -55,20 +54,34 @@ class HttpProvider(Object):
 
     def _on_relation_departed(self, event):
         """
-        Re-adds only joined units to _trusted_proxies
+        Keeps only the remaining units in _trusted_proxies
         (Effectively removing departed units)
         """
         if self.charm.model.unit.is_leader():
-            if not self.charm._is_nextcloud_installed():
-                logging.debug("Defering relation_departed until nextcloud is installed.")
-                event.defer()
+            if not self.charm._nextcloud_ready():
+                logging.debug("Syncing trusted proxies once nextcloud is installed.")
+                self.charm.intents.add(intents.TRUSTED_PROXIES)
                 return
             else:
-                # TODO: Figure out how to remove a single unit since it seems not avilable
-                # in this hook (private-address is not available in the data bucket)
-                utils.deleteTrustedProxies()
-                logging.debug("Re-adding remaning units:" + str(event.relation.units))
-                for u in event.relation.units:
-                    raddr = event.relation.data[u]['private-address']
-                    utils.addTrustedProxy(raddr)
-                    # utils.deleteTrustedProxy(raddr)
+                self.sync_trusted_proxies()
+
+    def _proxy_addresses(self):
+        """
+        The private-address of every unit currently on the relation(s).
+        A departing unit is no longer listed in relation.units.
+        """
+        addresses = set()
+        for relation in self.model.relations[self._relation_name]:
+            for unit in relation.units:
+                raddr = relation.data[unit].get('private-address')
+                if raddr:
+                    addresses.add(raddr)
+        return addresses
+
+    def sync_trusted_proxies(self):
+        """
+        Writes the additions and removals of trusted proxies in one go.
+        """
+        proxies = self._proxy_addresses()
+        logging.debug("Trusted proxies from relation: " + str(sorted(proxies)))
+        utils.syncTrustedProxies(proxies)
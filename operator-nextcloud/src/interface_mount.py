@@ -62,10 +62,6 @@ class NFSMountClient(Object):
         utils.install_nfs_systemd_mount(Path(self._charm.charm_dir / 'templates'),
                                         'media-nextcloud-data.mount.j2', ctx)
 
-        # Reload daemons
-        cmd = "systemctl daemon-reload"
-        sp.run(cmd.split())
-
         # Let the world know we're done.
         self.on.nfsmount_available.emit()
 
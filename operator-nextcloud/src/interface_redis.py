@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import logging
+import os
 from pathlib import Path
-import subprocess as sp
-import jinja2
 import utils
+import intents
+import render
+import modstate
 
 from ops.framework import (
     EventBase,
@@ -15,6 +17,8 @@ from ops.framework import (
 
 logger = logging.getLogger()
 
+NEXTCLOUD_CONFIG_DIR = '/var/www/nextcloud/config'
+
 
 class RedisAvailableEvent(EventBase):
     """RedisAvailableEvent."""
@@ -40,6 +44,8 @@ class RedisClient(Object):
         super().__init__(charm, relation_name)
         self._charm = charm
         self._relation_name = relation_name
+        # Files changed while handling the current event.
+        self.changes = render.ChangeSet()
         # Observe the relation-changed hook event and bind
         # self.on_relation_changed() to handle the event.
         self.framework.observe(
@@ -52,31 +58,42 @@ class RedisClient(Object):
         )
 
     def _on_relation_changed(self, event):
-        event_unit_data = event.relation.data.get(event.unit)
-        if not event_unit_data:
-            event.defer()
-            return
-        password = event_unit_data.get('password')
-        host = event_unit_data.get('hostname')
-        port = event_unit_data.get('port')
-
-        if (host and port):
-            redis_info = {
-                'redis_password': password,
-                'redis_hostname': host,
-                'redis_port': port,
-            }
-
-            # Configure redis
-            self.config_redis(redis_info)
-            self.config_redis_session(redis_info)
-
-            # Announce that redis is configured.
-            self.on.redis_available.emit()
+        if not self.configure():
+            # Done at the end of a later dispatch, once it can be.
+            self._charm.intents.add(intents.REDIS)
+
+    def configure(self) -> bool:
+        """
+        Configures redis from the first related unit that published
+        its hostname and port.
+        :return: False if that isn't possible yet.
+        """
+        if not os.path.isdir(NEXTCLOUD_CONFIG_DIR):
+            logger.info("Nextcloud not fetched yet, configuring redis later.")
+            return False
+        relation = self._charm.model.get_relation(self._relation_name)
+        if relation is None:
+            return True
+        for unit in sorted(relation.units, key=lambda u: u.name):
+            unit_data = relation.data[unit]
+            if unit_data.get('hostname') and unit_data.get('port'):
+                break
         else:
             logger.warning("REDIS INFO NOT AVAILABLE WHEN IT SHOULD.")
-            event.defer()
-            return
+            return False
+        redis_info = {
+            'redis_password': unit_data.get('password'),
+            'redis_hostname': unit_data.get('hostname'),
+            'redis_port': unit_data.get('port'),
+        }
+
+        # Configure redis
+        self.config_redis(redis_info)
+        self.config_redis_session(redis_info)
+
+        # Announce that redis is configured.
+        self.on.redis_available.emit()
+        return True
 
     def _on_relation_broken(self, event):
         """
@@ -94,59 +111,32 @@ class RedisClient(Object):
         Return the rendered config as text or emtpy string.
         """
         templates_path = Path(self._charm.charm_dir / 'templates')
+        target = Path(NEXTCLOUD_CONFIG_DIR, 'redis.config.php')
         if redis_info is None:
-            file_path = '/var/www/nextcloud/config/redis.config.php'
-            target = Path(file_path)
-            if target.exists():
-                target.unlink()
-            else:
-                pass
+            render.remove_file(target)
             return ""
-        else:
-            template = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(templates_path)
-            ).get_template(template)
-            target = Path('/var/www/nextcloud/config/redis.config.php')
-            rendered_content = template.render(redis_info)
-            target.write_text(rendered_content)
+        rendered_content = render.environment(templates_path).get_template(template).render(redis_info)
+        # Nextcloud reads its config on every request, no reload needed.
+        render.write_file(target, rendered_content)
         return rendered_content
 
     def config_redis_session(self, redis_info, template='redis_session.ini.j2'):
         """
         Puts redis session manager in place and enables the mod.
         Removes the file if redis_info = None.
+        Changes are recorded on self.changes.
 
         Returns the rendered config or empty string.
         """
         templates_path = Path(self._charm.charm_dir / 'templates')
+        phpversion = utils.get_phpversion()
+        target = Path(modstate.PHP_DIR, phpversion, 'mods-available', 'redis_session.ini')
         if redis_info is None:
-            target_72 = Path('/etc/php/7.2/mods-available/redis_session.ini')
-            target_74 = Path('/etc/php/7.4/mods-available/redis_session.ini')
-            target_81 = Path('/etc/php/8.1/mods-available/redis_session.ini')
-            if utils.get_phpversion() == "7.4":
-                if target_74.exists():
-                    target_74.unlink()
-            elif utils.get_phpversion() == "7.2":
-                if target_72.exists():
-                    target_72.unlink()
-            elif utils.get_phpversion() == "8.1":
-                if target_81.exists():
-                    target_81.unlink()
+            if render.remove_file(target):
+                self.changes.add(target, render.RELOAD)
             return ""
-        else:
-            template_env = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(templates_path)
-            )
-            template = template_env.get_template(template)
-            target_72 = Path('/etc/php/7.2/mods-available/redis_session.ini')
-            target_74 = Path('/etc/php/7.4/mods-available/redis_session.ini')
-            target_81 = Path('/etc/php/8.1/mods-available/redis_session.ini')
-            rendered_content = template.render(redis_info)
-            if utils.get_phpversion() == "7.4":
-                target_74.write_text(rendered_content)
-            elif utils.get_phpversion() == "7.2":
-                target_72.write_text(rendered_content)
-            elif utils.get_phpversion() == "8.1":
-                target_81.write_text(rendered_content)
-            sp.check_call(['phpenmod', 'redis_session'])
-            return rendered_content
+        rendered_content = render.environment(templates_path).get_template(template).render(redis_info)
+        if render.write_file(target, rendered_content):
+            self.changes.add(target, render.RELOAD)
+        modstate.ensure_php_module(phpversion, 'redis_session', self.changes)
+        return rendered_content
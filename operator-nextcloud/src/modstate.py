@@ -0,0 +1,107 @@
+"""
+Enable state of apache modules/sites and php modules.
+
+a2enmod, a2ensite and phpenmod only manage symlinks, so the state is
+read from the symlinks directly and the tools are only run to change it.
+"""
+import logging
+import re
+import subprocess as sp
+from pathlib import Path
+import render
+
+logger = logging.getLogger(__name__)
+
+APACHE_DIR = '/etc/apache2'
+PHP_DIR = '/etc/php'
+
+# Same default as phpenmod when an ini has no priority line.
+_DEFAULT_PHP_PRIORITY = '20'
+_PRIORITY_RE = re.compile(r'^\s*;\s*priority\s*=\s*(\d+)', re.MULTILINE)
+
+
+def apache_module_enabled(module) -> bool:
+    return Path(APACHE_DIR, 'mods-enabled', module + '.load').exists()
+
+
+def apache_site_enabled(site) -> bool:
+    return Path(APACHE_DIR, 'sites-enabled', site + '.conf').exists()
+
+
+def ensure_apache_modules(modules, changes=None) -> list:
+    """
+    Enables the modules that aren't enabled yet, in one a2enmod call.
+    Loading a new module needs an apache restart.
+    :return: list of modules that were enabled.
+    """
+    missing = [m for m in modules if not apache_module_enabled(m)]
+    if not missing:
+        return []
+    sp.call(['a2enmod', '-q'] + missing)
+    enabled = [m for m in missing if apache_module_enabled(m)]
+    if enabled:
+        logger.info("Enabled apache modules: " + ", ".join(enabled))
+    if set(missing) - set(enabled):
+        logger.error("Failed enabling apache modules: " + ", ".join(sorted(set(missing) - set(enabled))))
+    if changes is not None:
+        for module in enabled:
+            changes.add(Path(APACHE_DIR, 'mods-enabled', module + '.load'), render.RESTART)
+    return enabled
+
+
+def ensure_apache_site(site, enable=True, changes=None) -> bool:
+    """
+    Enables or disables an apache site if it isn't in that state already.
+    :return: True if the site was changed.
+    """
+    if apache_site_enabled(site) == enable:
+        return False
+    sp.check_call(['a2ensite' if enable else 'a2dissite', '-q', site])
+    if changes is not None:
+        changes.add(Path(APACHE_DIR, 'sites-enabled', site + '.conf'), render.RELOAD)
+    return True
+
+
+def _php_priority(phpversion, module) -> str:
+    try:
+        text = Path(PHP_DIR, phpversion, 'mods-available', module + '.ini').read_text()
+    except OSError:
+        return _DEFAULT_PHP_PRIORITY
+    match = _PRIORITY_RE.search(text)
+    return match.group(1) if match else _DEFAULT_PHP_PRIORITY
+
+
+def php_sapis(phpversion) -> list:
+    """
+    SAPIs of a php version, the directories phpenmod links into.
+    """
+    base = Path(PHP_DIR, phpversion)
+    if not base.is_dir():
+        return []
+    return sorted(p.name for p in base.iterdir() if Path(p, 'conf.d').is_dir())
+
+
+def php_module_enabled(phpversion, module) -> bool:
+    """
+    True if module is linked, with its current priority, into every SAPI.
+    """
+    sapis = php_sapis(phpversion)
+    if not sapis:
+        return False
+    link = _php_priority(phpversion, module) + '-' + module + '.ini'
+    return all(Path(PHP_DIR, phpversion, sapi, 'conf.d', link).exists() for sapi in sapis)
+
+
+def ensure_php_module(phpversion, module, changes=None) -> bool:
+    """
+    Runs phpenmod for module only if it isn't enabled for all SAPIs.
+    A newly enabled module is picked up by an apache reload.
+    :return: True if phpenmod was run.
+    """
+    if php_module_enabled(phpversion, module):
+        return False
+    sp.check_call(['phpenmod', '-v', phpversion, module])
+    logger.info(f"Enabled php {phpversion} module {module}")
+    if changes is not None:
+        changes.add(Path(PHP_DIR, phpversion, 'mods-available', module + '.ini'), render.RELOAD)
+    return True
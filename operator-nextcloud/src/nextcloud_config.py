@@ -0,0 +1,279 @@
+"""
+Access to the Nextcloud config.php without starting php.
+
+Parses the literal $CONFIG = array (...); structure that Nextcloud and
+this charm write, and merges the *.config.php overlays in the config
+directory on top of it the way Nextcloud does (natural sort order, top
+level keys replaced). Parsed files are cached for the lifetime of the
+hook and re-read when their mtime or size changes.
+
+Anything that isn't a plain literal (constants, function calls, string
+interpolation) raises ConfigPhpError, callers then fall back to occ.
+
+dump() writes a parsed config back in the var_export format Nextcloud
+uses itself.
+"""
+import copy
+import glob
+import os
+import re
+
+CONFIG_DIR = '/var/www/nextcloud/config'
+
+# path -> ((mtime_ns, size), text or parsed value)
+_texts = {}
+_parsed = {}
+
+
+class ConfigPhpError(Exception):
+    """Raised when a config file can't be parsed as literal php."""
+
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+|//[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<open_tag><\?php)
+  | (?P<close_tag>\?>)
+  | (?P<variable>\$[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<sq_string>'(?:[^'\\]|\\.)*')
+  | (?P<dq_string>"(?:[^"\\]|\\.)*")
+  | (?P<number>-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<arrow>=>)
+  | (?P<punct>[=;,()\[\]])
+  | (?P<word>[A-Za-z_\\][A-Za-z0-9_\\]*)
+""", re.VERBOSE | re.DOTALL)
+
+_DQ_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'v': '\v', 'f': '\f', 'e': '\x1b',
+               '0': '\0', '\\': '\\', '"': '"', '$': '$'}
+
+_INT_KEY_RE = re.compile(r'^(0|-?[1-9][0-9]*)$')
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN_RE.match(text, pos)
+        if not m:
+            raise ConfigPhpError(f"Unexpected input at offset {pos}: {text[pos:pos + 20]!r}")
+        pos = m.end()
+        if m.lastgroup not in ('space', 'open_tag', 'close_tag'):
+            tokens.append((m.lastgroup, m.group()))
+    return tokens
+
+
+def _unquote_single(token):
+    return re.sub(r"\\([\\'])", r'\1', token[1:-1])
+
+
+def _unquote_double(token):
+    body = token[1:-1]
+    if re.search(r'(?<!\\)(?:\\\\)*\$[A-Za-z_{]', body):
+        raise ConfigPhpError("String interpolation is not supported: " + token)
+    return re.sub(r'\\(.)', lambda m: _DQ_ESCAPES.get(m.group(1), m.group()), body)
+
+
+def _normalize_key(key):
+    """
+    Apply the php array key casts that matter for config files.
+    """
+    if isinstance(key, bool):
+        return int(key)
+    if isinstance(key, float):
+        return int(key)
+    if key is None:
+        return ''
+    if isinstance(key, str) and _INT_KEY_RE.match(key):
+        return int(key)
+    return key
+
+
+class _Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self, value=None):
+        kind, token = self.peek()
+        if kind is None or (value is not None and token.lower() != value):
+            raise ConfigPhpError(f"Expected {value or 'a token'}, got {token!r}")
+        self.pos += 1
+        return kind, token
+
+    def config(self):
+        kind, token = self.take()
+        if token != '$CONFIG':
+            raise ConfigPhpError("Only '$CONFIG = array (...);' is supported, got " + token)
+        self.take('=')
+        value = self.value()
+        self.take(';')
+        if self.peek()[0] is not None:
+            raise ConfigPhpError("Unexpected statement after $CONFIG: " + self.peek()[1])
+        if not isinstance(value, (dict, list)):
+            raise ConfigPhpError("$CONFIG is not an array")
+        return value
+
+    def value(self):
+        kind, token = self.take()
+        if kind == 'sq_string':
+            return _unquote_single(token)
+        if kind == 'dq_string':
+            return _unquote_double(token)
+        if kind == 'number':
+            if re.fullmatch(r'-?\d+', token):
+                return int(token)
+            return float(token)
+        if token == '[':
+            return self.array(']')
+        if kind == 'word':
+            word = token.lower()
+            if word == 'array':
+                self.take('(')
+                return self.array(')')
+            if word in ('true', 'false'):
+                return word == 'true'
+            if word == 'null':
+                return None
+        raise ConfigPhpError("Unsupported value: " + token)
+
+    def array(self, close):
+        items = {}
+        next_index = 0
+        while self.peek()[1] != close:
+            value = self.value()
+            if self.peek()[0] == 'arrow':
+                self.take()
+                key = _normalize_key(value)
+                value = self.value()
+            else:
+                key = next_index
+            items[key] = value
+            if isinstance(key, int) and key >= next_index:
+                next_index = key + 1
+            if self.peek()[1] == ',':
+                self.take()
+            elif self.peek()[1] != close:
+                raise ConfigPhpError("Expected ',' or '" + close + "', got " + str(self.peek()[1]))
+        self.take(close)
+        if list(items.keys()) == list(range(len(items))):
+            return list(items.values())
+        return items
+
+
+def parse(text) -> dict:
+    """
+    Parses the text of a config.php.
+    Arrays with keys 0..n-1 in order become lists, all others dicts.
+    """
+    value = _Parser(_tokenize(text)).config()
+    if isinstance(value, list):
+        return dict(enumerate(value))
+    return value
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def read_text(path) -> str:
+    """
+    Returns the raw content of path, cached until its mtime or size changes.
+    """
+    key = _stat_key(path)
+    cached = _texts.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(path) as f:
+        text = f.read()
+    _texts[path] = (key, text)
+    return text
+
+
+def read_file(path) -> dict:
+    """
+    Returns the parsed $CONFIG of one file, cached until its mtime or size changes.
+    """
+    key = _stat_key(path)
+    cached = _parsed.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    value = parse(read_text(path))
+    _parsed[path] = (key, value)
+    return value
+
+
+def _natural_key(path):
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', os.path.basename(path))]
+
+
+def config_files(config_dir=None) -> list:
+    """
+    Returns config.php followed by its overlays, in the order Nextcloud loads them.
+    """
+    config_dir = config_dir or CONFIG_DIR
+    overlays = sorted(glob.glob(os.path.join(config_dir, '*.config.php')), key=_natural_key)
+    return [os.path.join(config_dir, 'config.php')] + overlays
+
+
+def read_config(config_dir=None) -> dict:
+    """
+    Returns the merged system config, like Nextcloud sees it.
+    Raises FileNotFoundError without a config.php and ConfigPhpError
+    if any file can't be parsed.
+    """
+    merged = {}
+    for path in config_files(config_dir):
+        merged.update(read_file(path))
+    return merged
+
+
+def get_system_value(key, default=None, config_dir=None):
+    """
+    Returns a single system config value, or default if it isn't set.
+    The value is a copy, callers are free to modify it.
+    """
+    return copy.deepcopy(read_config(config_dir).get(key, default))
+
+
+def _export_scalar(value) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+    raise ConfigPhpError(f"Unsupported value: {value!r}")
+
+
+def _export(value, indent) -> str:
+    if not isinstance(value, (dict, list)):
+        return _export_scalar(value)
+    items = value.items() if isinstance(value, dict) else enumerate(value)
+    pad = ' ' * (indent + 2)
+    lines = ['array (']
+    for key, item in items:
+        key = _export_scalar(_normalize_key(key))
+        if isinstance(item, (dict, list)):
+            lines.append(f"{pad}{key} => \n{pad}{_export(item, indent + 2)},")
+        else:
+            lines.append(f"{pad}{key} => {_export_scalar(item)},")
+    lines.append(' ' * indent + ')')
+    return '\n'.join(lines)
+
+
+def dump(config) -> str:
+    """
+    Returns the text of a config.php with config, like Nextcloud writes it.
+    Keys that are integer strings, e.g. after a round trip through json,
+    are written as integers like php casts them.
+    """
+    return "<?php\n$CONFIG = " + _export(config, 0) + ";\n"
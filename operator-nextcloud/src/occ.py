@@ -1,25 +1,256 @@
 import subprocess as sp
 from subprocess import CompletedProcess
+import functools
 import logging
+import json
+import os
+import socket
 import sys
+import nextcloud_config
 
 logger = logging.getLogger(__name__)
 
+NEXTCLOUD_ROOT = '/var/www/nextcloud'
+OCC_WORKER_SOCKET = '/run/nextcloud-occ/occ.sock'
+
+# Bootstraps Nextcloud once and applies all queued system config changes
+# in a single write of config.php. A null value deletes the key.
+_BATCH_PHP = """
+define('OC_CONSOLE', 1);
+require_once '%s/lib/base.php';
+$changes = json_decode(stream_get_contents(STDIN), true);
+\\OC::$server->getSystemConfig()->setValues($changes);
+$results = [];
+foreach ($changes as $key => $value) {
+    $results[$key] = $value === null ? 'deleted' : 'set';
+}
+echo json_encode($results);
+""" % NEXTCLOUD_ROOT
+
+
+class OccWorker:
+    """
+    Client for the optional long lived occ worker (scripts/occ-worker).
+    The worker keeps Nextcloud bootstrapped and runs occ commands sent
+    over a unix socket, which saves a full php startup per command.
+    """
+    socket_path = OCC_WORKER_SOCKET
+    timeout = 600
+
+    @classmethod
+    def available(cls) -> bool:
+        return os.path.exists(cls.socket_path)
+
+    @classmethod
+    def request(cls, payload) -> dict:
+        """
+        Send one request to the worker.
+        :return: the reply as dict or None if the worker could not serve it.
+        """
+        if not cls.available():
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.settimeout(cls.timeout)
+                s.connect(cls.socket_path)
+                s.sendall((json.dumps(payload) + "\n").encode())
+                with s.makefile('r', encoding='utf-8') as f:
+                    reply = json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            logger.debug("occ worker not usable, spawning php instead: " + str(e))
+            return None
+        if reply.get('restart'):
+            logger.debug("occ worker is restarting, spawning php instead.")
+            return None
+        return reply
+
+    @classmethod
+    def run(cls, cmd) -> CompletedProcess:
+        """
+        Run an occ command line, given as list, on the worker.
+        :return: CompletedProcess or None if the worker could not serve it.
+        """
+        occ_index = next(i for i, arg in enumerate(cmd) if arg.endswith('occ'))
+        reply = cls.request({'argv': cmd[occ_index + 1:]})
+        if reply is None:
+            return None
+        return CompletedProcess(args=cmd, returncode=reply['returncode'],
+                                stdout=reply['stdout'], stderr='')
+
+
+def _run(cmd, use_worker=True) -> CompletedProcess:
+    """
+    Runs an occ command line on the occ worker when it is running,
+    otherwise spawns php for it.
+    """
+    if use_worker:
+        cp = OccWorker.run(cmd)
+        if cp is not None:
+            return cp
+    return sp.run(cmd, cwd=NEXTCLOUD_ROOT,
+                  stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+
+
+class HookCache:
+    """
+    Memoizes read-only occ results for the rest of the hook dispatch,
+    e.g. status which is needed several times by update-status.
+    Write operations through Occ invalidate the entries they affect.
+    """
+    _entries = {}
+
+    @classmethod
+    def cached(cls, key):
+        """
+        Decorator caching the result under key. Failed
+        CompletedProcess results are not cached.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if key in cls._entries:
+                    return cls._entries[key]
+                result = func(*args, **kwargs)
+                if not (isinstance(result, CompletedProcess) and result.returncode != 0):
+                    cls._entries[key] = result
+                return result
+            return wrapper
+        return decorator
+
+    @classmethod
+    def invalidates(cls, *keys):
+        """
+        Decorator dropping the cached keys, or all of them if none
+        are given, once the decorated write has run.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    cls.invalidate(*keys)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def invalidate(cls, *keys):
+        """
+        Drop the given keys from the cache, or everything without keys.
+        """
+        if not keys:
+            cls._entries.clear()
+        for key in keys:
+            cls._entries.pop(key, None)
+
+
+# System config keys that are part of the cached occ results.
+_CACHED_CONFIG_KEYS = {
+    'trusted_domains': 'trusted_domains',
+    'trusted_proxies': 'trusted_proxies',
+    'installed': 'status',
+    'maintenance': 'status',
+    'version': 'status',
+}
+
+
+class ConfigBatch:
+    """
+    Queues config:system set/delete operations and applies all of them
+    with one php process on flush(), instead of one occ call per key.
+    Values are top level config.php keys, lists are written as a whole.
+    """
+
+    def __init__(self):
+        self._changes = {}
+
+    def __len__(self):
+        return len(self._changes)
+
+    def set(self, key, value):
+        """
+        Queue setting a system config key to value.
+        """
+        self._changes[key] = value
+        return self
+
+    def delete(self, key):
+        """
+        Queue removal of a system config key.
+        """
+        self._changes[key] = None
+        return self
+
+    @property
+    def changes(self) -> dict:
+        """
+        The queued changes, None values are deletes.
+        """
+        return dict(self._changes)
+
+    def discard(self, key):
+        """
+        Drop a queued change.
+        """
+        self._changes.pop(key, None)
+        return self
+
+    def flush(self) -> dict:
+        """
+        Apply all queued changes in one go.
+        :return: dict with 'set', 'deleted' or 'failed' for each key.
+        """
+        changes, self._changes = self._changes, {}
+        if not changes:
+            return {}
+        affected = {_CACHED_CONFIG_KEYS[k] for k in changes if k in _CACHED_CONFIG_KEYS}
+        if affected:
+            HookCache.invalidate(*affected)
+        reply = OccWorker.request({'system_config': changes})
+        if reply is not None:
+            cp = CompletedProcess(args=[], returncode=reply['returncode'],
+                                  stdout=reply['stdout'], stderr=reply['stdout'])
+            return self._results(changes, cp)
+        cmd = ['sudo', '-u', 'www-data', 'php', '-r', _BATCH_PHP]
+        cp = sp.run(cmd, cwd=NEXTCLOUD_ROOT, input=json.dumps(changes),
+                    stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return self._results(changes, cp)
+
+    @staticmethod
+    def _results(changes, cp) -> dict:
+        results = dict.fromkeys(changes, 'failed')
+        if cp.returncode == 0:
+            try:
+                results.update(json.loads(cp.stdout))
+            except ValueError:
+                logger.error("Unexpected output from config batch: " + cp.stdout)
+        else:
+            logger.error("Failed applying config batch: " + cp.stderr)
+        return results
+
 
 class Occ:
 
     @staticmethod
+    def config_system_batch() -> ConfigBatch:
+        """
+        Returns an empty ConfigBatch to queue system config changes on.
+        """
+        return ConfigBatch()
+
+    @staticmethod
+    @HookCache.invalidates('trusted_proxies')
     def delete_trusted_proxies() -> CompletedProcess:
         """
-        Removes all trusted_proxies from config via occ.
+        Removes all trusted_proxies from config via occ by setting an empty value.
         """
         cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
                " trusted_proxies "
-               " --value=''")
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+               " --value=")
+        return _run(cmd.split())
 
     @staticmethod
+    @HookCache.invalidates('trusted_proxies')
     def set_trusted_proxy(host, index) -> CompletedProcess:
         """
         Sets a trusted proxy on the given index.
@@ -30,10 +261,10 @@ class Occ:
         cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
                " trusted_proxies {index}"
                " --value={host} ").format(index=index, host=host)
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
+    @HookCache.invalidates('trusted_domains')
     def config_system_set_trusted_domains(domain, index) -> CompletedProcess:
         """
         Adds a trusted domain to nextcloud config.php with occ
@@ -42,8 +273,7 @@ class Occ:
         cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
                " trusted_domains {index}"
                " --value={domain} ").format(index=index, domain=domain)
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
     def remove_trusted_domain(domain):
@@ -53,64 +283,122 @@ class Occ:
         current_domains = Occ.config_system_get_trusted_domains()
         if domain in current_domains:
             current_domains.remove(domain)
-            # First delete all trusted domains from config.php
-            # since they might have indices not in order.
-            Occ.config_system_delete_trusted_domains()
+            # Write the remaining domains as a whole so the
+            # indices are in order starting from 0.
+            batch = Occ.config_system_batch()
             if current_domains:
-                # Now, add all the domains with indices in order starting from 0
-                for index, domain in enumerate(current_domains):
-                    Occ.config_system_set_trusted_domains(domain, index)
+                batch.set('trusted_domains', current_domains)
+            else:
+                batch.delete('trusted_domains')
+            batch.flush()
 
     @staticmethod
+    @HookCache.invalidates('trusted_domains')
     def config_system_delete_trusted_domains() -> CompletedProcess:
         cmd = "sudo -u www-data php /var/www/nextcloud/occ \
                                   config:system:delete trusted_domains"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
-    def config_system_get_trusted_domains() -> CompletedProcess:
+    def config_system_get_trusted_domains() -> list:
         """
-        Get all current trusted domains in config.php with occ
+        Get all current trusted domains in config.php.
+        Read directly from config.php, occ is only used if that fails.
         return list
         """
+        try:
+            domains = nextcloud_config.get_system_value('trusted_domains', [])
+            return list(domains.values()) if isinstance(domains, dict) else list(domains)
+        except (OSError, nextcloud_config.ConfigPhpError) as e:
+            logger.debug("Reading trusted_domains with occ: " + str(e))
+        return Occ._occ_trusted_domains()
+
+    @staticmethod
+    @HookCache.cached('trusted_domains')
+    def _occ_trusted_domains() -> list:
         cmd = "sudo -u www-data php /var/www/nextcloud/occ \
                            config:system:get trusted_domains"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
-        # domains = output.stdout.split()
+        return _run(cmd.split()).stdout.split()
 
     @staticmethod
-    def update_trusted_domains_peer_ips(domains):
-        current_domains = Occ.config_system_get_trusted_domains().stdout.split()
+    def config_system_get_trusted_proxies():
+        """
+        Get the trusted_proxies in config.php, as the json occ would print.
+        Read directly from config.php, occ is only used if that fails.
+        """
+        try:
+            proxies = nextcloud_config.get_system_value('trusted_proxies', dict())
+            # Match the json occ prints, where object keys are strings.
+            if isinstance(proxies, dict):
+                return {str(k): v for k, v in proxies.items()}
+            return proxies
+        except (OSError, nextcloud_config.ConfigPhpError) as e:
+            logger.debug("Reading trusted_proxies with occ: " + str(e))
+        return Occ._occ_trusted_proxies()
+
+    @staticmethod
+    @HookCache.cached('trusted_proxies')
+    def _occ_trusted_proxies():
+        cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:get trusted_proxies --output=json")
+        s = _run(cmd.split())
+        # Load an empty dict into json if no trusted proxy exists.
+        if s.stdout == '':
+            return json.loads(str(dict()))
+        return json.loads(s.stdout)
+
+    @staticmethod
+    def config_system_get(key) -> CompletedProcess:
+        """
+        Get a single system config value from config.php with occ
+        """
+        cmd = f"sudo -u www-data php /var/www/nextcloud/occ config:system:get {key}"
+        return _run(cmd.split())
+
+    @staticmethod
+    def update_trusted_domains_peer_ips(domains, batch=None):
+        """
+        Replaces the peer IP:s in trusted_domains.
+        If a ConfigBatch is given the change is queued on it instead.
+        """
+        current_domains = Occ.config_system_get_trusted_domains()
         # Copy 'localhost' and fqdn but replace all peers IP:s
         # with the ones currently available in the relation.
         new_domains = current_domains[0:2] + domains[:]
-        Occ.config_system_delete_trusted_domains()
-        for index, d in enumerate(new_domains):
-            Occ.config_system_set_trusted_domains(d, index)
+        if batch is not None:
+            batch.set('trusted_domains', new_domains)
+            return None
+        return Occ.config_system_batch().set('trusted_domains', new_domains).flush()
 
     @staticmethod
     def db_add_missing_indices() -> CompletedProcess:
         cmd = "sudo -u www-data php /var/www/nextcloud/occ db:add-missing-indices"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
     def db_convert_filecache_bigint() -> CompletedProcess:
         cmd = "sudo -u www-data php /var/www/nextcloud/occ \
                db:convert-filecache-bigint --no-interaction"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
+    @HookCache.invalidates('status')
     def maintenance_mode(enable) -> CompletedProcess:
         m = "--on" if enable else "--off"
         cmd = f"sudo -u www-data php /var/www/nextcloud/occ maintenance:mode {m}"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
+    @HookCache.invalidates()
+    def upgrade() -> CompletedProcess:
+        """
+        Runs the database and app migrations of newly switched in code.
+        Never on the occ worker, it has the old code loaded.
+        """
+        cmd = "sudo -u www-data php /var/www/nextcloud/occ upgrade --no-interaction"
+        return _run(cmd.split(), use_worker=False)
+
+    @staticmethod
+    @HookCache.invalidates()
     def maintenance_install(ctx) -> CompletedProcess:
         """
         Initializes nextcloud via the nextcloud occ interface.
@@ -122,8 +410,7 @@ class Occ:
                "--database-user {dbuser} --admin-user {adminusername} "
                "--admin-pass {adminpassword} "
                "--data-dir {datadir} ").format(**ctx)
-        cp = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                    stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cp = _run(cmd.split(), use_worker=False)
 
         # Remove potential passwords from reaching the log.
         cp.args[13] = '*********'
@@ -138,33 +425,38 @@ class Occ:
         return cp
 
     @staticmethod
+    @HookCache.cached('status')
     def status() -> CompletedProcess:
         """
         Returns CompletedProcess with nextcloud status in .stdout as json.
+        The result is cached for the rest of the hook.
         """
         cmd = "sudo -u www-data /usr/bin/php occ status --output=json --no-warnings"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
-    def overwriteprotocol(protocol='http') -> CompletedProcess:
+    def overwriteprotocol(protocol='http', batch=None) -> CompletedProcess:
         """
         Sets the overwrite protocol with occ
+        If a ConfigBatch is given the change is queued on it instead.
         :return:
         """
         if protocol == "http" or protocol == "https":
             logger.info("Setting overwriteprotocol to: " + protocol)
+            if batch is not None:
+                batch.set('overwriteprotocol', protocol)
+                return None
             cmd = ("sudo -u www-data /usr/bin/php occ config:system:set overwriteprotocol --value=" + protocol)
-            return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                          stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+            return _run(cmd.split())
         else:
             logger.error("Unsupported overwriteprotocol provided as config: " + protocol)
             sys.exit(-1)
 
     @staticmethod
-    def defaultPhoneRegion(regionCode) -> CompletedProcess:
+    def defaultPhoneRegion(regionCode, batch=None) -> CompletedProcess:
         """
         Sets the default_phone_region with occ
+        If a ConfigBatch is given the change is queued on it instead.
         :return:
         """
         valid_codes = ['AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AQ', 'AR', 'AS', 'AT', 'AU', 'AW', 'AX', 'AZ', 'BA', 'BB',
@@ -183,9 +475,11 @@ class Occ:
         'UZ', 'VA', 'VC', 'VE', 'VG', 'VI', 'VN', 'VU', 'WF', 'WS', 'YE', 'YT', 'ZA', 'ZM', 'ZW']
         if regionCode in valid_codes:
             logger.info("Setting default_phone_region to: " + regionCode)
+            if batch is not None:
+                batch.set('default_phone_region', regionCode)
+                return None
             cmd = ("sudo -u www-data /usr/bin/php occ config:system:set default_phone_region --value=" + regionCode)
-            return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                          stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+            return _run(cmd.split())
         else:
             logger.error("Unsupported phone region code provided as config: " + regionCode)
             sys.exit(-1)
@@ -196,8 +490,7 @@ class Occ:
         Sets the background job scheulder to cron
         """
         cmd = "sudo -u www-data /usr/bin/php occ background:cron --no-warnings"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
     def setRewriteBase() -> CompletedProcess:
@@ -207,8 +500,7 @@ class Occ:
         updateHtaccess() must run for this to have effect.
         """
         cmd = "sudo -u www-data php occ config:system:set htaccess.RewriteBase --value='/'"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
     def updateHtaccess() -> CompletedProcess:
@@ -216,24 +508,29 @@ class Occ:
         Updates the .htaccess file. Needed for some settings to have effect, e.g. setRewriteBase().
         """
         cmd = "sudo -u www-data php occ maintenance:update:htaccess"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
-    def overwriteCliUrl(url) -> CompletedProcess:
+    def overwriteCliUrl(url, batch=None) -> CompletedProcess:
         """
         Specify the base URL for any URLs which are generated within Nextcloud using any kind of command
         line tools (cron or occ). The value should contain the full base URL: https://nextcloud.dwellir.com
+        If a ConfigBatch is given the change is queued on it instead.
         """
+        if batch is not None:
+            batch.set('overwrite.cli.url', url)
+            return None
         cmd = f"sudo -u www-data php occ config:system:set overwrite.cli.url --value={url}"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
 
     @staticmethod
-    def setDebug(onoff: bool) -> CompletedProcess:
+    def setDebug(onoff: bool, batch=None) -> CompletedProcess:
         """
         Set the debug flag in config.php
+        If a ConfigBatch is given the change is queued on it instead.
         """
+        if batch is not None:
+            batch.set('debug', bool(onoff))
+            return None
         cmd = f"sudo -u www-data php occ config:system:set debug --type=boolean --value={onoff}"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return _run(cmd.split())
@@ -0,0 +1,168 @@
+"""
+Ownership and mode fixer for the nextcloud trees.
+
+Replaces chown -R: the tree is walked with os.scandir on a thread pool,
+which keeps many stat calls in flight on NFS, and only entries with the
+wrong owner, or without owner read/write access, are changed. Excluded
+paths, like a datadir, are not descended into.
+
+A fingerprint of a tree, the ctime of its root and direct children,
+lets callers skip walks when nothing was extracted or replaced in it
+since the last walk.
+"""
+import hashlib
+import logging
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+# Owner access every entry needs, directories also need to be searchable.
+_FILE_BITS = stat.S_IRUSR | stat.S_IWUSR
+_DIR_BITS = stat.S_IRWXU
+
+
+class Report:
+    """
+    What a walk looked at and changed.
+    """
+
+    def __init__(self):
+        self.scanned = 0
+        self.chowned = 0
+        self.chmodded = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, scanned=0, chowned=0, chmodded=0, errors=0):
+        with self._lock:
+            self.scanned += scanned
+            self.chowned += chowned
+            self.chmodded += chmodded
+            self.errors += errors
+
+    def __str__(self):
+        return (f"scanned {self.scanned}, chowned {self.chowned}, chmodded {self.chmodded}, "
+                f"errors {self.errors} in {self.seconds:.2f}s")
+
+
+def _fix(path, st, uid, gid) -> tuple:
+    """
+    Fixes one entry from its lstat result.
+    :return: (chowned, chmodded)
+    """
+    chowned = chmodded = 0
+    if st.st_uid != uid or st.st_gid != gid:
+        os.lchown(path, uid, gid)
+        chowned = 1
+    if not stat.S_ISLNK(st.st_mode):
+        bits = _DIR_BITS if stat.S_ISDIR(st.st_mode) else _FILE_BITS
+        if st.st_mode & bits != bits:
+            os.chmod(path, stat.S_IMODE(st.st_mode) | bits)
+            chmodded = 1
+    return chowned, chmodded
+
+
+def _scan(directory, uid, gid, excluded, report) -> list:
+    """
+    Fixes the entries of one directory.
+    :return: the subdirectories to walk.
+    """
+    subdirs = []
+    scanned = chowned = chmodded = errors = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    c, m = _fix(entry.path, st, uid, gid)
+                    chowned += c
+                    chmodded += m
+                    scanned += 1
+                    if stat.S_ISDIR(st.st_mode) and entry.path not in excluded:
+                        subdirs.append(entry.path)
+                except FileNotFoundError:
+                    # Removed while walking.
+                    pass
+                except OSError as e:
+                    logger.warning(f"Unable to fix {entry.path}: {e}")
+                    errors += 1
+    except OSError as e:
+        logger.warning(f"Unable to scan {directory}: {e}")
+        errors += 1
+    report.add(scanned, chowned, chmodded, errors)
+    return subdirs
+
+
+def fix_tree(root, uid, gid, exclude=(), workers=None) -> Report:
+    """
+    Gives root and everything below it, except exclude, to uid:gid.
+    """
+    report = Report()
+    started = time.monotonic()
+    root = os.path.abspath(root)
+    excluded = {os.path.abspath(p).rstrip('/') for p in exclude}
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+    report.add(*_fix_paths([root], uid, gid))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan, root, uid, gid, excluded, report)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    pending.add(pool.submit(_scan, subdir, uid, gid, excluded, report))
+    report.seconds = time.monotonic() - started
+    return report
+
+
+def _fix_paths(paths, uid, gid) -> tuple:
+    scanned = chowned = chmodded = errors = 0
+    for path in paths:
+        try:
+            c, m = _fix(path, os.lstat(path), uid, gid)
+            scanned += 1
+            chowned += c
+            chmodded += m
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Unable to fix {path}: {e}")
+            errors += 1
+    return scanned, chowned, chmodded, errors
+
+
+def fix_paths(paths, uid, gid) -> Report:
+    """
+    Fixes only the given paths, e.g. files the charm just wrote.
+    """
+    report = Report()
+    started = time.monotonic()
+    report.add(*_fix_paths(paths, uid, gid))
+    report.seconds = time.monotonic() - started
+    return report
+
+
+def fingerprint(root, exclude=()) -> str:
+    """
+    Fingerprint of root and its direct children. Extracting, replacing
+    or chowning any of them changes their ctime, and so the fingerprint.
+    None if root doesn't exist.
+    """
+    excluded = {os.path.abspath(p).rstrip('/') for p in exclude}
+    h = hashlib.sha256()
+    try:
+        st = os.lstat(root)
+        h.update(f"{st.st_ino}:{st.st_ctime_ns}:{st.st_uid}:{st.st_gid}".encode())
+        with os.scandir(root) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.path in excluded:
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                h.update(f"{entry.name}:{st.st_ino}:{st.st_ctime_ns}:{st.st_uid}:{st.st_gid}".encode())
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
@@ -0,0 +1,246 @@
+"""
+Per handler profiling of charm hooks.
+
+The profiled class decorator wraps every _on_* handler of a charm. Under
+juju each outermost handler call appends one JSON line to PROFILE_FILE:
+wall time, cpu time and output blocks (getrusage of the charm and its
+children), and the subprocesses spawned meanwhile, counted per command
+class, e.g. "occ maintenance:mode" or "systemctl". subprocess.Popen is
+replaced by a subclass that times every process from spawn to reap,
+which covers run, call and check_call in Occ and utils alike, and
+os.system by a wrapper that times the shell.
+
+blocks_out is ru_oublock: the blocks the filesystem wrote out for the
+hook, not the bytes it wrote. Writes still in the page cache when the
+hook ends don't count, so it shows the block I/O of a handler, e.g. a
+tar extraction or a sync, not every small config write.
+
+The file rolls over to PROFILE_FILE.1 at MAX_BYTES. summarize() gives
+the percentiles per handler for the hook-profile action.
+"""
+import functools
+import json
+import logging
+import os
+import resource
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = '/var/log/nextcloud-charm'
+PROFILE_FILE = 'hook-profile.jsonl'
+MAX_BYTES = 4 * 1024 * 1024
+
+_state = threading.local()
+_OriginalPopen = subprocess.Popen
+_original_system = os.system
+
+
+def enabled() -> bool:
+    """
+    Profiles are only written when running under juju.
+    """
+    return 'JUJU_UNIT_NAME' in os.environ and os.environ.get('NEXTCLOUD_CHARM_PROFILE', '1') != '0'
+
+
+def command_class(args) -> str:
+    """
+    Short class of a command line: the program, for occ its subcommand.
+    """
+    if isinstance(args, (str, bytes)):
+        args = os.fsdecode(args).split()
+    args = [os.fsdecode(a) for a in args]
+    while args and (args[0] == 'sudo' or '=' in args[0] or args[0].startswith('-')):
+        # sudo -u www-data, FOO=bar
+        args = args[2:] if args[0] == '-u' else args[1:]
+    for i, arg in enumerate(args):
+        if os.path.basename(arg) == 'occ':
+            sub = next((a for a in args[i + 1:] if not a.startswith('-')), '')
+            return f"occ {sub}".strip()
+    return os.path.basename(args[0]) if args else '?'
+
+
+class ProfiledPopen(_OriginalPopen):
+    """
+    Popen that reports its command class and lifetime to the running profile.
+    """
+
+    def __init__(self, args, *a, **kw):
+        self._profile_started = time.monotonic()
+        self._profile_class = command_class(args)
+        self._profile_done = False
+        super().__init__(args, *a, **kw)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if not self._profile_done:
+            self._profile_done = True
+            _record_command(self._profile_class, time.monotonic() - self._profile_started)
+        return returncode
+
+
+def _record_command(cls, seconds):
+    profile = getattr(_state, 'profile', None)
+    if profile is None:
+        return
+    entry = profile['commands'].setdefault(cls, {'count': 0, 'seconds': 0.0})
+    entry['count'] += 1
+    entry['seconds'] += seconds
+
+
+def _system(command):
+    started = time.monotonic()
+    try:
+        return _original_system(command)
+    finally:
+        _record_command(command_class(command), time.monotonic() - started)
+
+
+def install():
+    """
+    Puts ProfiledPopen and the os.system wrapper in place, once.
+    """
+    if subprocess.Popen is not ProfiledPopen:
+        subprocess.Popen = ProfiledPopen
+    if os.system is not _system:
+        os.system = _system
+
+
+def _usage() -> tuple:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime,
+            own.ru_oublock + children.ru_oublock)
+
+
+def _hook_name() -> str:
+    dispatched = os.path.basename(os.environ.get('JUJU_DISPATCH_PATH', ''))
+    return os.environ.get('JUJU_ACTION_NAME') or os.environ.get('JUJU_HOOK_NAME') or dispatched or '?'
+
+
+def write(record, profile_dir=None):
+    """
+    Appends one record, rolling the file over at MAX_BYTES.
+    """
+    path = Path(profile_dir or PROFILE_DIR, PROFILE_FILE)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists() and path.stat().st_size > MAX_BYTES:
+            os.replace(path, f"{path}.1")
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    except OSError as e:
+        logger.debug(f"Unable to write hook profile: {e}")
+
+
+def _profile(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_state, 'profile', None) is not None or not enabled():
+            # Nested handlers count towards the outermost one.
+            return func(*args, **kwargs)
+        profile = _state.profile = {'commands': {}}
+        utime, stime, blocks = _usage()
+        started = time.monotonic()
+        error = None
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _state.profile = None
+            end_utime, end_stime, end_blocks = _usage()
+            commands = profile['commands']
+            write({'ts': round(time.time(), 3),
+                   'hook': _hook_name(),
+                   'handler': func.__name__,
+                   'wall': round(time.monotonic() - started, 4),
+                   'user': round(end_utime - utime, 4),
+                   'system': round(end_stime - stime, 4),
+                   'blocks_out': end_blocks - blocks,
+                   'subprocesses': sum(c['count'] for c in commands.values()),
+                   'subprocess_seconds': round(sum(c['seconds'] for c in commands.values()), 4),
+                   'commands': commands,
+                   'error': error})
+    return wrapper
+
+
+def profiled(cls):
+    """
+    Class decorator profiling every _on_* handler of cls.
+    """
+    if enabled():
+        install()
+    for name, value in list(vars(cls).items()):
+        if name.startswith('_on_') and callable(value):
+            setattr(cls, name, _profile(value))
+    return cls
+
+
+def read(profile_dir=None) -> list:
+    """
+    All records, oldest first.
+    """
+    path = Path(profile_dir or PROFILE_DIR, PROFILE_FILE)
+    records = []
+    for p in [Path(f"{path}.1"), path]:
+        try:
+            with open(p) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A line cut off by a killed hook.
+                        continue
+        except FileNotFoundError:
+            continue
+    return records
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of values, None if there are none.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def summarize(records, handler=None) -> dict:
+    """
+    Percentiles of wall time, subprocesses and output blocks per handler,
+    and the command classes that took the most time.
+    """
+    by_handler = {}
+    for record in records:
+        if handler and record['handler'] != handler:
+            continue
+        by_handler.setdefault(record['handler'], []).append(record)
+    summary = {}
+    for name, rs in sorted(by_handler.items()):
+        walls = [r['wall'] for r in rs]
+        commands = {}
+        for r in rs:
+            for cls, c in r['commands'].items():
+                commands[cls] = commands.get(cls, 0.0) + c['seconds']
+        slowest = sorted(commands.items(), key=lambda c: -c[1])[:5]
+        summary[name] = {
+            'count': len(rs),
+            'errors': sum(1 for r in rs if r.get('error')),
+            'wall-p50': percentile(walls, 50),
+            'wall-p90': percentile(walls, 90),
+            'wall-p99': percentile(walls, 99),
+            'wall-max': max(walls),
+            'subprocesses-p50': percentile([r['subprocesses'] for r in rs], 50),
+            'subprocesses-p90': percentile([r['subprocesses'] for r in rs], 90),
+            'blocks-out-p50': percentile([r['blocks_out'] for r in rs], 50),
+            'blocks-out-p90': percentile([r['blocks_out'] for r in rs], 90),
+            'slowest-commands': ", ".join(f"{cls} {seconds:.2f}s" for cls, seconds in slowest),
+        }
+    return summary
@@ -0,0 +1,70 @@
+"""
+Desired state reconciliation of the Nextcloud system config.
+
+The charm queues the desired value of every key it manages on a
+ConfigBatch, the reconciler reads the current config.php once, drops
+the keys that already have their desired value and applies the rest
+as a single batch.
+"""
+import logging
+import nextcloud_config
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class SystemConfigReconciler:
+    """
+    Applies only the changed keys of a desired system config.
+    """
+
+    def __init__(self, config_dir=None):
+        self._config_dir = config_dir
+
+    def current(self) -> dict:
+        """
+        Current system config in one read of config.php and its overlays.
+        Returns None if it can't be read, then every key counts as changed.
+        """
+        try:
+            return nextcloud_config.read_config(self._config_dir)
+        except (OSError, nextcloud_config.ConfigPhpError) as e:
+            logger.warning("Unable to read current config, applying all keys: " + str(e))
+            return None
+
+    def diff(self, desired) -> dict:
+        """
+        Returns {key: (current, desired)} for the keys that differ.
+        Desired None means the key should not exist.
+        """
+        current = self.current()
+        changes = {}
+        for key, value in desired.items():
+            if current is None:
+                changes[key] = (None, value)
+                continue
+            old = current.get(key, _MISSING)
+            if value is None:
+                if old is not _MISSING:
+                    changes[key] = (old, None)
+            elif old != value:
+                changes[key] = (None if old is _MISSING else old, value)
+        return changes
+
+    def reconcile(self, batch) -> dict:
+        """
+        Flushes the keys of batch that differ from config.php, skips the rest.
+        Logs what was changed.
+        :return: dict with the flush result for each changed key.
+        """
+        changes = self.diff(batch.changes)
+        for key in set(batch.changes) - set(changes):
+            batch.discard(key)
+        if not changes:
+            logger.info("System config already up to date, nothing to apply.")
+            return {}
+        results = batch.flush()
+        for key, (old, new) in changes.items():
+            logger.info(f"System config {key}: {old!r} -> {new!r} ({results.get(key)})")
+        return results
@@ -0,0 +1,241 @@
+"""
+Versioned nextcloud code releases with an atomic switch.
+
+Every release is extracted to RELEASES_DIR/<version> while the live one
+keeps serving. LIVE (/var/www/nextcloud) is a symlink to the current
+release and is switched with a rename, so the code changes at once and
+rolling back is flipping it back to the previous release, which is
+remembered in RELEASES_DIR/.previous.
+
+What a release doesn't ship is carried over from the current one:
+config/*.php, apps that aren't part of the new release and the data
+dir. A data dir inside a release is moved out to SHARED_DIR once and
+symlinked from every release.
+"""
+import logging
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+LIVE = '/var/www/nextcloud'
+RELEASES_DIR = '/var/www/nextcloud-releases'
+SHARED_DIR = '/var/www/nextcloud-shared'
+
+# Dirs nextcloud keeps apps in, the second one is where the app store installs to.
+APP_DIRS = ['apps', 'custom_apps']
+
+_VERSION = re.compile(r"\$OC_VersionString\s*=\s*'([^']+)'")
+
+
+class ReleaseError(Exception):
+    pass
+
+
+def read_version(root) -> str:
+    """
+    The version string of the nextcloud code in root, from its version.php.
+    """
+    try:
+        match = _VERSION.search(Path(root, 'version.php').read_text())
+    except OSError as e:
+        raise ReleaseError(f"No nextcloud release in {root}: {e}")
+    if not match:
+        raise ReleaseError(f"No version in {root}/version.php")
+    return match.group(1)
+
+
+def release_path(version) -> Path:
+    return Path(RELEASES_DIR, version)
+
+
+def releases() -> list:
+    """
+    Versions of the extracted releases.
+    """
+    try:
+        return sorted(e.name for e in os.scandir(RELEASES_DIR)
+                      if e.is_dir(follow_symlinks=False) and not e.name.startswith('.'))
+    except FileNotFoundError:
+        return []
+
+
+def _target(link) -> str:
+    """
+    Version a release symlink points to, None if there is none.
+    """
+    try:
+        return os.path.basename(os.readlink(link))
+    except OSError:
+        return None
+
+
+def current() -> str:
+    return _target(LIVE)
+
+
+def previous() -> str:
+    return _target(Path(RELEASES_DIR, '.previous'))
+
+
+def _symlink(target, link):
+    """
+    Points link to target with a rename, which is atomic.
+    """
+    tmp = f"{link}.tmp"
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+
+
+def _share_data(release):
+    """
+    Moves a data dir inside release out to SHARED_DIR and links it back.
+    """
+    data = Path(release, 'data')
+    if data.is_symlink() or not data.is_dir():
+        return
+    shared = Path(SHARED_DIR, 'data')
+    if shared.exists():
+        raise ReleaseError(f"{data} and {shared} both exist, not moving the data dir.")
+    shared.parent.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Moving data dir {data} to {shared}")
+    shutil.move(str(data), str(shared))
+    os.symlink(shared, data)
+
+
+def adopt():
+    """
+    Turns a nextcloud extracted to LIVE into the first release.
+    Nothing to do if LIVE already is a release link or doesn't exist.
+    """
+    if os.path.islink(LIVE) or not os.path.isdir(LIVE):
+        return
+    version = read_version(LIVE)
+    release = release_path(version)
+    if release.exists():
+        raise ReleaseError(f"{LIVE} is a directory, but release {version} exists.")
+    release.parent.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Adopting {LIVE} as release {version}")
+    os.rename(LIVE, release)
+    os.symlink(release, LIVE)
+    _share_data(release)
+
+
+def prepare(extract, version=None) -> str:
+    """
+    Extracts a release next to the live one.
+    extract is called with a staging dir and has to put the nextcloud
+    dir of the tarball in there, like extracting to /var/www/ does.
+    If the release is the live one already, as when an install is
+    retried after its switch, the extracted copy is thrown away.
+    :return: the version of the extracted release.
+    """
+    Path(RELEASES_DIR).mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(dir=RELEASES_DIR, prefix='.staging-'))
+    try:
+        extract(staging)
+        root = Path(staging, 'nextcloud')
+        found = read_version(root)
+        if version and found != version:
+            raise ReleaseError(f"Expected nextcloud {version}, the archive has {found}")
+        if not Path(root, 'occ').is_file():
+            raise ReleaseError(f"Release {found} has no occ")
+        release = release_path(found)
+        if release.exists():
+            if found == current():
+                logger.info(f"Release {found} is live already, keeping it")
+                return found
+            shutil.rmtree(release)
+        os.rename(root, release)
+        logger.info(f"Prepared release {found} in {release}")
+        return found
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def carry_over(version, source=None):
+    """
+    Copies config and apps the release doesn't ship, and links the data
+    dir, from the source release, by default the live one.
+    """
+    source = source or current()
+    release = release_path(version)
+    if not source or source == version:
+        return
+    old = release_path(source)
+    _share_data(old)
+    carry_over_config(version, source)
+    for app_dir in APP_DIRS:
+        if not Path(old, app_dir).is_dir():
+            continue
+        Path(release, app_dir).mkdir(exist_ok=True)
+        for app in os.scandir(Path(old, app_dir)):
+            target = Path(release, app_dir, app.name)
+            if app.is_dir(follow_symlinks=False) and not target.exists():
+                shutil.copytree(app.path, target, symlinks=True)
+    data = Path(old, 'data')
+    if data.is_symlink() and not os.path.lexists(Path(release, 'data')):
+        os.symlink(os.readlink(data), Path(release, 'data'))
+
+
+def carry_over_config(version, source=None):
+    """
+    Copies config/*.php, except the sample, from the source release.
+    """
+    source = source or current()
+    if not source or source == version:
+        return
+    for conf in release_path(source).joinpath('config').glob('*.php'):
+        if conf.name != 'config.sample.php':
+            shutil.copy2(conf, Path(release_path(version), 'config', conf.name))
+
+
+def switch(version):
+    """
+    Makes version the live release and remembers the one it replaces.
+    """
+    release = release_path(version)
+    if not release.is_dir():
+        raise ReleaseError(f"No release {version} in {RELEASES_DIR}")
+    live = current()
+    if live == version:
+        return
+    if live:
+        _symlink(release_path(live), Path(RELEASES_DIR, '.previous'))
+    _symlink(release, LIVE)
+    logger.info(f"Switched {LIVE} from {live} to {version}")
+
+
+def rollback() -> str:
+    """
+    Switches back to the previous release.
+    :return: the version now live.
+    """
+    version = previous()
+    if not version or not release_path(version).is_dir():
+        raise ReleaseError("No previous release to roll back to.")
+    switch(version)
+    return version
+
+
+def prune(keep=2) -> list:
+    """
+    Removes all but the keep newest releases, never the current or
+    previous one.
+    :return: the removed versions.
+    """
+    def key(version):
+        return [int(p) if p.isdigit() else 0 for p in version.split('.')]
+
+    protected = {current(), previous()}
+    candidates = sorted(releases(), key=key)[:-keep] if keep else releases()
+    removed = [v for v in candidates if v not in protected]
+    for version in removed:
+        shutil.rmtree(release_path(version))
+        logger.info(f"Removed release {version}")
+    return removed
@@ -0,0 +1,151 @@
+"""
+Shared render pipeline for the files this charm writes.
+
+Templates are rendered with one cached jinja2 Environment per templates
+directory. Targets are only written when their content hash changes,
+atomically and keeping owner and mode of the file they replace. Every
+write is recorded in a ChangeSet, which decides if the service using the
+files needs nothing, a graceful reload or a full restart.
+
+jinja2 is only imported once a template is rendered, most hooks don't.
+"""
+import hashlib
+import logging
+import os
+import subprocess as sp
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Service actions, ordered by impact.
+NO_ACTION = 0
+RELOAD = 1
+RESTART = 2
+
+_ACTION_NAMES = {NO_ACTION: 'none', RELOAD: 'reload', RESTART: 'restart'}
+
+_environments = {}
+
+
+class ChangeSet:
+    """
+    Collects changed files together with the service action each needs.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def __bool__(self):
+        return bool(self.files)
+
+    def add(self, path, action=RELOAD):
+        """
+        Record that path changed and needs at least action.
+        """
+        path = str(path)
+        self.files[path] = max(action, self.files.get(path, NO_ACTION))
+        return self
+
+    def merge(self, other):
+        """
+        Add all changes of another ChangeSet to this one.
+        """
+        if other:
+            for path, action in other.files.items():
+                self.add(path, action)
+        return self
+
+    @property
+    def action(self) -> int:
+        return max(self.files.values(), default=NO_ACTION)
+
+    def apply(self, service) -> int:
+        """
+        Reloads or restarts service as the recorded changes require.
+        A reload starts the service if it isn't running.
+        :return: the action taken.
+        """
+        action = self.action
+        if action == RESTART:
+            sp.check_call(['systemctl', 'restart', service])
+        elif action == RELOAD:
+            sp.check_call(['systemctl', 'reload-or-restart', service])
+        logger.info(f"{service}: {_ACTION_NAMES[action]} for changes in {sorted(self.files)}")
+        return action
+
+
+def environment(templates_path):
+    """
+    Returns the cached jinja2 Environment for a templates directory.
+    """
+    key = str(templates_path)
+    if key not in _environments:
+        import jinja2
+        _environments[key] = jinja2.Environment(loader=jinja2.FileSystemLoader(key))
+    return _environments[key]
+
+
+def _digest(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_file(target, content, mode=0o644) -> bool:
+    """
+    Atomically writes content (str or bytes) to target, unless target
+    already has exactly that content. An existing target keeps its
+    owner and mode, new files get mode.
+    :return: True if the file was written.
+    """
+    target = Path(target)
+    data = content.encode() if isinstance(content, str) else content
+    try:
+        st = target.stat()
+        if st.st_size == len(data) and _digest(target.read_bytes()) == _digest(data):
+            return False
+    except FileNotFoundError:
+        st = None
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(target.parent), prefix='.' + target.name + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if st is not None:
+            os.chmod(tmp, st.st_mode & 0o7777)
+            os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp, mode)
+        os.replace(tmp, str(target))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return True
+
+
+def remove_file(target) -> bool:
+    """
+    Removes target if it exists.
+    :return: True if a file was removed.
+    """
+    target = Path(target)
+    if target.exists():
+        target.unlink()
+        return True
+    return False
+
+
+def render_template(templates_path, template, target, ctx, changes=None, action=RELOAD) -> bool:
+    """
+    Renders template to target if the result differs from what is on disk.
+    A change is recorded with action on changes, if given.
+    :return: True if target was written.
+    """
+    content = environment(templates_path).get_template(template).render(ctx)
+    changed = write_file(target, content)
+    if changed and changes is not None:
+        changes.add(target, action)
+    return changed
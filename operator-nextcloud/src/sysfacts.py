@@ -0,0 +1,147 @@
+"""
+System facts: distro, php and hardware.
+
+The facts are probed once, php with a single interpreter run, and kept
+as json in the charms StoredState. Hooks read them from there instead
+of spawning php -v or lsb_release. Call refresh() after installing or
+upgrading packages.
+"""
+import json
+import logging
+import os
+import subprocess as sp
+
+logger = logging.getLogger(__name__)
+
+OS_RELEASE = '/etc/os-release'
+
+# Bump when the shape of the facts changes, stored facts are re-probed.
+FACTS_VERSION = 1
+
+_PHP_PROBE = """echo json_encode([
+    'version' => PHP_MAJOR_VERSION . '.' . PHP_MINOR_VERSION,
+    'release' => PHP_VERSION,
+    'ini_file' => php_ini_loaded_file(),
+    'ini_scanned_files' => php_ini_scanned_files(),
+    'extension_dir' => ini_get('extension_dir'),
+    'extensions' => array_map('strtolower', get_loaded_extensions()),
+]);"""
+
+_stored = None
+_facts = None
+
+
+def bind(stored) -> None:
+    """
+    Keep the facts in stored, a StoredState with a system_facts string.
+    """
+    global _stored, _facts
+    _stored = stored
+    _facts = None
+
+
+def _probe_distro() -> dict:
+    release = {}
+    try:
+        with open(OS_RELEASE) as f:
+            for line in f:
+                key, sep, value = line.strip().partition('=')
+                if sep:
+                    release[key] = value.strip('"\'')
+    except OSError as e:
+        logger.warning("Unable to read " + OS_RELEASE + ": " + str(e))
+    return {'id': release.get('ID'),
+            'version_id': release.get('VERSION_ID'),
+            'codename': release.get('VERSION_CODENAME') or release.get('UBUNTU_CODENAME')}
+
+
+def _probe_php() -> dict:
+    """
+    All php facts from one php run, None if php isn't installed.
+    """
+    try:
+        cp = sp.run(['php', '-r', _PHP_PROBE], stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+    except FileNotFoundError:
+        return None
+    if cp.returncode != 0:
+        logger.warning("Probing php failed: " + cp.stderr)
+        return None
+    php = json.loads(cp.stdout)
+    scanned = php.pop('ini_scanned_files') or ''
+    php['ini_scanned_files'] = [f.strip() for f in scanned.split(',') if f.strip()]
+    return php
+
+
+def _probe_hardware() -> dict:
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        memory = None
+    return {'cpus': os.cpu_count(), 'memory': memory}
+
+
+def probe() -> dict:
+    return {'facts_version': FACTS_VERSION,
+            'distro': _probe_distro(),
+            'php': _probe_php(),
+            'hardware': _probe_hardware()}
+
+
+def _save(facts) -> None:
+    global _facts
+    _facts = facts
+    if _stored is not None:
+        _stored.system_facts = json.dumps(facts)
+
+
+def refresh() -> dict:
+    """
+    Probes the system again, e.g. after package installs.
+    """
+    facts = probe()
+    _save(facts)
+    logger.info("System facts: " + json.dumps(facts, sort_keys=True))
+    return facts
+
+
+def facts() -> dict:
+    """
+    The system facts, probed only if none are stored yet.
+    """
+    if _facts is not None:
+        return _facts
+    stored = _stored.system_facts if _stored is not None else ''
+    if stored:
+        loaded = json.loads(stored)
+        if loaded.get('facts_version') == FACTS_VERSION:
+            _save(loaded)
+            return loaded
+    return refresh()
+
+
+def distro_codename() -> str:
+    return facts()['distro']['codename']
+
+
+def php() -> dict:
+    """
+    The php facts. If php wasn't installed when probed it is probed again.
+    """
+    current = facts()
+    if current['php'] is None:
+        current = dict(current, php=_probe_php())
+        if current['php'] is not None:
+            _save(current)
+    return current['php']
+
+
+def php_version() -> str:
+    """
+    php version as X.Y, None if php isn't installed.
+    """
+    php_facts = php()
+    return php_facts['version'] if php_facts else None
+
+
+def hardware() -> dict:
+    return facts()['hardware']
@@ -0,0 +1,230 @@
+"""
+Leader orchestrated rolling upgrade over the cluster peer relation.
+
+The leader publishes a plan in the application data bag, every unit
+reports its progress for that plan in its own unit data bag:
+
+    stage    all units extract and prepare the new release while the
+             old one keeps serving, then report 'staged'.
+    upgrade  the leader enters maintenance, switches its own code and
+             runs occ upgrade, once for the cluster.
+    switch   the leader lets peers switch their code in batches, so no
+             more than 1 - upgrade-min-capacity of the units are
+             switching at any time. Each reports 'switched'.
+    done     all units run the new release.
+    failed   a unit reported a failure, the plan stops there.
+
+Peers running the old release keep their config.php until they switch,
+since it is only valid for the new code after occ upgrade.
+"""
+import json
+import logging
+import math
+import time
+from ops.model import MaintenanceStatus, BlockedStatus
+import utils
+import releases
+import artifact_cache
+from occ import Occ
+
+logger = logging.getLogger(__name__)
+
+KEY = 'upgrade'
+
+STAGE = 'stage'
+UPGRADE = 'upgrade'
+SWITCH = 'switch'
+DONE = 'done'
+FAILED = 'failed'
+
+STAGED = 'staged'
+SWITCHED = 'switched'
+
+
+def batch_size(total, min_capacity) -> int:
+    """
+    Units that may switch at once, keeping min_capacity of total serving.
+    At least one, or an upgrade could never finish.
+    """
+    return max(1, math.floor(total * (1 - min_capacity) + 1e-9))
+
+
+def _unit_key(name):
+    app, _, number = name.partition('/')
+    return app, int(number) if number.isdigit() else 0
+
+
+def advance(plan, states, units, min_capacity) -> dict:
+    """
+    The next plan, from the states units reported for it.
+    states maps unit names to their reported state dict.
+    The leader does the upgrade phase itself and reports 'switched'.
+    """
+    plan = dict(plan)
+    units = sorted(units, key=_unit_key)
+    reported = {u: states[u].get('state') for u in units if states.get(u, {}).get('id') == plan['id']}
+    failed = [u for u in units if reported.get(u) == FAILED]
+    if failed:
+        plan.update(phase=FAILED, failed=failed, switch=[])
+        return plan
+    if plan['phase'] == STAGE and all(reported.get(u) in (STAGED, SWITCHED) for u in units):
+        plan['phase'] = UPGRADE
+    elif plan['phase'] == SWITCH:
+        pending = [u for u in units if reported.get(u) != SWITCHED]
+        in_flight = [u for u in plan.get('switch', []) if u in pending]
+        if not pending:
+            plan.update(phase=DONE, switch=[])
+        elif not in_flight:
+            plan['switch'] = pending[:batch_size(len(units), min_capacity)]
+    return plan
+
+
+class RollingUpgrade:
+    """
+    Drives the plan for one charm unit: the leader advances it, every
+    unit, the leader included, carries out its own part.
+    """
+
+    def __init__(self, charm):
+        self.charm = charm
+
+    @property
+    def relation(self):
+        return self.charm.model.get_relation('cluster')
+
+    def plan(self) -> dict:
+        if not self.relation:
+            return {}
+        return json.loads(self.relation.data[self.charm.app].get(KEY) or '{}')
+
+    def _publish(self, plan):
+        self.relation.data[self.charm.app][KEY] = json.dumps(plan, sort_keys=True)
+
+    def _states(self) -> dict:
+        rel = self.relation
+        states = {}
+        for unit in list(rel.units) + [self.charm.unit]:
+            states[unit.name] = json.loads(rel.data[unit].get(KEY) or '{}')
+        return states
+
+    def _report(self, plan, state, message=''):
+        self.relation.data[self.charm.unit][KEY] = json.dumps(
+            {'id': plan['id'], 'version': plan['version'], 'state': state, 'message': message},
+            sort_keys=True)
+
+    def in_progress(self) -> bool:
+        return self.plan().get('phase') in (STAGE, UPGRADE, SWITCH, FAILED)
+
+    def config_applies(self) -> bool:
+        """
+        False while this unit still runs the release the plan replaces.
+        """
+        plan = self.plan()
+        return plan.get('phase') not in (SWITCH, FAILED) or releases.current() == plan['version']
+
+    def status(self):
+        plan = self.plan()
+        if plan.get('phase') == FAILED:
+            return BlockedStatus(f"upgrade to {plan['version']} failed on {', '.join(plan['failed'])}")
+        states = self._states()
+        switched = sum(1 for s in states.values() if s.get('id') == plan['id'] and s.get('state') == SWITCHED)
+        return MaintenanceStatus(f"upgrade to {plan.get('version')}: {plan.get('phase')}, "
+                                 f"{switched}/{len(states)} units switched")
+
+    def start(self, tarfile_url, checksum):
+        """
+        Starts an upgrade, on the leader. The leader stages first, so peers
+        can fetch the archive from it.
+        :return: the version upgraded to.
+        """
+        self.charm.unit.status = MaintenanceStatus("upgrade: staging release")
+        releases.adopt()
+        version, digest = utils.prepare_nextcloud_release(tarfile_url, checksum)
+        if version == releases.current():
+            raise releases.ReleaseError(f"Nextcloud {version} is already live.")
+        releases.carry_over(version)
+        plan = {'id': str(time.time()), 'version': version, 'tarfile': tarfile_url,
+                'sha256': digest or checksum or '', 'previous': releases.current(),
+                'phase': STAGE, 'switch': []}
+        self._publish(plan)
+        self._report(plan, STAGED)
+        self.step()
+        return version
+
+    def step(self):
+        """
+        Carries out this unit's part of the plan, and on the leader
+        advances the plan as far as the reported states allow.
+        """
+        if not self.relation:
+            return
+        plan = self.plan()
+        if not plan or plan['phase'] in (DONE, FAILED):
+            return
+        own = self._states()[self.charm.unit.name]
+        if own.get('id') != plan['id']:
+            self._stage(plan)
+        elif plan['phase'] == SWITCH and self.charm.unit.name in plan['switch'] and own.get('state') != SWITCHED:
+            self._switch(plan)
+        if self.charm.unit.is_leader():
+            self._lead(plan)
+        self.charm.unit.status = self.status()
+
+    def _stage(self, plan):
+        self.charm.unit.status = MaintenanceStatus(f"upgrade: staging {plan['version']}")
+        try:
+            version, _ = utils.prepare_nextcloud_release(
+                plan['tarfile'], plan['sha256'] or None, mirrors=self.charm._peer_archives())
+            if version != plan['version']:
+                raise releases.ReleaseError(f"Expected nextcloud {plan['version']}, got {version}")
+            releases.carry_over(version)
+        except (releases.ReleaseError, artifact_cache.ArtifactError, OSError) as e:
+            logger.error(f"Staging nextcloud {plan['version']} failed: {e}")
+            self._report(plan, FAILED, str(e))
+            return
+        self._report(plan, STAGED)
+
+    def _switch(self, plan):
+        releases.switch(plan['version'])
+        utils.reload_nextcloud_code()
+        self._report(plan, SWITCHED)
+
+    def _lead(self, plan):
+        min_capacity = self.charm.config.get('upgrade-min-capacity')
+        states = self._states()
+        units = list(states)
+        new = advance(plan, states, units, min_capacity)
+        if new['phase'] == UPGRADE:
+            if not self._upgrade(new):
+                self._report(new, FAILED, 'occ upgrade failed')
+                new.update(phase=FAILED, failed=[self.charm.unit.name], switch=[])
+            else:
+                new['phase'] = SWITCH
+                new = advance(new, self._states(), units, min_capacity)
+        if new != plan:
+            logger.info(f"Upgrade to {new['version']}: {new['phase']}, switching {new['switch']}")
+            self._publish(new)
+        if new['phase'] == DONE:
+            self.charm._stored.archive_sha256 = new['sha256']
+            self.charm._stored.archive_source = new['tarfile']
+            releases.prune()
+
+    def _upgrade(self, plan) -> bool:
+        """
+        Switches the leader and migrates the database, once for the cluster.
+        """
+        self.charm.unit.status = MaintenanceStatus(f"upgrade: occ upgrade to {plan['version']}")
+        Occ.maintenance_mode(enable=True)
+        # Config may have changed while staging, maintenance mode included.
+        releases.carry_over_config(plan['version'])
+        releases.switch(plan['version'])
+        utils.reload_nextcloud_code()
+        cp = Occ.upgrade()
+        if cp.returncode != 0:
+            logger.error("occ upgrade failed: " + cp.stdout + cp.stderr)
+            return False
+        Occ.maintenance_mode(enable=False)
+        self._report(plan, SWITCHED)
+        # Peers pick up the upgraded config.php when they switch.
+        self.charm.updateClusterRelationData()
+        return True
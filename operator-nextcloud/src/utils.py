@@ -2,15 +2,31 @@ import subprocess as sp
 from subprocess import CompletedProcess
 import sys
 import os
-import requests
-import tarfile
+import pwd
 from pathlib import Path
-import jinja2
-import json
-import io
+import logging
+import shutil
+import tempfile
 import string
 from random import randint, choice
-from occ import Occ
+from occ import Occ, OccWorker
+from reconciler import SystemConfigReconciler
+import render
+import modstate
+import sysfacts
+import artifact_cache
+import permissions
+import installer
+import releases
+
+logger = logging.getLogger(__name__)
+
+OCC_WORKER_UNIT = 'nextcloud-occ-worker.service'
+OCC_WORKER_SCRIPT = '/usr/local/lib/nextcloud-charm/occ-worker.php'
+ARCHIVE_SHARE_UNIT = 'nextcloud-archive-share.service'
+ARCHIVE_SHARE_PORT = 8099
+NEXTCLOUD_ROOT = '/var/www/nextcloud'
+SYSTEMD_DIR = '/etc/systemd/system'
 
 
 def _modify_port(start=None, end=None, protocol='tcp', hook_tool="open-port"):
@@ -44,188 +60,200 @@ def close_port(start, end=None, protocol="tcp"):
     _modify_port(start, end, protocol=protocol, hook_tool="close-port")
 
 
-def set_nextcloud_permissions(charm):
+def set_nextcloud_permissions(charm, include_datadir=False, force=False):
     """
     Set ownershow to www-data for nextcloud locations.
+    The datadir is skipped unless include_datadir, it can be huge.
+    A tree is only walked if its fingerprint changed since the last
+    walk, or with force, e.g. after extracting nextcloud.
     """
-    _datadir = str(charm._stored.nextcloud_datadir)
-    cmd = ['chown', '-R', 'www-data:www-data', '/var/www/nextcloud', _datadir]
-    sp.run(cmd, cwd='/var/www/nextcloud')
+    pw = pwd.getpwnam('www-data')
+    datadir = str(charm._stored.nextcloud_datadir)
+    trees = [(NEXTCLOUD_ROOT, [datadir])]
+    if include_datadir:
+        trees.append((datadir, []))
+    for root, exclude in trees:
+        fingerprint = permissions.fingerprint(root, exclude)
+        if fingerprint is None:
+            continue
+        if not force and charm._stored.permission_fingerprints.get(root) == fingerprint:
+            logger.info(f"Permissions of {root} unchanged since last run, skipping.")
+            continue
+        report = permissions.fix_tree(root, pw.pw_uid, pw.pw_gid, exclude)
+        logger.info(f"Permissions of {root}: {report}")
+        charm._stored.permission_fingerprints[root] = permissions.fingerprint(root, exclude)
 
 
-def install_dependencies():
+def set_nextcloud_file_permissions(paths):
     """
-    Installs package dependencies for the supported distros.
-    + focal
-    + bionic
-    :return:
-    """
-    distro_codename = sp.check_output(['lsb_release', '-sc'], universal_newlines=True).strip()
-    if 'focal' == distro_codename:
-        _install_dependencies_focal()
-    elif 'bionic' == distro_codename:
-        _install_dependencies_bionic()
-    elif 'jammy' == distro_codename:
-        _install_dependencies_jammy()
-    else:
-        raise RuntimeError("No valid series found to install package dependencies for")
-
-
-def install_apt_update():
-    command = ["sudo", "apt", "update", "-y"]
-    sp.run(command, check=True)
-
-
-def install_backup_dependencies():
-    try:
-        packages = ['pigz',
-                    'postgresql-client',
-                    'python3-pip']
-        command = ["sudo", "apt", "install", "-y"]
-        command.extend(packages)
-        sp.run(command, check=True)
-    except sp.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
-    try:
-        packages = ['pdpyras==4.4.0']
-        command = ["sudo", "pip3", "install"]
-        command.extend(packages)
-        sp.run(command, check=True)
-    except sp.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
+    Set ownership to www-data for files the charm wrote.
+    """
+    pw = pwd.getpwnam('www-data')
+    report = permissions.fix_paths(paths, pw.pw_uid, pw.pw_gid)
+    logger.info(f"Permissions of {', '.join(str(p) for p in paths)}: {report}")
 
 
-def _install_dependencies_bionic():
+def install_dependencies(offline_bundle=None) -> bool:
     """
-    Install packages that is needed by nextcloud to work with this charm.
-    Inspired by: https://github.com/nextcloud/vm/blob/master/nextcloud_install_production.sh
+    Installs package dependencies for the supported distros,
+    including the backup dependencies, in one apt transaction.
+    + jammy
+    + focal
+    + bionic
+    With an offline_bundle, only from the debs and wheels in it.
+    :return: True if anything was installed.
     """
+    packages = installer.packages_for(sysfacts.distro_codename())
     try:
-        packages = ['apache2',
-                    'libapache2-mod-php7.2',
-                    'php7.2-gd',
-                    'php7.2-json',
-                    'php7.2-mysql',
-                    'php7.2-pgsql',
-                    'php7.2-curl',
-                    'php7.2-mbstring',
-                    'php7.2-intl',
-                    'php7.2-imagick',
-                    'php7.2-zip',
-                    'php7.2-xml',
-                    'php-apcu',
-                    'php-redis',
-                    'php-smbclient']
-        command = ["sudo", "apt", "install", "-y"]
-        command.extend(packages)
-        sp.run(command, check=True)
+        offline_dir = installer.unpack_offline(offline_bundle) if offline_bundle else None
+        return installer.install(packages, installer.PIP_PACKAGES, offline_dir)
     except sp.CalledProcessError as e:
         print(e)
         sys.exit(-1)
 
 
-def _install_dependencies_focal():
+def _merge_tree(src, dst):
     """
-    Install packages that is needed by nextcloud to work with this charm.
-    Inspired by: https://github.com/nextcloud/vm/blob/master/nextcloud_install_production.sh
-    :return:
+    Moves the contents of src into dst, replacing files that exist.
     """
-    try:
-        packages = ['apache2',
-                    'libapache2-mod-php7.4',
-                    'php7.4-fpm',
-                    'php7.4-intl',
-                    'php7.4-ldap',
-                    'php7.4-imap',
-                    'php7.4-gd',
-                    'php7.4-pgsql',
-                    'php7.4-curl',
-                    'php7.4-xml',
-                    'php7.4-zip',
-                    'php7.4-mbstring',
-                    'php7.4-soap',
-                    'php7.4-json',
-                    'php7.4-gmp',
-                    'php7.4-bz2',
-                    'php7.4-bcmath',
-                    'php7.4-imagick',
-                    'php-pear',
-                    'php-apcu',
-                    'php-redis']
-        command = ["sudo", "apt", "install", "-y"]
-        command.extend(packages)
-        sp.run(command, check=True)
-    except sp.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
+    for entry in os.scandir(src):
+        target = os.path.join(dst, entry.name)
+        if entry.is_dir(follow_symlinks=False) and os.path.isdir(target) and not os.path.islink(target):
+            _merge_tree(entry.path, target)
+        else:
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.replace(entry.path, target)
 
 
-def _install_dependencies_jammy():
+def _fetch_and_extract(tarfile_url, checksum, dst, cache) -> str:
     """
-    Install packages that is needed by nextcloud to work with this charm.
-    Inspired by: https://github.com/nextcloud/vm/blob/master/nextcloud_install_production.sh
-    :return:
+    Extracts tarfile_url from the cache or while downloading it.
+    :return: sha256 of the archive.
     """
-    packages = "apache2 php8.1 libapache2-mod-php8.1 php8.1-curl php8.1-xml \
-                php8.1-pgsql php8.1-mbstring php8.1-gd php8.1-redis \
-                php8.1-intl php8.1-gmp php8.1-bcmath php8.1-imagick \
-                php8.1-zip php8.1-fpm php8.1-intl php8.1-ldap".split()
-
+    import archive
+    dst = Path(dst)
+    staging = Path(tempfile.mkdtemp(dir=dst, prefix='.nextcloud-')) if checksum else dst
+    download = None
     try:
-        sp.run('sudo apt remove php8.1-common -y'.split(), check=True)
-        command = ["sudo", "DEBIAN_FRONTEND=noninteractive", "apt", "install", "-y"]
-        command.extend(packages)
-        sp.run(command, check=True)
-    except sp.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
-
-
-def fetch_and_extract_nextcloud(tarfile_url):
+        path, digest = cache.lookup(tarfile_url, checksum)
+        if path:
+            logger.info(f"Using {tarfile_url} from the artifact cache.")
+            archive.extract_file(path, staging)
+        else:
+            download = cache.download(tarfile_url)
+            archive.extract(download, staging)
+            digest = download.drain()
+        logger.info(f"Fetched {tarfile_url} sha256: {digest}")
+        if checksum and digest != checksum.strip().lower():
+            download.discard()
+            raise artifact_cache.ArtifactError(f"Checksum mismatch for {tarfile_url}, "
+                                               f"expected {checksum} got {digest}")
+        if download:
+            download.commit()
+        if checksum:
+            _merge_tree(staging, dst)
+        return digest
+    finally:
+        # An unfinished download stays in the cache and is resumed next time.
+        if download:
+            download.close()
+        if checksum:
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def fetch_and_extract_nextcloud(tarfile_url, checksum=None, dst='/var/www/', cache=None, mirrors=()):
     """
     Fetch and Install nextcloud from internet
-    Sources are about 100M.
+    Sources are about 100M, they are streamed through the (parallel)
+    decompressor while downloading and hashed on the way.
+    .tar.bz2, .tar.zst and .tar.xz are supported.
+    Downloads are kept in the artifact cache, an archive that is already
+    cached is extracted from there and an interrupted one is resumed.
+    With a sha256 checksum the tarball is extracted to a staging dir
+    in dst and only moved in place if the checksum matches.
+    mirrors is a list of (url, sha256), e.g. peer units, tried in order
+    before tarfile_url.
+    Raises ArtifactError if neither a mirror nor tarfile_url worked.
+    :return: sha256 of the archive.
     """
     # tarfile_url = 'https://download.nextcloud.com/server/releases/nextcloud-18.0.3.tar.bz2'
     # checksum = '7b67e709006230f90f95727f9fa92e8c73a9e93458b22103293120f9cb50fd72'
+    # Only imported when nextcloud is fetched, most hooks don't.
+    import tarfile
+    import requests
+    import archive
+    cache = cache or artifact_cache.ArtifactCache()
+    errors = (requests.RequestException, archive.ArchiveError, artifact_cache.ArtifactError,
+              tarfile.TarError, OSError)
+    for url, sha256 in mirrors:
+        try:
+            return _fetch_and_extract(url, sha256, dst, cache)
+        except errors as e:
+            logger.warning(f"Fetching from mirror {url} failed, trying next: {e}")
     try:
-        response = requests.get(tarfile_url, allow_redirects=True, stream=True)
-        dst = Path('/var/www/')
-        with tarfile.open(fileobj=io.BytesIO(response.content), mode='r:bz2') as tfile:
-            tfile.extractall(path=dst)
-    except sp.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
+        return _fetch_and_extract(tarfile_url, checksum, dst, cache)
+    except errors as e:
+        raise artifact_cache.ArtifactError(f"Fetching nextcloud from {tarfile_url} failed: {e}") from e
 
 
-def extract_nextcloud(tarfile_path):
+def extract_nextcloud(tarfile_path, dst='/var/www/'):
     """
-    Install nextcloud from tarfile
+    Install nextcloud from tarfile, .tar.bz2, .tar.zst or .tar.xz
     """
-    dst = Path('/var/www/')
-    with tarfile.open(tarfile_path, mode='r:bz2') as tfile:
-        tfile.extractall(path=dst)
+    import archive
+    archive.extract_file(tarfile_path, dst)
 
 
-def config_apache2(templates_path, template):
+def prepare_nextcloud_release(tarfile_url=None, checksum=None, tarfile_path=None, mirrors=()) -> tuple:
     """
-    Configures apache2
+    Extracts a nextcloud release next to the live one, from tarfile_path
+    if given, otherwise fetched from mirrors or tarfile_url, and gives it
+    to www-data before it goes live.
+    :return: (version, sha256 of the fetched archive or None)
+    """
+    digest = None
+
+    def extract(staging):
+        nonlocal digest
+        if tarfile_path:
+            extract_nextcloud(tarfile_path, staging)
+        else:
+            digest = fetch_and_extract_nextcloud(tarfile_url, checksum, staging, mirrors=mirrors)
+
+    version = releases.prepare(extract)
+    pw = pwd.getpwnam('www-data')
+    release = releases.release_path(version)
+    report = permissions.fix_tree(release, pw.pw_uid, pw.pw_gid, [os.path.join(release, 'data')])
+    logger.info(f"Permissions of {release}: {report}")
+    return version, digest
+
+
+def reload_nextcloud_code():
+    """
+    Makes apache and the occ worker pick up a switched release. A graceful
+    reload drops the opcache of the old release files.
+    """
+    sp.call(['systemctl', 'try-restart', OCC_WORKER_UNIT])
+    sp.call(['systemctl', 'reload-or-restart', 'apache2.service'])
+
+
+def config_apache2(templates_path, template) -> render.ChangeSet:
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
-    target = Path('/etc/apache2/sites-available/nextcloud.conf')
-    ctx = {}
-    target.write_text(template.render(ctx))
-    # Enable required modules.
-    for module in ['rewrite', 'headers', 'env', 'dir', 'mime', 'setenvif', 'proxy_fcgi']:
-        sp.call(['a2enmod', module])
+    Configures apache2
+    :return: ChangeSet, a changed site only needs a reload, a new module a restart.
+    """
+    changes = render.ChangeSet()
+    render.render_template(templates_path, template,
+                           Path(modstate.APACHE_DIR, 'sites-available', 'nextcloud.conf'), {}, changes)
+    # Enable required modules, only the missing ones.
+    modstate.ensure_apache_modules(['rewrite', 'headers', 'env', 'dir', 'mime', 'setenvif', 'proxy_fcgi'],
+                                   changes)
     # Disable default site
-    sp.check_call(['a2dissite', '000-default'])
+    modstate.ensure_apache_site('000-default', False, changes)
     # Enable nextcloud site (wich will be default)
-    sp.check_call(['a2ensite', 'nextcloud'])
+    modstate.ensure_apache_site('nextcloud', True, changes)
+    return changes
 
 
 def install_nfs_systemd_mount(templates_path, template, ctx):
@@ -233,64 +261,105 @@ def install_nfs_systemd_mount(templates_path, template, ctx):
     Installs nfs systemd.mount unit file
     ctx = {'nfs_host': <iphostname>, 'appname': <appname>}
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
-    target = Path('/etc/systemd/system/media-nextcloud-data.mount')
-    target.write_text(template.render(ctx))
-    sp.call(['systemctl', 'daemon-reload'])
+    if render.render_template(templates_path, template,
+                              Path(SYSTEMD_DIR, 'media-nextcloud-data.mount'), ctx):
+        sp.call(['systemctl', 'daemon-reload'])
+
+
+def config_occ_worker(enable, templates_path, template, worker_script):
+    """
+    Installs and starts, or stops and disables, the occ worker service.
+    worker_script is the occ-worker.php shipped with the charm.
+    """
+    target = Path(SYSTEMD_DIR, OCC_WORKER_UNIT)
+    if not enable:
+        if target.exists():
+            sp.call(['systemctl', 'disable', '--now', OCC_WORKER_UNIT])
+            target.unlink()
+            sp.call(['systemctl', 'daemon-reload'])
+        return
+    changes = render.ChangeSet()
+    # Keep the script outside of the charm dir so www-data can read it.
+    if render.write_file(OCC_WORKER_SCRIPT, Path(worker_script).read_bytes()):
+        changes.add(OCC_WORKER_SCRIPT, render.RESTART)
+    ctx = {'worker_script': OCC_WORKER_SCRIPT,
+           'socket': OccWorker.socket_path,
+           'nextcloud_root': NEXTCLOUD_ROOT}
+    if render.render_template(templates_path, template, target, ctx, changes, render.RESTART):
+        sp.call(['systemctl', 'daemon-reload'])
+    sp.call(['systemctl', 'enable', OCC_WORKER_UNIT])
+    # Only a changed script or unit needs a restart, otherwise just make sure it runs.
+    if changes:
+        changes.apply(OCC_WORKER_UNIT)
+    else:
+        sp.call(['systemctl', 'start', OCC_WORKER_UNIT])
+
+
+def config_archive_share(enable, bind_address, templates_path, template):
+    """
+    Serves the artifact cache to peer units on bind_address, or stops it.
+    Only complete, content addressed archives are served.
+    """
+    target = Path(SYSTEMD_DIR, ARCHIVE_SHARE_UNIT)
+    if not enable:
+        if target.exists():
+            sp.call(['systemctl', 'disable', '--now', ARCHIVE_SHARE_UNIT])
+            target.unlink()
+            sp.call(['systemctl', 'daemon-reload'])
+        return
+    objects_dir = Path(artifact_cache.CACHE_DIR, 'objects')
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    ctx = {'bind_address': bind_address,
+           'directory': str(objects_dir),
+           'port': ARCHIVE_SHARE_PORT}
+    changes = render.ChangeSet()
+    if render.render_template(templates_path, template, target, ctx, changes, render.RESTART):
+        sp.call(['systemctl', 'daemon-reload'])
+    sp.call(['systemctl', 'enable', ARCHIVE_SHARE_UNIT])
+    if changes:
+        changes.apply(ARCHIVE_SHARE_UNIT)
+    else:
+        sp.call(['systemctl', 'start', ARCHIVE_SHARE_UNIT])
 
 
-def config_php(phpmod_context, templates_path, template):
+def config_php(phpmod_context, templates_path, template) -> render.ChangeSet:
     """
     Renders the phpmodule for nextcloud (nextcloud.ini)
     This is instead of manipulating the system wide php.ini
     which might be overwitten or changed from elsewhere.
+    :return: ChangeSet, mod_php picks up ini changes on a graceful reload.
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
-    target_72 = Path('/etc/php/7.2/mods-available/nextcloud.ini')
-    target_74 = Path('/etc/php/7.4/mods-available/nextcloud.ini')
-    target_81 = Path('/etc/php/8.1/mods-available/nextcloud.ini')
-    if get_phpversion() == "7.4":
-        target_74.write_text(template.render(phpmod_context))
-    elif get_phpversion() == "7.2":
-        target_72.write_text(template.render(phpmod_context))
-    elif get_phpversion() == "8.1":
-        target_81.write_text(template.render(phpmod_context))
-    sp.check_call(['phpenmod', 'nextcloud'])
+    changes = render.ChangeSet()
+    phpversion = get_phpversion()
+    render.render_template(templates_path, template,
+                           Path(modstate.PHP_DIR, phpversion, 'mods-available', 'nextcloud.ini'),
+                           phpmod_context, changes)
+    modstate.ensure_php_module(phpversion, 'nextcloud', changes)
+    return changes
 
 
-def config_ceph(ceph_info, templates_path, template):
+def config_ceph(ceph_info, templates_path, template) -> bool:
     """
-    Renders the phpmodule for nextcloud (nextcloud.ini)
-    This is instead of manipulating the system wide php.ini
-    which might be overwitten or changed from elsewhere.
+    Renders ceph.config.php, the objectstore config for nextcloud.
+    It is read on every request, so no service action is needed.
+    :return: True if the file changed.
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
-    target = Path('/var/www/nextcloud/config/ceph.config.php')
-    target.write_text(template.render(ceph_info))
+    return render.render_template(templates_path, template,
+                                  Path(NEXTCLOUD_ROOT, 'config', 'ceph.config.php'), ceph_info)
 
 
 def get_phpversion():
     """
-    Get php version X.Y from the running system.
+    Get php version X.Y from the system facts.
     Supports
     - 7.2 (bionic),
     - 7.4 (focal)
+    - 8.1 (jammy)
     :return: string
     """
-    response = sp.check_output(['php', '-v']).decode()
-    lines = response.split("\n")
-    if "PHP 7.4" in lines[0]:
-        return "7.4"
-    elif "PHP 7.2" in lines[0]:
-        return "7.2"
-    elif "PHP 8.1" in lines[0]:
-        return "8.1"
+    phpversion = sysfacts.php_version()
+    if phpversion in ("7.2", "7.4", "8.1"):
+        return phpversion
     else:
         raise RuntimeError("No valid PHP version found in check")
 
@@ -315,11 +384,8 @@ def config_backup(config, data_dir_path, db_host, db_user, db_pass):
         "pagerduty_token": config.get("backup-pagerduty-token"),
         "pagerduty_email": config.get("backup-pagerduty-email")
     }
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader("scripts/backup")
-    ).get_template("run_backup.sh")
-    target = Path('/root/scripts/backup/run_backup.sh')
-    target.write_text(template.render(run_backup_info))
+    render.render_template("scripts/backup", "run_backup.sh",
+                           '/root/scripts/backup/run_backup.sh', run_backup_info)
 
     # Configuring Nextcloud-Backup-Restore.conf
     backup_conf_info = {
@@ -328,24 +394,41 @@ def config_backup(config, data_dir_path, db_host, db_user, db_pass):
         "db_user": db_user,
         "db_pass": db_pass
     }
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader("scripts/backup/Nextcloud-Backup-Restore")
-    ).get_template("NextcloudBackupRestore.conf")
-    target = Path('/root/scripts/backup/Nextcloud-Backup-Restore/NextcloudBackupRestore.conf')
-    target.write_text(template.render(backup_conf_info))
+    render.render_template("scripts/backup/Nextcloud-Backup-Restore", "NextcloudBackupRestore.conf",
+                           '/root/scripts/backup/Nextcloud-Backup-Restore/NextcloudBackupRestore.conf',
+                           backup_conf_info)
 
 
 def getTrustedProxies():
     """
     Returns a json object with the trusted_proxies
     """
-    cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:get trusted_proxies --output=json")
-    s = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-               stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
-    # Load an empty dict into json if no trusted proxy exists.
-    if s.stdout == '':
-        return json.loads(str(dict()))
-    return json.loads(s.stdout)
+    return Occ.config_system_get_trusted_proxies()
+
+
+def syncTrustedProxies(hosts):
+    """
+    Makes trusted_proxies contain exactly hosts, in a single write and
+    only if anything differs. Kept proxies keep their order, new ones
+    are appended.
+    """
+    current = getTrustedProxies()
+    if isinstance(current, dict):
+        current = list(current.values())
+    elif not isinstance(current, list):
+        current = []
+    target = set(hosts)
+    proxies = []
+    for proxy in current:
+        if proxy in target and proxy not in proxies:
+            proxies.append(proxy)
+    proxies.extend(sorted(target - set(proxies)))
+    batch = Occ.config_system_batch()
+    if proxies:
+        batch.set('trusted_proxies', proxies)
+    else:
+        batch.delete('trusted_proxies')
+    return SystemConfigReconciler().reconcile(batch)
 
 
 def addTrustedProxy(host):
@@ -360,11 +443,7 @@ def deleteTrustedProxies() -> CompletedProcess:
     """
     Removes all trusted_proxies from config via occ by setting an empty value.
     """
-    cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
-           " trusted_proxies "
-           " --value=")
-    return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                  stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+    return Occ.delete_trusted_proxies()
 
 
 def deleteTrustedProxy(host) -> CompletedProcess:
@@ -375,21 +454,14 @@ def deleteTrustedProxy(host) -> CompletedProcess:
     ps = getTrustedProxies()
     for (idx, val) in ps.items():
         if val == host:
-            cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
-                   f" trusted_proxies {idx} --value=")
-            return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                          stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+            return Occ.set_trusted_proxy('', idx)
 
 
 def setTrustedProxy(host, index) -> CompletedProcess:
     """
     Sets a trusted proxy on the given index.
     """
-    cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
-           " trusted_proxies {index}"
-           " --value={host} ").format(index=index, host=host)
-    return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                  stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+    return Occ.set_trusted_proxy(host, index)
 
 
 def installCrontab():
@@ -0,0 +1,330 @@
+"""
+A fake system layer to run charm hooks without root, network or a real
+nextcloud.
+
+FakeSystem builds a unit's filesystem under a temporary root (a nextcloud
+release with config.php, apache and php config dirs, systemd units) and
+points the path constants of the charm modules at it. subprocess and
+os.system are replaced by a scripted runner that records every spawn by
+its command class and emulates the commands the charm depends on:
+occ status and config:system, the php config batch and facts probe,
+a2enmod/a2ensite/a2dissite and phpenmod symlinks. GETs of status.php
+are answered and recorded in requests. Every spawn adds a
+simulated cost from COSTS, rough figures for a small VM, so runs can be
+compared without timing real processes.
+"""
+import json
+import os
+import pwd
+import tempfile
+import time
+from pathlib import Path
+from subprocess import CompletedProcess, CalledProcessError
+from types import SimpleNamespace
+from unittest import mock
+import artifact_cache
+import charm
+import health
+import installer
+import interface_redis
+import modstate
+import nextcloud_config
+import occ
+import profiler
+import releases
+import sysfacts
+import utils
+
+VERSION = '26.0.1'
+PHP_VERSION = '8.1'
+APACHE_MODULES = ['rewrite', 'headers', 'env', 'dir', 'mime', 'setenvif', 'proxy_fcgi', 'php8.1']
+
+# Simulated seconds per command class, the first matching prefix wins.
+COSTS = [
+    ('occ upgrade', 30.0),
+    ('occ maintenance:install', 20.0),
+    ('occ', 0.4),
+    ('php', 0.3),
+    ('systemctl', 0.5),
+    ('a2enmod', 0.15),
+    ('a2ensite', 0.15),
+    ('a2dissite', 0.15),
+    ('phpenmod', 0.15),
+    ('apt-get', 10.0),
+]
+DEFAULT_COST = 0.02
+# A GET of status.php on a kept alive connection.
+HTTP_COST = 0.005
+
+STATUS = {'installed': True, 'version': VERSION + '.0', 'versionstring': VERSION,
+          'edition': '', 'maintenance': False, 'needsDbUpgrade': False,
+          'productname': 'Nextcloud', 'extendedSupport': False}
+
+
+def cost(cls) -> float:
+    for prefix, seconds in COSTS:
+        if cls == prefix or cls.startswith(prefix + ' '):
+            return seconds
+    return DEFAULT_COST
+
+
+class FakeSystem:
+    """
+    The fake root and runner, active between start() and stop().
+    """
+
+    def __init__(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix='nextcloud-fakesystem-')
+        self.root = Path(self._tmp.name)
+        self.live = self.root / 'var/www/nextcloud'
+        self.config_dir = self.live / 'config'
+        self.config_php = self.config_dir / 'config.php'
+        self.datadir = self.root / 'var/www/nextcloud-shared/data'
+        self.apache_dir = self.root / 'etc/apache2'
+        self.php_dir = self.root / 'etc/php'
+        self.commands = []
+        self.requests = []
+        self.seconds = 0.0
+        self._patches = []
+
+    def _build(self, config):
+        release = self.root / 'var/www/nextcloud-releases' / VERSION
+        (release / 'config').mkdir(parents=True)
+        (release / 'version.php').write_text(f"<?php\n$OC_VersionString = '{VERSION}';\n")
+        (release / 'occ').write_text("<?php\n")
+        self.datadir.mkdir(parents=True)
+        os.symlink(release, self.live)
+        self._write_config(config)
+        for d in ['mods-available', 'mods-enabled', 'sites-available', 'sites-enabled']:
+            (self.apache_dir / d).mkdir(parents=True)
+        for module in APACHE_MODULES:
+            (self.apache_dir / 'mods-available' / (module + '.load')).touch()
+        (self.apache_dir / 'sites-available/000-default.conf').touch()
+        self._link(self.apache_dir, 'sites', ['000-default'], '.conf', True)
+        for d in ['mods-available', 'apache2/conf.d', 'cli/conf.d']:
+            (self.php_dir / PHP_VERSION / d).mkdir(parents=True)
+        (self.root / 'etc/systemd/system').mkdir(parents=True)
+        (self.root / 'etc/os-release').write_text('ID=ubuntu\nVERSION_ID="22.04"\nVERSION_CODENAME=jammy\n')
+        (self.root / 'run').mkdir()
+
+    def start(self, config=None):
+        """
+        Builds the root with config as the initial config.php and patches
+        the charm modules to use it.
+        """
+        self._build(config or {'installed': True, 'version': STATUS['version'],
+                               'datadirectory': str(self.datadir),
+                               'trusted_domains': ['localhost', 'cloud.example.com']})
+        root = self.root
+        user = pwd.getpwuid(os.getuid())
+        constants = [
+            (charm, 'NEXTCLOUD_ROOT', str(self.live)),
+            (charm, 'NEXTCLOUD_CONFIG_PHP', str(self.config_php)),
+            (charm, 'NEXTCLOUD_CEPH_CONFIG_PHP', str(self.config_dir / 'ceph.config.php')),
+            (charm, 'NEXTCLOUD_CONFIG_DIR', str(self.config_dir)),
+            (charm, 'ONETIME_LOGIN', str(root / 'root/.onetimelogin')),
+            (occ, 'NEXTCLOUD_ROOT', str(self.live)),
+            (occ.OccWorker, 'socket_path', str(root / 'run/occ.sock')),
+            (releases, 'LIVE', str(self.live)),
+            (releases, 'RELEASES_DIR', str(root / 'var/www/nextcloud-releases')),
+            (releases, 'SHARED_DIR', str(root / 'var/www/nextcloud-shared')),
+            (nextcloud_config, 'CONFIG_DIR', str(self.config_dir)),
+            (interface_redis, 'NEXTCLOUD_CONFIG_DIR', str(self.config_dir)),
+            (modstate, 'APACHE_DIR', str(self.apache_dir)),
+            (modstate, 'PHP_DIR', str(self.php_dir)),
+            (utils, 'NEXTCLOUD_ROOT', str(self.live)),
+            (utils, 'SYSTEMD_DIR', str(root / 'etc/systemd/system')),
+            (utils, 'OCC_WORKER_SCRIPT', str(root / 'usr/local/lib/nextcloud-charm/occ-worker.php')),
+            (sysfacts, 'OS_RELEASE', str(root / 'etc/os-release')),
+            (artifact_cache, 'CACHE_DIR', str(root / 'var/cache/nextcloud-charm')),
+            (installer, 'OFFLINE_DIR', str(root / 'var/lib/nextcloud-charm/offline')),
+            (installer, 'APT_UPDATE_STAMPS', [str(root / 'var/lib/apt/periodic/update-success-stamp')]),
+            (profiler, 'PROFILE_DIR', str(root / 'var/log/nextcloud-charm')),
+        ]
+        self._patches = [mock.patch.object(module, name, value) for module, name, value in constants]
+        self._patches += [
+            mock.patch('pwd.getpwnam', return_value=SimpleNamespace(pw_uid=user.pw_uid, pw_gid=user.pw_gid)),
+            mock.patch.object(health, 'fetch', side_effect=self._fetch),
+            mock.patch('os.system', side_effect=self._system),
+            mock.patch('subprocess.run', side_effect=self._run),
+            mock.patch('subprocess.call', side_effect=self._call),
+            mock.patch('subprocess.check_call', side_effect=self._check_call),
+            mock.patch('subprocess.check_output', side_effect=self._check_output),
+            mock.patch('subprocess.Popen', side_effect=self._popen),
+        ]
+        for patch in self._patches:
+            patch.start()
+        return self
+
+    def stop(self):
+        for patch in reversed(self._patches):
+            patch.stop()
+        self._patches = []
+        self._tmp.cleanup()
+
+    def reset(self):
+        """
+        Forgets the recorded spawns.
+        """
+        self.commands = []
+        self.requests = []
+        self.seconds = 0.0
+
+    def counts(self) -> dict:
+        counts = {}
+        for cls in self.commands:
+            counts[cls] = counts.get(cls, 0) + 1
+        return counts
+
+    def occ_calls(self) -> int:
+        return sum(1 for cls in self.commands if cls.split()[0] == 'occ')
+
+    def config(self) -> dict:
+        return nextcloud_config.read_file(str(self.config_php))
+
+    def _write_config(self, config):
+        """
+        Writes config.php like php would, with an mtime that always moves
+        forward so the parse cache can't miss a write.
+        """
+        try:
+            mtime = self.config_php.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = 0
+        self.config_php.write_text(nextcloud_config.dump(config))
+        stamp = max(time.time_ns(), mtime + 1000)
+        os.utime(self.config_php, ns=(stamp, stamp))
+
+    # The runner.
+
+    def _execute(self, args, input=None) -> tuple:
+        """
+        Records and emulates one spawn.
+        :return: (returncode, stdout)
+        """
+        cls = profiler.command_class(args)
+        self.commands.append(cls)
+        self.seconds += cost(cls)
+        argv = args.split() if isinstance(args, str) else [os.fsdecode(a) for a in args]
+        if argv[:2] == ['sudo', '-u']:
+            argv = argv[3:]
+        for i, arg in enumerate(argv):
+            if os.path.basename(arg) == 'occ':
+                return self._occ(argv[i + 1:])
+        program = os.path.basename(argv[0])
+        if program == 'php' and '-r' in argv:
+            return self._php_batch(input) if input else self._php_probe()
+        if program == 'a2enmod':
+            return self._link(self.apache_dir, 'mods', argv[1:], '.load', True)
+        if program in ('a2ensite', 'a2dissite'):
+            return self._link(self.apache_dir, 'sites', argv[1:], '.conf', program == 'a2ensite')
+        if program == 'phpenmod':
+            return self._phpenmod(argv[1:])
+        return 0, ''
+
+    def _occ(self, argv) -> tuple:
+        args = [a for a in argv if not a.startswith('-')]
+        options = dict(a[2:].partition('=')[::2] for a in argv if a.startswith('--'))
+        command = args[0] if args else ''
+        if command == 'status':
+            return 0, json.dumps(STATUS)
+        config = dict(self.config())
+        if command == 'config:system:get':
+            value = config.get(args[1])
+            if value is None:
+                return 1, ''
+            if options.get('output') == 'json':
+                return 0, json.dumps(value)
+            if isinstance(value, dict):
+                value = list(value.values())
+            return 0, "\n".join(str(v) for v in value) if isinstance(value, list) else str(value)
+        if command == 'config:system:set':
+            value = options.get('value', '')
+            if options.get('type') == 'boolean':
+                value = value.lower() in ('1', 'true', 'yes')
+            if len(args) > 2:
+                entries = config.get(args[1]) or {}
+                entries = dict(entries) if isinstance(entries, dict) else dict(enumerate(entries))
+                entries[int(args[2])] = value
+                value = entries
+            config[args[1]] = value
+            self._write_config(config)
+        elif command == 'config:system:delete':
+            config.pop(args[1], None)
+            self._write_config(config)
+        return 0, ''
+
+    def _php_batch(self, input) -> tuple:
+        changes = json.loads(input)
+        config = dict(self.config())
+        for key, value in changes.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+        self._write_config(config)
+        return 0, json.dumps({k: 'deleted' if v is None else 'set' for k, v in changes.items()})
+
+    def _php_probe(self) -> tuple:
+        return 0, json.dumps({'version': PHP_VERSION, 'release': PHP_VERSION + '.2',
+                              'ini_file': f'/etc/php/{PHP_VERSION}/cli/php.ini',
+                              'ini_scanned_files': '',
+                              'extension_dir': '/usr/lib/php/20210902',
+                              'extensions': ['core', 'json', 'pdo_pgsql', 'redis']})
+
+    def _link(self, base, kind, names, suffix, enable) -> tuple:
+        for name in (n for n in names if not n.startswith('-')):
+            link = base / f'{kind}-enabled' / (name + suffix)
+            if enable and not link.exists():
+                os.symlink(base / f'{kind}-available' / (name + suffix), link)
+            elif not enable and link.is_symlink():
+                link.unlink()
+        return 0, ''
+
+    def _phpenmod(self, argv) -> tuple:
+        version = argv[argv.index('-v') + 1] if '-v' in argv else PHP_VERSION
+        modules = [a for a in argv if not a.startswith('-') and a != version]
+        for module in modules:
+            name = modstate._php_priority(version, module) + '-' + module + '.ini'
+            for sapi in modstate.php_sapis(version):
+                link = self.php_dir / version / sapi / 'conf.d' / name
+                if not link.exists():
+                    os.symlink(self.php_dir / version / 'mods-available' / (module + '.ini'), link)
+        return 0, ''
+
+    # The subprocess, os and http replacements.
+
+    def _fetch(self, url=None, timeout=None):
+        self.requests.append(url or health.STATUS_URL)
+        self.seconds += HTTP_COST
+        return health.parse(STATUS)
+
+    def _run(self, args, input=None, check=False, universal_newlines=None, text=None, **kwargs):
+        returncode, stdout = self._execute(args, input)
+        if not (universal_newlines or text):
+            stdout = stdout.encode()
+        cp = CompletedProcess(args, returncode, stdout=stdout, stderr=stdout[:0])
+        if check:
+            cp.check_returncode()
+        return cp
+
+    def _call(self, args, **kwargs):
+        return self._execute(args)[0]
+
+    def _check_call(self, args, **kwargs):
+        returncode = self._call(args)
+        if returncode != 0:
+            raise CalledProcessError(returncode, args)
+        return 0
+
+    def _check_output(self, args, universal_newlines=None, text=None, **kwargs):
+        returncode, stdout = self._execute(args, kwargs.get('input'))
+        if returncode != 0:
+            raise CalledProcessError(returncode, args, stdout)
+        return stdout if universal_newlines or text else stdout.encode()
+
+    def _system(self, command):
+        return self._execute(command)[0]
+
+    def _popen(self, args, *a, **kwargs):
+        raise AssertionError(f"Unexpected Popen in a fake system run: {args}")
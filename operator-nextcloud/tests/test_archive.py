@@ -0,0 +1,109 @@
+import bz2
+import io
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+import archive
+
+
+class TestArchive(unittest.TestCase):
+    """
+    Unittests for detecting and (parallel) extracting nextcloud archives.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        rng = random.Random(1)
+        words = [bytes(rng.getrandbits(8) for _ in range(4)).hex() for _ in range(2000)]
+        # Large enough for several bz2 blocks at level 1.
+        self.content = ' '.join(rng.choice(words) for _ in range(60000)).encode()
+        self.dst = Path(self.tmpdir.name, 'dst')
+        self.dst.mkdir()
+
+    def _tar(self) -> bytes:
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tfile:
+            info = tarfile.TarInfo('nextcloud/version.php')
+            info.size = len(self.content)
+            tfile.addfile(info, io.BytesIO(self.content))
+        return buf.getvalue()
+
+    def _assert_extracted(self) -> None:
+        self.assertEqual(Path(self.dst, 'nextcloud/version.php').read_bytes(), self.content)
+
+    def test_detect_format(self) -> None:
+        self.assertEqual(archive.detect_format(b'BZh91AY'), 'bz2')
+        self.assertEqual(archive.detect_format(b'\x28\xb5\x2f\xfd\x00'), 'zst')
+        self.assertEqual(archive.detect_format(b'\xfd7zXZ\x00'), 'xz')
+        with self.assertRaises(archive.ArchiveError):
+            archive.detect_format(b'PK\x03\x04')
+
+    def test_bz2_blocks_are_standalone_streams(self) -> None:
+        data = bz2.compress(self.content, 1) + bz2.compress(self.content[:1000], 9)
+        blocks = list(archive._bz2_blocks(io.BytesIO(data), chunk_size=4096))
+        self.assertGreater(len(blocks), 2)
+        self.assertEqual(b''.join(bz2.decompress(b) for b in blocks), self.content + self.content[:1000])
+
+    def test_bz2_marker_at_chunk_boundary(self) -> None:
+        data = bz2.compress(self.content[:1000], 9)
+        # The block magic at byte 4 ends the first chunk.
+        blocks = list(archive._bz2_blocks(io.BytesIO(data), chunk_size=10))
+        self.assertEqual(len(blocks), 1)
+        self.assertEqual(bz2.decompress(blocks[0]), self.content[:1000])
+
+    def test_truncated_bz2(self) -> None:
+        data = bz2.compress(self.content, 1)
+        with self.assertRaises(archive.ArchiveError):
+            list(archive._bz2_blocks(io.BytesIO(data[:len(data) // 2])))
+
+    @mock.patch.dict(archive.DECOMPRESSORS, clear=True)
+    @mock.patch('archive._threads', return_value=4)
+    def test_parallel_bz2_stream(self, threads) -> None:
+        archive.extract(io.BytesIO(bz2.compress(self._tar(), 1)), self.dst)
+        self._assert_extracted()
+
+    @mock.patch.dict(archive.DECOMPRESSORS, clear=True)
+    def test_python_xz_file(self) -> None:
+        path = Path(self.tmpdir.name, 'nextcloud.tar.xz')
+        with tarfile.open(path, mode='w:xz') as tfile:
+            tfile.add(self._write_source(), arcname='nextcloud')
+        archive.extract_file(path, self.dst)
+        self._assert_extracted()
+
+    @unittest.skipUnless(shutil.which('xz'), "xz not installed")
+    def test_tool_stream(self) -> None:
+        path = Path(self.tmpdir.name, 'nextcloud.tar.xz')
+        with tarfile.open(path, mode='w:xz') as tfile:
+            tfile.add(self._write_source(), arcname='nextcloud')
+        # A non file object is fed to the tool from a thread.
+        archive.extract(io.BytesIO(path.read_bytes()), self.dst)
+        self._assert_extracted()
+
+    def test_tool_file(self) -> None:
+        source = self._write_source()
+        for fmt, tool in [('xz', 'xz'), ('bz2', 'bzip2')]:
+            if not shutil.which(tool):
+                continue
+            with self.subTest(tool=tool), mock.patch.dict(archive.DECOMPRESSORS, {fmt: [[tool, '-dc']]}):
+                path = Path(self.tmpdir.name, f'nextcloud.tar.{fmt}')
+                with tarfile.open(path, mode=f'w:{fmt}') as tfile:
+                    tfile.add(source, arcname='nextcloud')
+                # The file itself is the stdin of the tool, after its head was read.
+                dst = Path(self.tmpdir.name, tool)
+                archive.extract_file(path, dst)
+                self.assertEqual(Path(dst, 'nextcloud/version.php').read_bytes(), self.content)
+
+    def _write_source(self) -> str:
+        src = Path(self.tmpdir.name, 'src')
+        src.mkdir()
+        Path(src, 'version.php').write_bytes(self.content)
+        return str(src)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from artifact_cache import ArtifactCache
+
+PAYLOAD = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD with Range support. The first response is cut off
+    after cut_after bytes, as if the connection dropped.
+    """
+    cut_after = None
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range') in (None, '"v1"'):
+            start = int(match.group(1))
+        RangeHandler.ranges.append(start)
+        if start >= len(PAYLOAD):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(PAYLOAD)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = PAYLOAD[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}')
+        self.end_headers()
+        if RangeHandler.cut_after is not None:
+            self.wfile.write(body[:RangeHandler.cut_after])
+            RangeHandler.cut_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class TestArtifactCache(unittest.TestCase):
+    """
+    Unittests for the content addressed artifact cache.
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.httpd = HTTPServer(("localhost", 0), RangeHandler)
+        cls.url = f'http://localhost:{cls.httpd.server_port}/nextcloud.tar.bz2'
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cache = ArtifactCache(self.tmpdir.name)
+        RangeHandler.cut_after = None
+        RangeHandler.ranges = []
+
+    def test_download_is_stored_and_reused(self) -> None:
+        download = self.cache.download(self.url)
+        path = download.commit()
+        digest = hashlib.sha256(PAYLOAD).hexdigest()
+        self.assertEqual(path, self.cache.object_path(digest))
+        self.assertEqual(path.read_bytes(), PAYLOAD)
+        self.assertEqual(self.cache.lookup(self.url), (path, digest))
+        self.assertEqual(self.cache.lookup('http://elsewhere/nextcloud.tar.bz2', digest), (path, digest))
+        self.assertEqual(self.cache.lookup('http://elsewhere/nextcloud.tar.bz2'), (None, None))
+
+    def test_interrupted_download_resumes_in_stream(self) -> None:
+        RangeHandler.cut_after = 1024 * 1024
+        download = self.cache.download(self.url)
+        data = download.read()
+        self.assertEqual(data, PAYLOAD)
+        self.assertEqual(RangeHandler.ranges, [0, 1024 * 1024])
+        self.assertEqual(download.drain(), hashlib.sha256(PAYLOAD).hexdigest())
+
+    def test_partial_download_resumes_later(self) -> None:
+        download = self.cache.download(self.url)
+        download.read(512 * 1024)
+        download.close()
+
+        download = self.cache.download(self.url)
+        self.assertEqual(download.resumed_from, 512 * 1024)
+        self.assertEqual(download.commit().read_bytes(), PAYLOAD)
+        self.assertEqual(RangeHandler.ranges, [0, 512 * 1024])
+        self.assertEqual(os.listdir(Path(self.tmpdir.name, 'partial')), [])
+
+    def test_complete_partial_download_is_replayed(self) -> None:
+        download = self.cache.download(self.url)
+        download.drain()
+        # Killed before commit().
+        download.close()
+
+        download = self.cache.download(self.url)
+        self.assertEqual(download.resumed_from, len(PAYLOAD))
+        self.assertEqual(download.commit().read_bytes(), PAYLOAD)
+        self.assertEqual(RangeHandler.ranges, [0, len(PAYLOAD)])
+
+    def test_oversized_partial_download_starts_over(self) -> None:
+        partial = Path(self.tmpdir.name, 'partial', hashlib.sha256(self.url.encode()).hexdigest())
+        partial.parent.mkdir(parents=True)
+        partial.write_bytes(PAYLOAD + b'stale')
+
+        download = self.cache.download(self.url)
+        self.assertEqual(download.resumed_from, 0)
+        self.assertEqual(download.commit().read_bytes(), PAYLOAD)
+        self.assertEqual(RangeHandler.ranges, [len(PAYLOAD) + 5, 0])
+
+    def test_lru_eviction(self) -> None:
+        cache = ArtifactCache(self.tmpdir.name, max_bytes=100)
+        now = time.time()
+        for i, name in enumerate(['a', 'b', 'c']):
+            path = Path(self.tmpdir.name, name)
+            path.write_bytes(b'x' * 10)
+            cache.store(path, name)
+            os.utime(cache.object_path(name), (now - 100 + i, now - 100 + i))
+        # 'a' was used recently, so 'b' is the least recently used.
+        cache.get('a')
+        cache.max_bytes = 25
+        self.assertEqual(cache.evict(), ['b'])
+        self.assertEqual(sorted(os.listdir(Path(self.tmpdir.name, 'objects'))), ['a', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
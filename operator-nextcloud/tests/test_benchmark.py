@@ -0,0 +1,160 @@
+"""
+Hook benchmarks on the ops Harness and the fake system layer.
+
+Each scenario replays a sequence of dispatches on a leader with an
+installed nextcloud and counts the subprocesses the charm spawns, the
+occ calls among them and the simulated time they would take (see
+fakesystem.COSTS). The budgets are the counts measured when the
+scenario was written plus some headroom, a change that makes a hook
+spawn more fails here. The report is printed once all ran, and also
+written as json to $NEXTCLOUD_BENCHMARK_REPORT if that is set.
+"""
+import json
+import os
+import unittest
+from ops.testing import Harness
+import render
+from charm import NextcloudCharm
+from occ import HookCache
+from tests.fakesystem import FakeSystem
+
+
+def values(array) -> list:
+    return list(array.values()) if isinstance(array, dict) else list(array)
+
+
+class TestHookBenchmark(unittest.TestCase):
+    """
+    Spawn budgets of the charm hooks in common scenarios.
+    """
+    results = {}
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        lines = [f"{'scenario':<22} {'dispatches':>10} {'spawns':>7} {'occ':>5} {'http':>5} {'simulated':>10}  busiest"]
+        for name, r in sorted(cls.results.items()):
+            busiest = ", ".join(f"{c} x{n}" for c, n in sorted(r['commands'].items(), key=lambda c: -c[1])[:3])
+            lines.append(f"{name:<22} {r['dispatches']:>10} {r['spawns']:>7} {r['occ_calls']:>5} {r['requests']:>5} "
+                         f"{r['simulated_seconds']:>9.2f}s  {busiest}")
+        print("\n" + "\n".join(lines))
+        path = os.environ.get('NEXTCLOUD_BENCHMARK_REPORT')
+        if path:
+            with open(path, 'w') as f:
+                json.dump(cls.results, f, indent=2, sort_keys=True)
+
+    def setUp(self) -> None:
+        self.system = FakeSystem().start()
+        self.addCleanup(self.system.stop)
+        self.harness = Harness(NextcloudCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.set_leader(True)
+        self.cluster = self.harness.add_relation('cluster', 'nextcloud')
+        self.harness.update_relation_data(self.cluster, 'nextcloud/0', {'ingress-address': '10.0.0.1',
+                                                                        'private-address': '10.0.0.1'})
+        self.harness.begin()
+        self.dispatches = 0
+        stored = self.harness.charm._stored
+        stored.nextcloud_fetched = True
+        stored.nextcloud_initialized = True
+        stored.database_available = True
+        stored.nextcloud_datadir = str(self.system.datadir)
+        # The first config-changed enables modules and sites, not measured.
+        self.dispatch(lambda: self.harness.update_config({'fqdn': 'cloud.example.com'}))
+        self.system.reset()
+        self.dispatches = 0
+
+    def dispatch(self, fire):
+        """
+        One hook dispatch: juju starts every dispatch with a new charm
+        instance and commits at its end, which drains the intents.
+        """
+        HookCache.invalidate()
+        self.harness.charm.redis.changes = render.ChangeSet()
+        fire()
+        self.harness.framework.commit()
+        self.dispatches += 1
+
+    def join(self, relation_id, unit_name, data):
+        """
+        A remote unit joins with its data in place, as with juju.
+        """
+        with self.harness.hooks_disabled():
+            self.harness.add_relation_unit(relation_id, unit_name)
+            self.harness.update_relation_data(relation_id, unit_name, data)
+        relation = self._relation(relation_id)
+        unit = self.harness.model.get_unit(unit_name)
+        self.dispatch(lambda: self.harness.charm.on[relation.name].relation_joined.emit(relation, unit.app, unit))
+        self.dispatch(lambda: self.harness.charm.on[relation.name].relation_changed.emit(relation, unit.app, unit))
+
+    def depart(self, relation_id, unit_name):
+        self.dispatch(lambda: self.harness.remove_relation_unit(relation_id, unit_name))
+
+    def _relation(self, relation_id):
+        for relations in self.harness.model.relations.values():
+            for relation in relations:
+                if relation.id == relation_id:
+                    return relation
+        raise KeyError(relation_id)
+
+    def record(self, name, budget):
+        """
+        Stores the result of a scenario and checks it against its budget.
+        """
+        result = {'dispatches': self.dispatches,
+                  'spawns': len(self.system.commands),
+                  'occ_calls': self.system.occ_calls(),
+                  'requests': len(self.system.requests),
+                  'simulated_seconds': round(self.system.seconds, 2),
+                  'commands': self.system.counts()}
+        self.results[name] = result
+        self.assertLessEqual(result['spawns'], budget, f"{name}: {result}")
+        return result
+
+    def test_scale_out_20_units(self) -> None:
+        for n in range(1, 21):
+            self.join(self.cluster, f'nextcloud/{n}', {'ingress-address': f'10.0.0.{n + 1}',
+                                                       'private-address': f'10.0.0.{n + 1}'})
+        domains = values(self.system.config()['trusted_domains'])
+        self.assertEqual(domains[:2], ['localhost', 'cloud.example.com'])
+        self.assertEqual(sorted(domains[2:]), sorted(f'10.0.0.{n}' for n in range(1, 22)))
+        result = self.record('scale-out-20', budget=25)
+        # Only the trusted domains batch of each join.
+        self.assertEqual(result['occ_calls'], 0)
+
+    def test_haproxy_churn(self) -> None:
+        website = self.harness.add_relation('website', 'haproxy')
+        for n in range(3):
+            self.join(website, f'haproxy/{n}', {'private-address': f'10.0.2.{n}'})
+        for n in range(3, 13):
+            self.depart(website, f'haproxy/{n - 3}')
+            self.join(website, f'haproxy/{n}', {'private-address': f'10.0.2.{n}'})
+        proxies = values(self.system.config()['trusted_proxies'])
+        self.assertEqual(sorted(proxies), sorted(f'10.0.2.{n}' for n in range(10, 13)))
+        self.record('haproxy-churn', budget=30)
+
+    def test_config_flapping(self) -> None:
+        for n in range(10):
+            self.dispatch(lambda: self.harness.update_config({'debug': n % 2 == 0}))
+        self.assertFalse(self.system.config()['debug'])
+        result = self.record('config-flapping', budget=15)
+        # The status comes from status.php, occ isn't booted.
+        self.assertEqual(result['occ_calls'], 0)
+        # Nothing on disk changes for apache, nor its modules.
+        self.assertNotIn('a2enmod', result['commands'])
+        self.assertNotIn('systemctl', result['commands'])
+
+    def test_redis_attach_detach(self) -> None:
+        data = {'hostname': '10.0.3.1', 'port': '6379', 'password': 'secret'}
+        redis_config = self.system.config_dir / 'redis.config.php'
+        for n in range(3):
+            redis = self.harness.add_relation('redis', 'redis')
+            self.join(redis, 'redis/0', data)
+            self.assertTrue(redis_config.exists())
+            self.depart(redis, 'redis/0')
+            self.dispatch(lambda: self.harness.remove_relation(redis))
+            self.assertFalse(redis_config.exists())
+        self.record('redis-attach-detach', budget=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
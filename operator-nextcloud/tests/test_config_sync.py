@@ -0,0 +1,115 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+import config_sync
+import nextcloud_config
+
+CONFIG_PHP = "<?php\n$CONFIG = array (\n  'instanceid' => 'oc123',\n  'debug' => false,\n);\n"
+
+
+class TestConfigSync(unittest.TestCase):
+    """
+    Unittests for the hashed config propagation to peers.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.leader = Path(self.tmpdir.name, 'leader')
+        self.peer = Path(self.tmpdir.name, 'peer')
+        for d in [self.leader, self.peer]:
+            d.mkdir()
+        Path(self.leader, 'config.php').write_text(CONFIG_PHP * 20)
+        Path(self.leader, 'ceph.config.php').write_text("<?php\n$CONFIG = array ();\n")
+        Path(self.leader, 'redis.config.php').write_text("local")
+        self.databag = {'nextcloud_config': CONFIG_PHP}
+        self.files = ['config.php', 'ceph.config.php']
+
+    def test_publish_compresses_and_drops_legacy_keys(self) -> None:
+        self.assertTrue(config_sync.publish(self.databag, self.leader, self.files))
+        self.assertNotIn('nextcloud_config', self.databag)
+        files = json.loads(self.databag[config_sync.KEY])
+        self.assertEqual(sorted(files), ['ceph.config.php', 'config.php'])
+        self.assertLess(len(files['config.php']['payload']), len(CONFIG_PHP * 20))
+        self.assertEqual(config_sync.decode(files['config.php']), (CONFIG_PHP * 20).encode())
+        self.assertFalse(config_sync.publish(self.databag, self.leader, self.files))
+
+    def test_apply_writes_only_differing_files(self) -> None:
+        config_sync.publish(self.databag, self.leader, self.files)
+        self.assertEqual(config_sync.apply(self.databag, self.peer),
+                         [str(Path(self.peer, 'ceph.config.php')), str(Path(self.peer, 'config.php'))])
+        self.assertEqual(Path(self.peer, 'config.php').read_text(), CONFIG_PHP * 20)
+        self.assertEqual(Path(self.peer, 'config.php').stat().st_mode & 0o777, 0o640)
+
+        with mock.patch('config_sync.decode') as decode:
+            self.assertEqual(config_sync.apply(self.databag, self.peer), [])
+        decode.assert_not_called()
+
+        Path(self.leader, 'config.php').write_text(CONFIG_PHP)
+        self.assertTrue(config_sync.publish(self.databag, self.leader, self.files))
+        self.assertEqual(config_sync.differing(self.databag, self.peer), ['config.php'])
+        self.assertEqual(config_sync.apply(self.databag, self.peer), [str(Path(self.peer, 'config.php'))])
+
+    def _leader_config(self, **changes):
+        config = {'instanceid': 'oc123', 'trusted_domains': ['a', 'b'], 'debug': False}
+        config.update(changes)
+        Path(self.leader, 'config.php').write_text(nextcloud_config.dump(config))
+        return config_sync.publish_config(self.databag, self.leader)
+
+    def test_config_generations(self) -> None:
+        self.assertTrue(self._leader_config())
+        self.assertFalse(self._leader_config())
+        self.assertEqual(config_sync.document(self.databag)['generation'], 1)
+        self.assertEqual(sorted(json.loads(self.databag[config_sync.KEY])), ['ceph.config.php'])
+
+        self.assertEqual(config_sync.apply_config(self.databag, self.peer, 0), (1, True))
+        self.assertFalse(config_sync.config_differs(self.databag, self.peer))
+
+        self._leader_config(debug=True, trusted_domains=['a'])
+        doc = config_sync.document(self.databag)
+        self.assertEqual((doc['generation'], doc['changed']), (2, ['debug', 'trusted_domains']))
+        # A peer one generation behind only looks at the changed keys,
+        # local keys outside of them are kept.
+        peer_config = nextcloud_config.read_file(str(Path(self.peer, 'config.php')))
+        peer_config['local'] = 1
+        Path(self.peer, 'config.php').write_text(nextcloud_config.dump(peer_config))
+        self.assertEqual(config_sync.apply_config(self.databag, self.peer, 1), (2, True))
+        self.assertEqual(nextcloud_config.read_file(str(Path(self.peer, 'config.php'))),
+                         {'instanceid': 'oc123', 'trusted_domains': ['a'], 'debug': True, 'local': 1})
+
+        self.assertEqual(config_sync.apply_config(self.databag, self.peer, 2), (2, False))
+        self.assertEqual(config_sync.apply_config(self.databag, self.peer, 3), (3, False))
+
+    def test_unparsable_config_is_published_as_file(self) -> None:
+        self._leader_config()
+        Path(self.leader, 'config.php').write_text("<?php\n$CONFIG = array ('a' => FOO);\n")
+        self.assertTrue(config_sync.publish_config(self.databag, self.leader))
+        self.assertNotIn(config_sync.DOC_KEY, self.databag)
+        self.assertIn(str(Path(self.peer, 'config.php')), config_sync.apply(self.databag, self.peer))
+
+    def test_generation_survives_unparsable_config(self) -> None:
+        self._leader_config()
+        self._leader_config(debug=True)
+        self.assertEqual(config_sync.apply_config(self.databag, self.peer, 0), (2, True))
+        Path(self.leader, 'config.php').write_text("<?php\n$CONFIG = array ('a' => FOO);\n")
+        config_sync.publish_config(self.databag, self.leader)
+        self.assertEqual(config_sync.apply_config(self.databag, self.peer, 2), (2, False))
+
+        # Parsable again, the peer that applied 2 takes the next generation.
+        self._leader_config(debug=False)
+        doc = config_sync.document(self.databag)
+        self.assertEqual((doc['generation'], doc['changed']), (3, ['debug', 'instanceid', 'trusted_domains']))
+        self.assertEqual(config_sync.apply_config(self.databag, self.peer, 2), (3, True))
+        self.assertFalse(nextcloud_config.read_file(str(Path(self.peer, 'config.php')))['debug'])
+
+    def test_corrupt_payload_is_rejected(self) -> None:
+        entry = config_sync.encode(b'abc')
+        entry['sha256'] = config_sync.sha256(b'abd')
+        with self.assertRaises(ValueError):
+            config_sync.decode(entry)
+
+
+if __name__ == '__main__':
+    unittest.main()
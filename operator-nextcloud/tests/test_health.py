@@ -0,0 +1,125 @@
+import json
+import socket
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from subprocess import CompletedProcess
+from types import SimpleNamespace
+from unittest import mock
+import health
+import nextcloud_config
+from occ import HookCache
+
+STATUS = {'installed': True, 'maintenance': False, 'needsDbUpgrade': False,
+          'version': '26.0.1.1', 'versionstring': '26.0.1', 'edition': '', 'productname': 'Nextcloud'}
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        body = json.dumps(self.server.status).encode()
+        self.send_response(200 if self.path == '/status.php' else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHealth(unittest.TestCase):
+    """
+    Unittests for the status.php probe and its occ fallback.
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.httpd = ThreadingHTTPServer(('127.0.0.1', 0), StatusHandler)
+        cls.httpd.daemon_threads = True
+        cls.httpd_thread = threading.Thread(target=cls.httpd.serve_forever, daemon=True)
+        cls.httpd_thread.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def setUp(self) -> None:
+        self.httpd.status = dict(STATUS)
+        self.httpd.requests = []
+        self.httpd.connections = 0
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.config_php = Path(tmpdir.name, 'config.php')
+        self.config_php.write_text("<?php\n$CONFIG = array ('maintenance' => false);\n")
+        url = f'http://127.0.0.1:{self.httpd.server_address[1]}/status.php'
+        for patch in [mock.patch.object(health, 'STATUS_URL', url),
+                      mock.patch.object(nextcloud_config, 'CONFIG_DIR', tmpdir.name)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.stored = SimpleNamespace(nextcloud_status='')
+        health.bind(self.stored)
+        self.addCleanup(health.bind, None)
+        self.addCleanup(health.close)
+        HookCache.invalidate()
+
+    def _closed_port(self) -> str:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return f'http://127.0.0.1:{s.getsockname()[1]}/status.php'
+
+    def test_status_from_http_is_cached(self) -> None:
+        status = health.status()
+        self.assertEqual((status['installed'], status['version'], status['source']), (True, '26.0.1.1', 'http'))
+        self.assertEqual(health.status(), status)
+        self.assertEqual(self.httpd.requests, ['/status.php'])
+        # It survives the dispatch in StoredState.
+        health.bind(SimpleNamespace(nextcloud_status=self.stored.nextcloud_status))
+        self.assertEqual(health.status()['checked'], status['checked'])
+        self.assertEqual(len(self.httpd.requests), 1)
+
+    def test_config_change_and_ttl_expire_the_cache(self) -> None:
+        health.status()
+        self.httpd.status['maintenance'] = True
+        self.config_php.write_text("<?php\n$CONFIG = array ('maintenance' => true);\n")
+        self.assertTrue(health.status()['maintenance'])
+        with mock.patch.object(health, 'TTL', 0):
+            health.status()
+        self.assertEqual(len(self.httpd.requests), 3)
+
+    def test_connection_is_kept_alive(self) -> None:
+        for _ in range(3):
+            health.invalidate()
+            health.status()
+        self.assertEqual(len(self.httpd.requests), 3)
+        self.assertEqual(self.httpd.connections, 1)
+
+    @mock.patch('occ.sp.run')
+    def test_falls_back_to_occ(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=0, stderr='',
+                                            stdout="PHP Warning: something\n" + json.dumps(STATUS))
+        with mock.patch.object(health, 'STATUS_URL', self._closed_port()):
+            status = health.status()
+        self.assertEqual((status['installed'], status['source']), (True, 'occ'))
+        self.assertTrue(status['error'])
+        run.assert_called_once()
+
+    @mock.patch('occ.sp.run')
+    def test_none_when_nothing_answers(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=1, stdout='', stderr='Could not open input file')
+        with mock.patch.object(health, 'STATUS_URL', self._closed_port()):
+            self.assertIsNone(health.status())
+        self.assertEqual(self.stored.nextcloud_status, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import io
+import os
+import tarfile
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from subprocess import CompletedProcess
+from unittest import mock
+import installer
+
+
+class TestInstaller(unittest.TestCase):
+    """
+    Unittests for the single transaction package installer.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.site = Path(self.tmpdir.name, 'site')
+        self.site.mkdir()
+        self.stamp = Path(self.tmpdir.name, 'apt-update-stamp')
+        for name, value in [('PIP_SITE_DIRS', [str(self.site)]), ('APT_UPDATE_STAMPS', [str(self.stamp)])]:
+            patcher = mock.patch.object(installer, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.commands = []
+
+    def _run(self, installed):
+        def run(cmd, **kwargs):
+            self.commands.append(cmd)
+            stdout = ''
+            if cmd[0] == 'dpkg-query':
+                stdout = ''.join(f"{p}\t{'ii ' if p in installed else 'un '}\n" for p in cmd[3:])
+            return CompletedProcess(args=cmd, returncode=0, stdout=stdout, stderr='')
+        return run
+
+    def test_nothing_missing_runs_no_apt(self) -> None:
+        Path(self.site, 'pdpyras-4.4.0.dist-info').mkdir()
+        with mock.patch('installer.sp.run', side_effect=self._run({'apache2', 'zstd'})):
+            self.assertFalse(installer.install(['apache2', 'zstd'], ['pdpyras==4.4.0']))
+        self.assertEqual([cmd[0] for cmd in self.commands], ['dpkg-query'])
+
+    def test_missing_packages_in_one_transaction(self) -> None:
+        with mock.patch('installer.sp.run', side_effect=self._run({'apache2'})):
+            self.assertTrue(installer.install(['apache2', 'zstd', 'lbzip2'], ['pdpyras==4.4.0']))
+        self.assertEqual(self.commands[1:], [
+            ['sudo', 'apt-get', 'update'],
+            ['sudo', 'DEBIAN_FRONTEND=noninteractive', 'apt-get', 'install', '-y', 'zstd', 'lbzip2'],
+            ['sudo', 'pip3', 'install', 'pdpyras==4.4.0'],
+        ])
+        self.assertTrue(installer.index_fresh())
+
+    def test_fresh_index_skips_update(self) -> None:
+        self.stamp.touch()
+        with mock.patch('installer.sp.run', side_effect=self._run(set())):
+            installer.install(['zstd'])
+        self.assertNotIn(['sudo', 'apt-get', 'update'], self.commands)
+
+        old = time.time() - installer.INDEX_MAX_AGE - 60
+        os.utime(self.stamp, (old, old))
+        self.assertFalse(installer.index_fresh())
+
+    def test_pip_installed_matches_version(self) -> None:
+        Path(self.site, 'PDPyRAS-4.3.0.dist-info').mkdir()
+        self.assertFalse(installer.pip_installed('pdpyras==4.4.0'))
+        self.assertTrue(installer.pip_installed('pdpyras'))
+
+    def _bundle(self, names) -> Path:
+        bundle = Path(self.tmpdir.name, 'offline-packages.tar')
+        with tarfile.open(bundle, 'w') as tfile:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = 1
+                tfile.addfile(info, io.BytesIO(b'x'))
+        return bundle
+
+    def test_offline_install_uses_only_the_bundle(self) -> None:
+        offline = Path(self.tmpdir.name, 'offline')
+        installer.unpack_offline(self._bundle(['debs/zstd.deb', 'debs/lbzip2.deb', 'wheels/p.whl']), offline)
+        with mock.patch('installer.sp.run', side_effect=self._run(set())):
+            self.assertTrue(installer.install(['zstd', 'lbzip2'], ['pdpyras==4.4.0'], offline))
+        debs = Path(offline, 'debs').resolve()
+        apt = ['sudo', 'DEBIAN_FRONTEND=noninteractive', 'apt-get'] + installer._NO_SOURCES
+        self.assertEqual(self.commands[1:], [
+            apt + ['install', '-y', '--no-download', f'{debs}/lbzip2.deb', f'{debs}/zstd.deb'],
+            ['sudo', 'pip3', 'install', '--no-index', '--find-links', str(Path(offline, 'wheels')),
+             'pdpyras==4.4.0'],
+        ])
+
+    def test_offline_install_with_index(self) -> None:
+        offline = Path(self.tmpdir.name, 'offline')
+        installer.unpack_offline(self._bundle(['debs/zstd.deb', 'debs/Packages.gz']), offline)
+        with mock.patch('installer.sp.run', side_effect=self._run(set())):
+            installer.install(['zstd'], offline_dir=offline)
+        sources = Path(offline, 'sources.list')
+        self.assertIn('[trusted=yes] file:', sources.read_text())
+        self.assertEqual([cmd[-1] for cmd in self.commands[1:]], ['update', 'zstd'])
+        self.assertIn(f'Dir::Etc::SourceList={sources}', self.commands[1])
+        # The system lists in /var/lib/apt/lists stay as they are.
+        lists = Path(offline, 'lists').resolve()
+        for cmd in self.commands[1:]:
+            self.assertIn(f'Dir::State::Lists={lists}', cmd)
+            self.assertIn(f"Dir::Cache={Path(offline, 'cache').resolve()}", cmd)
+        self.assertTrue(Path(lists, 'partial').is_dir())
+
+    def test_unpack_offline_skips_unchanged_bundle(self) -> None:
+        offline = Path(self.tmpdir.name, 'offline')
+        bundle = self._bundle(['debs/zstd.deb'])
+        installer.unpack_offline(bundle, offline)
+        Path(offline, 'debs', 'zstd.deb').unlink()
+        installer.unpack_offline(bundle, offline)
+        self.assertFalse(Path(offline, 'debs', 'zstd.deb').exists())
+        os.utime(bundle, (1, 1))
+        installer.unpack_offline(bundle, offline)
+        self.assertTrue(Path(offline, 'debs', 'zstd.deb').exists())
+
+    def test_packages_for(self) -> None:
+        packages = installer.packages_for('jammy')
+        self.assertEqual(len(packages), len(set(packages)))
+        self.assertIn('postgresql-client', packages)
+        with self.assertRaises(RuntimeError):
+            installer.packages_for('xenial')
+
+
+if __name__ == '__main__':
+    unittest.main()
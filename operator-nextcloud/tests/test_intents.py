@@ -0,0 +1,47 @@
+import unittest
+from types import SimpleNamespace
+import intents
+
+
+class TestIntents(unittest.TestCase):
+    """
+    Unittests for the coalesced pending work.
+    """
+
+    def setUp(self) -> None:
+        self.stored = SimpleNamespace(intents=[])
+        self.intents = intents.Intents(self.stored)
+
+    def test_duplicates_collapse(self) -> None:
+        self.assertTrue(self.intents.add(intents.TRUSTED_PROXIES))
+        for _ in range(9):
+            self.assertFalse(self.intents.add(intents.TRUSTED_PROXIES))
+        self.intents.add(intents.START)
+        self.assertEqual(self.stored.intents, [intents.TRUSTED_PROXIES, intents.START])
+
+    def test_drain_keeps_what_isnt_ready(self) -> None:
+        calls = []
+        ready = {'value': False}
+
+        def start():
+            calls.append(intents.START)
+            return ready['value']
+
+        def proxies():
+            calls.append(intents.TRUSTED_PROXIES)
+            return True
+
+        handlers = {intents.START: start, intents.TRUSTED_PROXIES: proxies}
+        for name in [intents.START, intents.TRUSTED_PROXIES, 'unknown']:
+            self.intents.add(name)
+        self.assertEqual(self.intents.drain(handlers), [intents.TRUSTED_PROXIES])
+        self.assertEqual(self.intents.pending(), [intents.START])
+
+        ready['value'] = True
+        self.assertEqual(self.intents.drain(handlers), [intents.START])
+        self.assertEqual(self.intents.pending(), [])
+        self.assertEqual(calls, [intents.START, intents.TRUSTED_PROXIES, intents.START])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+import modstate
+import render
+
+
+class TestModState(unittest.TestCase):
+    """
+    Unittests for inspecting apache and php module state from symlinks.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.apache = Path(self.tmpdir.name, 'apache2')
+        self.php = Path(self.tmpdir.name, 'php')
+        for d in ['mods-available', 'mods-enabled', 'sites-available', 'sites-enabled']:
+            Path(self.apache, d).mkdir(parents=True)
+        for d in ['mods-available', 'apache2/conf.d', 'cli/conf.d']:
+            Path(self.php, '8.1', d).mkdir(parents=True)
+        for name, value in [('APACHE_DIR', str(self.apache)), ('PHP_DIR', str(self.php))]:
+            patcher = mock.patch.object(modstate, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _enable_apache_module(self, module):
+        Path(self.apache, 'mods-available', module + '.load').touch()
+        os.symlink(Path(self.apache, 'mods-available', module + '.load'),
+                   Path(self.apache, 'mods-enabled', module + '.load'))
+
+    @mock.patch('modstate.sp.call')
+    def test_only_missing_apache_modules_are_enabled(self, call) -> None:
+        self._enable_apache_module('rewrite')
+        call.side_effect = lambda cmd: self._enable_apache_module('headers')
+        changes = render.ChangeSet()
+
+        self.assertEqual(modstate.ensure_apache_modules(['rewrite', 'headers'], changes), ['headers'])
+        call.assert_called_once_with(['a2enmod', '-q', 'headers'])
+        self.assertEqual(changes.action, render.RESTART)
+
+        call.reset_mock()
+        self.assertEqual(modstate.ensure_apache_modules(['rewrite', 'headers']), [])
+        call.assert_not_called()
+
+    @mock.patch('modstate.sp.check_call')
+    def test_apache_site(self, check_call) -> None:
+        Path(self.apache, 'sites-enabled', '000-default.conf').touch()
+        self.assertFalse(modstate.ensure_apache_site('nextcloud', False))
+        self.assertTrue(modstate.ensure_apache_site('000-default', False))
+        check_call.assert_called_once_with(['a2dissite', '-q', '000-default'])
+
+    @mock.patch('modstate.sp.check_call')
+    def test_php_module_priority_link(self, check_call) -> None:
+        Path(self.php, '8.1', 'mods-available', 'nextcloud.ini').write_text("; priority=99\n")
+        Path(self.php, '8.1', 'apache2', 'conf.d', '99-nextcloud.ini').touch()
+        self.assertFalse(modstate.php_module_enabled('8.1', 'nextcloud'))
+
+        changes = render.ChangeSet()
+        self.assertTrue(modstate.ensure_php_module('8.1', 'nextcloud', changes))
+        check_call.assert_called_once_with(['phpenmod', '-v', '8.1', 'nextcloud'])
+        self.assertEqual(changes.action, render.RELOAD)
+
+        Path(self.php, '8.1', 'cli', 'conf.d', '99-nextcloud.ini').touch()
+        check_call.reset_mock()
+        self.assertFalse(modstate.ensure_php_module('8.1', 'nextcloud'))
+        check_call.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
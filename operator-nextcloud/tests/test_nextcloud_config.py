@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+import nextcloud_config
+from nextcloud_config import ConfigPhpError
+
+CONFIG_PHP = """<?php
+$CONFIG = array (
+  'instanceid' => 'ocr3x4mpl3',
+  'trusted_domains' =>
+  array (
+    0 => 'localhost',
+    1 => 'cloud.example.com',
+    2 => '10.0.0.1',
+  ),
+  // A comment
+  'trusted_proxies' => array (1 => '10.0.0.10', 2 => '10.0.0.11'),
+  'datadirectory' => '/var/www/nextcloud/data/',
+  'dbport' => 5432,
+  'debug' => false,
+  "loglevel" => 2,
+  'memcache.local' => '\\\\OC\\\\Memcache\\\\APCu',
+  'app_install_overwrite' => [],
+  'it\\'s' => "tab\\there",
+);
+"""
+
+
+class TestConfigPhp(unittest.TestCase):
+    """
+    Unittests for the native config.php reader.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.config_dir = self.tmpdir.name
+        Path(self.config_dir, 'config.php').write_text(CONFIG_PHP)
+
+    def test_parse(self) -> None:
+        config = nextcloud_config.parse(CONFIG_PHP)
+        self.assertEqual(config['trusted_domains'], ['localhost', 'cloud.example.com', '10.0.0.1'])
+        self.assertEqual(config['trusted_proxies'], {1: '10.0.0.10', 2: '10.0.0.11'})
+        self.assertEqual(config['dbport'], 5432)
+        self.assertIs(config['debug'], False)
+        self.assertEqual(config['loglevel'], 2)
+        self.assertEqual(config['memcache.local'], '\\OC\\Memcache\\APCu')
+        self.assertEqual(config['app_install_overwrite'], [])
+        self.assertEqual(config["it's"], 'tab\there')
+
+    def test_dump_round_trip(self) -> None:
+        config = nextcloud_config.parse(CONFIG_PHP)
+        self.assertEqual(nextcloud_config.parse(nextcloud_config.dump(config)), config)
+        # Integer keys that went through json are written as integers again.
+        text = nextcloud_config.dump({'trusted_proxies': {'1': 'a', '2': 'b'}})
+        self.assertEqual(nextcloud_config.parse(text), {'trusted_proxies': {1: 'a', 2: 'b'}})
+
+    def test_parse_rejects_code(self) -> None:
+        for text in ["<?php $CONFIG = array('a' => getenv('A'));",
+                     "<?php $CONFIG = array('a' => \"$b\");",
+                     "<?php $CONFIG = array(); $CONFIG['a'] = 1;",
+                     "<?php $OTHER = array();"]:
+            with self.assertRaises(ConfigPhpError):
+                nextcloud_config.parse(text)
+
+    def test_overlays_override_in_natural_order(self) -> None:
+        Path(self.config_dir, 'redis.config.php').write_text(
+            "<?php $CONFIG = ['memcache.local' => '\\\\OC\\\\Memcache\\\\Redis', 'redis' => ['port' => 6379]];")
+        Path(self.config_dir, 'z10.config.php').write_text("<?php $CONFIG = ['loglevel' => 10];")
+        Path(self.config_dir, 'z9.config.php').write_text("<?php $CONFIG = ['loglevel' => 9];")
+        config = nextcloud_config.read_config(self.config_dir)
+        self.assertEqual(config['memcache.local'], '\\OC\\Memcache\\Redis')
+        self.assertEqual(config['redis'], {'port': 6379})
+        self.assertEqual(config['loglevel'], 10)
+        self.assertEqual(config['dbport'], 5432)
+
+    def test_cache_invalidated_by_mtime(self) -> None:
+        path = Path(self.config_dir, 'config.php')
+        self.assertIs(nextcloud_config.get_system_value('debug', config_dir=self.config_dir), False)
+        path.write_text(CONFIG_PHP.replace("'debug' => false", "'debug' => true"))
+        os.utime(path, ns=(0, 0))
+        self.assertIs(nextcloud_config.get_system_value('debug', config_dir=self.config_dir), True)
+
+    def test_values_are_copies(self) -> None:
+        domains = nextcloud_config.get_system_value('trusted_domains', config_dir=self.config_dir)
+        domains.append('evil.example.com')
+        self.assertEqual(len(nextcloud_config.get_system_value('trusted_domains', config_dir=self.config_dir)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
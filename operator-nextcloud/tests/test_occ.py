@@ -0,0 +1,171 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from subprocess import CompletedProcess
+from unittest import mock
+import occ
+from occ import Occ, OccWorker, HookCache
+
+
+class TestConfigBatch(unittest.TestCase):
+    """
+    Unittests for batched config:system changes.
+    """
+
+    def _completed(self, stdout='', returncode=0):
+        return CompletedProcess(args=[], returncode=returncode, stdout=stdout, stderr='')
+
+    @mock.patch('occ.sp.run')
+    def test_flush_runs_one_process(self, run) -> None:
+        run.return_value = self._completed(json.dumps({'debug': 'set', 'foo': 'deleted'}))
+        batch = Occ.config_system_batch()
+        batch.set('debug', True).delete('foo')
+        self.assertEqual(len(batch), 2)
+
+        results = batch.flush()
+
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(json.loads(run.call_args.kwargs['input']), {'debug': True, 'foo': None})
+        self.assertEqual(results, {'debug': 'set', 'foo': 'deleted'})
+        self.assertEqual(len(batch), 0)
+
+    @mock.patch('occ.sp.run')
+    def test_flush_empty_batch_is_noop(self, run) -> None:
+        self.assertEqual(Occ.config_system_batch().flush(), {})
+        run.assert_not_called()
+
+    @mock.patch('occ.sp.run')
+    def test_flush_failure_reports_every_key(self, run) -> None:
+        run.return_value = self._completed(returncode=1)
+        batch = occ.ConfigBatch().set('a', 1).set('b', 2)
+        self.assertEqual(batch.flush(), {'a': 'failed', 'b': 'failed'})
+
+    @mock.patch('occ.sp.run')
+    def test_setters_queue_on_batch(self, run) -> None:
+        batch = Occ.config_system_batch()
+        Occ.overwriteprotocol('https', batch)
+        Occ.overwriteCliUrl('https://cloud.example.com', batch)
+        Occ.defaultPhoneRegion('SE', batch)
+        Occ.setDebug(False, batch)
+        run.assert_not_called()
+        self.assertEqual(len(batch), 4)
+
+
+class TestHookCache(unittest.TestCase):
+    """
+    Unittests for the hook scoped cache of occ results.
+    """
+
+    def setUp(self) -> None:
+        HookCache.invalidate()
+        self.addCleanup(HookCache.invalidate)
+
+    @mock.patch('occ.sp.run')
+    def test_status_is_cached(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=0, stdout='{}', stderr='')
+        Occ.status()
+        Occ.status()
+        self.assertEqual(run.call_count, 1)
+
+    @mock.patch('occ.sp.run')
+    def test_failed_status_is_not_cached(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=1, stdout='', stderr='')
+        Occ.status()
+        Occ.status()
+        self.assertEqual(run.call_count, 2)
+
+    @mock.patch('occ.sp.run')
+    def test_writes_invalidate(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=0, stdout='{}', stderr='')
+        Occ.status()
+        Occ.maintenance_mode(enable=True)
+        Occ.status()
+        self.assertEqual(run.call_count, 3)
+
+        run.return_value = CompletedProcess(args=[], returncode=0, stdout='{"maintenance": "set"}',
+                                            stderr='')
+        Occ.config_system_batch().set('maintenance', False).flush()
+        Occ.status()
+        self.assertEqual(run.call_count, 5)
+
+        Occ.config_system_batch().set('debug', False).flush()
+        Occ.status()
+        self.assertEqual(run.call_count, 6)
+
+
+class TestOccWorker(unittest.TestCase):
+    """
+    Unittests for the occ worker client, against a fake worker.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'occ.sock')
+        self.requests = []
+        HookCache.invalidate()
+        patcher = mock.patch.object(OccWorker, 'socket_path', self.socket_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _serve(self, *replies):
+        """
+        Start a fake worker answering each connection with the next reply.
+        """
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        self.addCleanup(server.close)
+
+        def serve():
+            for reply in replies:
+                conn, _ = server.accept()
+                with conn, conn.makefile('rw') as f:
+                    self.requests.append(json.loads(f.readline()))
+                    f.write(json.dumps(reply) + "\n")
+        threading.Thread(target=serve, daemon=True).start()
+
+    @mock.patch('occ.sp.run')
+    def test_command_runs_on_worker(self, run) -> None:
+        self._serve({'returncode': 0, 'stdout': '{"installed":true}'})
+        cp = Occ.status()
+        run.assert_not_called()
+        self.assertEqual(cp.stdout, '{"installed":true}')
+        self.assertEqual(self.requests, [{'argv': ['status', '--output=json', '--no-warnings']}])
+
+    @mock.patch('occ.sp.run')
+    def test_spawns_without_worker(self, run) -> None:
+        Occ.status()
+        run.assert_called_once()
+
+    @mock.patch('occ.sp.run')
+    def test_spawns_when_worker_restarts(self, run) -> None:
+        self._serve({'restart': True})
+        Occ.status()
+        run.assert_called_once()
+
+    @mock.patch('occ.sp.run')
+    def test_batch_runs_on_worker(self, run) -> None:
+        self._serve({'returncode': 0, 'stdout': '{"debug": "set"}'})
+        results = Occ.config_system_batch().set('debug', True).flush()
+        run.assert_not_called()
+        self.assertEqual(results, {'debug': 'set'})
+        self.assertEqual(self.requests, [{'system_config': {'debug': True}}])
+
+    @mock.patch('occ.sp.run')
+    def test_install_never_uses_worker(self, run) -> None:
+        run.return_value = CompletedProcess(args=[str(i) for i in range(24)], returncode=0,
+                                            stdout='', stderr='')
+        self._serve({'returncode': 0, 'stdout': ''})
+        ctx = dict.fromkeys(['dbtype', 'dbname', 'dbhost', 'dbpass', 'dbuser',
+                             'adminusername', 'adminpassword', 'datadir'], 'x')
+        Occ.maintenance_install(ctx)
+        run.assert_called_once()
+        self.assertEqual(self.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
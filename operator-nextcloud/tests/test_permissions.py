@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+import permissions
+
+UID, GID = 4242, 4343
+
+
+@unittest.skipUnless(os.geteuid() == 0, "changing ownership needs root")
+class TestPermissions(unittest.TestCase):
+    """
+    Unittests for the incremental ownership fixer.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.root = Path(self.tmpdir.name, 'nextcloud')
+        for d in ['apps/files/lib', 'config', 'data/admin/files']:
+            Path(self.root, d).mkdir(parents=True)
+        for f in ['index.php', 'apps/files/lib/App.php', 'config/config.php', 'data/admin/files/a.txt']:
+            Path(self.root, f).write_text('x')
+        os.symlink('index.php', Path(self.root, 'link.php'))
+
+    def _owners(self, *paths):
+        return {p: os.lstat(Path(self.root, p)).st_uid for p in paths}
+
+    def test_fix_tree_skips_excluded_and_correct_entries(self) -> None:
+        data = str(Path(self.root, 'data'))
+        report = permissions.fix_tree(self.root, UID, GID, exclude=[data], workers=4)
+        self.assertEqual(report.chowned, report.scanned)
+        self.assertEqual(report.errors, 0)
+        self.assertEqual(self._owners('apps/files/lib/App.php', 'link.php', 'data', 'data/admin'),
+                         {'apps/files/lib/App.php': UID, 'link.php': UID, 'data': UID, 'data/admin': 0})
+
+        report = permissions.fix_tree(self.root, UID, GID, exclude=[data])
+        self.assertEqual(report.chowned, 0)
+        self.assertGreater(report.scanned, 0)
+
+    def test_fix_tree_adds_owner_access(self) -> None:
+        os.chmod(Path(self.root, 'config/config.php'), 0o440)
+        report = permissions.fix_tree(self.root, UID, GID)
+        self.assertEqual(report.chmodded, 1)
+        self.assertEqual(os.stat(Path(self.root, 'config/config.php')).st_mode & 0o777, 0o640)
+
+    def test_fingerprint(self) -> None:
+        data = str(Path(self.root, 'data'))
+        before = permissions.fingerprint(self.root, [data])
+        self.assertEqual(before, permissions.fingerprint(self.root, [data]))
+        Path(self.root, 'data', 'new').mkdir()
+        self.assertEqual(before, permissions.fingerprint(self.root, [data]))
+        os.chown(Path(self.root, 'apps'), UID, GID)
+        self.assertNotEqual(before, permissions.fingerprint(self.root, [data]))
+        self.assertIsNone(permissions.fingerprint(Path(self.root, 'missing')))
+
+    def test_fix_paths(self) -> None:
+        report = permissions.fix_paths([Path(self.root, 'config/config.php'), Path(self.root, 'missing')],
+                                       UID, GID)
+        self.assertEqual((report.scanned, report.chowned, report.errors), (1, 1, 0))
+        self.assertEqual(self._owners('config', 'config/config.php'), {'config': 0, 'config/config.php': UID})
+
+
+if __name__ == '__main__':
+    unittest.main()
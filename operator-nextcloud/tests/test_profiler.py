@@ -0,0 +1,75 @@
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+import profiler
+
+
+class TestProfiler(unittest.TestCase):
+    """
+    Unittests for the hook profiler.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        for patcher in [mock.patch.object(profiler, 'PROFILE_DIR', self.tmpdir.name),
+                        mock.patch.dict(os.environ, {'JUJU_UNIT_NAME': 'nextcloud/0',
+                                                     'JUJU_HOOK_NAME': 'config-changed'}),
+                        mock.patch.object(subprocess, 'Popen', subprocess.Popen),
+                        mock.patch.object(os, 'system', os.system)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_command_class(self) -> None:
+        self.assertEqual(profiler.command_class(
+            "sudo -u www-data /usr/bin/php occ status --output=json".split()), 'occ status')
+        self.assertEqual(profiler.command_class(
+            ['sudo', 'DEBIAN_FRONTEND=noninteractive', 'apt-get', 'install', '-y']), 'apt-get')
+        self.assertEqual(profiler.command_class('systemctl reload apache2'), 'systemctl')
+
+    def test_profiled_handlers(self) -> None:
+        @profiler.profiled
+        class Charm:
+            def _on_config_changed(self, event):
+                subprocess.run(['true'])
+                subprocess.call(['true'])
+                os.system('true')
+                self._on_update_status(event)
+
+            def _on_update_status(self, event):
+                subprocess.run(['sh', '-c', 'exit 0'])
+
+            def _on_fail(self, event):
+                raise RuntimeError()
+
+        charm = Charm()
+        charm._on_config_changed(None)
+        with self.assertRaises(RuntimeError):
+            charm._on_fail(None)
+        records = profiler.read()
+        self.assertEqual([r['handler'] for r in records], ['_on_config_changed', '_on_fail'])
+        self.assertEqual(records[0]['hook'], 'config-changed')
+        self.assertEqual(records[0]['subprocesses'], 4)
+        self.assertEqual(records[0]['commands']['true']['count'], 3)
+        self.assertIsInstance(records[0]['blocks_out'], int)
+        self.assertEqual(records[1]['error'], 'RuntimeError')
+
+    def test_rollover_and_summary(self) -> None:
+        with mock.patch.object(profiler, 'MAX_BYTES', 200):
+            for wall in range(1, 11):
+                profiler.write({'handler': '_on_start', 'wall': wall, 'subprocesses': 1, 'blocks_out': 0,
+                                'commands': {'systemctl': {'count': 1, 'seconds': 0.5}}})
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, profiler.PROFILE_FILE + '.1')))
+        records = [{'handler': '_on_start', 'wall': w, 'subprocesses': 1, 'blocks_out': 0,
+                    'commands': {'systemctl': {'count': 1, 'seconds': 0.5}}} for w in range(1, 11)]
+        summary = profiler.summarize(records)['_on_start']
+        self.assertEqual((summary['count'], summary['wall-p50'], summary['wall-p90'], summary['wall-max']),
+                         (10, 5, 9, 10))
+        self.assertEqual(summary['slowest-commands'], 'systemctl 5.00s')
+        self.assertEqual(summary['blocks-out-p90'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from subprocess import CompletedProcess
+from unittest import mock
+from occ import Occ, HookCache
+from reconciler import SystemConfigReconciler
+
+CONFIG_PHP = """<?php
+$CONFIG = array (
+  'trusted_domains' => array (0 => 'localhost', 1 => 'cloud.example.com'),
+  'overwriteprotocol' => 'https',
+  'default_phone_region' => 'SE',
+  'debug' => false,
+);
+"""
+
+
+class TestSystemConfigReconciler(unittest.TestCase):
+    """
+    Unittests for applying only changed system config keys.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        Path(self.tmpdir.name, 'config.php').write_text(CONFIG_PHP)
+        self.reconciler = SystemConfigReconciler(self.tmpdir.name)
+        HookCache.invalidate()
+
+    @mock.patch('occ.sp.run')
+    def test_steady_state_makes_no_writes(self, run) -> None:
+        batch = Occ.config_system_batch()
+        Occ.overwriteprotocol('https', batch)
+        Occ.defaultPhoneRegion('SE', batch)
+        Occ.setDebug(False, batch)
+        batch.set('trusted_domains', ['localhost', 'cloud.example.com'])
+        batch.delete('overwrite.cli.url')
+        self.assertEqual(self.reconciler.reconcile(batch), {})
+        run.assert_not_called()
+
+    @mock.patch('occ.sp.run')
+    def test_only_changed_keys_are_applied(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=0, stderr='',
+                                            stdout=json.dumps({'debug': 'set', 'overwriteprotocol': 'deleted'}))
+        batch = Occ.config_system_batch()
+        Occ.setDebug(True, batch)
+        Occ.defaultPhoneRegion('SE', batch)
+        batch.delete('overwriteprotocol')
+        results = self.reconciler.reconcile(batch)
+        run.assert_called_once()
+        self.assertEqual(json.loads(run.call_args.kwargs['input']), {'debug': True, 'overwriteprotocol': None})
+        self.assertEqual(results, {'debug': 'set', 'overwriteprotocol': 'deleted'})
+
+    @mock.patch('occ.sp.run')
+    def test_unreadable_config_applies_everything(self, run) -> None:
+        Path(self.tmpdir.name, 'config.php').write_text("<?php $CONFIG = array('a' => getenv('A'));")
+        run.return_value = CompletedProcess(args=[], returncode=0, stderr='', stdout='{}')
+        batch = Occ.config_system_batch()
+        Occ.setDebug(False, batch)
+        self.reconciler.reconcile(batch)
+        self.assertEqual(json.loads(run.call_args.kwargs['input']), {'debug': False})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+import releases
+
+
+def _nextcloud(root, version, apps=('files',)):
+    for app in apps:
+        Path(root, 'apps', app).mkdir(parents=True)
+    Path(root, 'config').mkdir(parents=True, exist_ok=True)
+    Path(root, 'config', 'config.sample.php').write_text('sample')
+    Path(root, 'occ').write_text('<?php')
+    Path(root, 'version.php').write_text(f"<?php\n$OC_Version = array(1);\n$OC_VersionString = '{version}';\n")
+
+
+class TestReleases(unittest.TestCase):
+    """
+    Unittests for the blue/green release directories.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.www = Path(self.tmpdir.name)
+        self.live = Path(self.www, 'nextcloud')
+        for name, value in [('LIVE', str(self.live)),
+                            ('RELEASES_DIR', str(Path(self.www, 'nextcloud-releases'))),
+                            ('SHARED_DIR', str(Path(self.www, 'nextcloud-shared')))]:
+            patcher = mock.patch.object(releases, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _legacy_install(self):
+        _nextcloud(self.live, '25.0.1', apps=('files', 'calendar'))
+        Path(self.live, 'config', 'config.php').write_text('v25')
+        Path(self.live, 'data', 'admin').mkdir(parents=True)
+
+    def test_adopt_moves_live_dir_into_a_release(self) -> None:
+        self._legacy_install()
+        releases.adopt()
+        self.assertTrue(self.live.is_symlink())
+        self.assertEqual(releases.current(), '25.0.1')
+        self.assertEqual(os.readlink(Path(self.live, 'data')), str(Path(self.www, 'nextcloud-shared', 'data')))
+        self.assertTrue(Path(self.live, 'data', 'admin').is_dir())
+        releases.adopt()
+        self.assertEqual(releases.releases(), ['25.0.1'])
+
+    def test_upgrade_and_rollback(self) -> None:
+        self._legacy_install()
+        releases.adopt()
+        version = releases.prepare(lambda staging: _nextcloud(Path(staging, 'nextcloud'), '26.0.0'))
+        self.assertEqual(version, '26.0.0')
+        self.assertEqual(releases.current(), '25.0.1')
+        self.assertEqual([p.name for p in Path(self.www, 'nextcloud-releases').iterdir()
+                          if p.name.startswith('.staging')], [])
+
+        releases.carry_over(version)
+        new = releases.release_path(version)
+        self.assertEqual(Path(new, 'config', 'config.php').read_text(), 'v25')
+        self.assertEqual(Path(new, 'config', 'config.sample.php').read_text(), 'sample')
+        self.assertTrue(Path(new, 'apps', 'calendar').is_dir())
+        self.assertTrue(Path(new, 'data', 'admin').is_dir())
+
+        releases.switch(version)
+        self.assertEqual((releases.current(), releases.previous()), ('26.0.0', '25.0.1'))
+        self.assertTrue(Path(self.live, 'occ').exists())
+
+        self.assertEqual(releases.rollback(), '25.0.1')
+        self.assertEqual((releases.current(), releases.previous()), ('25.0.1', '26.0.0'))
+
+    def test_prepare_rejects_wrong_release(self) -> None:
+        with self.assertRaises(releases.ReleaseError):
+            releases.prepare(lambda staging: _nextcloud(Path(staging, 'nextcloud'), '26.0.0'), '27.0.0')
+        with self.assertRaises(releases.ReleaseError):
+            releases.prepare(lambda staging: Path(staging, 'nextcloud').mkdir())
+        self.assertEqual(releases.releases(), [])
+
+    def test_prepare_keeps_the_live_release(self) -> None:
+        def extract(staging):
+            _nextcloud(Path(staging, 'nextcloud'), '26.0.0')
+
+        version = releases.prepare(extract)
+        releases.carry_over(version)
+        releases.switch(version)
+        Path(self.live, 'config', 'config.php').write_text('v26')
+        # A retried install prepares the same release again.
+        self.assertEqual(releases.prepare(extract, '26.0.0'), '26.0.0')
+        self.assertEqual(releases.current(), '26.0.0')
+        self.assertEqual(Path(self.live, 'config', 'config.php').read_text(), 'v26')
+        self.assertEqual([p.name for p in Path(self.www, 'nextcloud-releases').iterdir()], ['26.0.0'])
+
+    def test_prune_keeps_current_and_previous(self) -> None:
+        for version in ['9.0.0', '24.0.0', '25.0.0', '26.0.0']:
+            releases.prepare(lambda staging: _nextcloud(Path(staging, 'nextcloud'), version))
+        releases.switch('24.0.0')
+        releases.switch('9.0.0')
+        self.assertEqual(releases.prune(keep=2), [])
+        releases.switch('26.0.0')
+        self.assertEqual(releases.prune(keep=2), ['24.0.0'])
+        self.assertEqual(releases.releases(), ['25.0.0', '26.0.0', '9.0.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
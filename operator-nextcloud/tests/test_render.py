@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+import render
+
+
+class TestRender(unittest.TestCase):
+    """
+    Unittests for the content hashed render pipeline.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.templates = Path(self.tmpdir.name, 'templates')
+        self.templates.mkdir()
+        Path(self.templates, 'site.conf.j2').write_text("Listen {{ port }}\n")
+        self.target = Path(self.tmpdir.name, 'site.conf')
+
+    def test_unchanged_content_is_not_written(self) -> None:
+        changes = render.ChangeSet()
+        self.assertTrue(render.render_template(self.templates, 'site.conf.j2', self.target, {'port': 80}, changes))
+        mtime = self.target.stat().st_mtime_ns
+        self.assertFalse(render.render_template(self.templates, 'site.conf.j2', self.target, {'port': 80}, changes))
+        self.assertEqual(self.target.stat().st_mtime_ns, mtime)
+        self.assertEqual(self.target.read_text(), "Listen 80")
+        self.assertEqual(changes.files, {str(self.target): render.RELOAD})
+
+    def test_write_keeps_mode(self) -> None:
+        render.write_file(self.target, "a")
+        os.chmod(self.target, 0o600)
+        self.assertTrue(render.write_file(self.target, "b"))
+        self.assertEqual(self.target.stat().st_mode & 0o777, 0o600)
+        # No temporary files left behind.
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['site.conf', 'templates'])
+
+    def test_environment_is_cached(self) -> None:
+        self.assertIs(render.environment(self.templates), render.environment(str(self.templates)))
+
+    @mock.patch('render.sp.check_call')
+    def test_changeset_action(self, check_call) -> None:
+        changes = render.ChangeSet()
+        self.assertEqual(changes.apply('apache2.service'), render.NO_ACTION)
+        check_call.assert_not_called()
+
+        changes.add('/etc/php/8.1/mods-available/nextcloud.ini', render.RELOAD)
+        self.assertEqual(changes.apply('apache2.service'), render.RELOAD)
+        check_call.assert_called_with(['systemctl', 'reload-or-restart', 'apache2.service'])
+
+        other = render.ChangeSet().add('/etc/apache2/mods-enabled/rewrite.load', render.RESTART)
+        self.assertEqual(changes.merge(other).apply('apache2.service'), render.RESTART)
+        check_call.assert_called_with(['systemctl', 'restart', 'apache2.service'])
+
+
+if __name__ == '__main__':
+    unittest.main()
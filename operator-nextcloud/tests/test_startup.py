@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+import unittest
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported on first use only, no hook that doesn't need them pays for them.
+LAZY_MODULES = ['requests', 'urllib3', 'jinja2', 'tarfile', 'archive']
+
+
+def _python(code, *options):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(CHARM_DIR, 'src'),
+                                                       os.path.join(CHARM_DIR, 'lib')]))
+    return subprocess.run([sys.executable] + list(options) + ['-c', code], cwd=CHARM_DIR, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def import_times(module) -> dict:
+    """
+    {module: (self, cumulative)} in microseconds from python -X importtime.
+    """
+    times = {}
+    for line in _python(f"import {module}", '-X', 'importtime').stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        if own.strip().isdigit():
+            times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Interpreter startup of a hook, the charm is imported on every dispatch.
+    """
+
+    def test_heavy_modules_are_lazy(self) -> None:
+        times = import_times('charm')
+        own = [name for name in os.listdir(os.path.join(CHARM_DIR, 'src')) if name.endswith('.py') and name != 'charm.py']
+        slowest = sorted(((times[n[:-3]][1], n[:-3]) for n in own if n[:-3] in times), reverse=True)[:5]
+        modules = ", ".join(f"{name} {us / 1000:.1f}ms" for us, name in slowest)
+        print(f"\nimport charm: {times['charm'][1] / 1000:.1f}ms, of that {modules}")
+        self.assertEqual([m for m in LAZY_MODULES if m in times], [])
+
+    def test_loaded_on_first_use(self) -> None:
+        code = ("import sys, charm, render\n"
+                "render.environment('templates')\n"
+                "print(sorted(m for m in sys.modules if m in ('jinja2', 'requests')))")
+        self.assertEqual(_python(code).stdout.strip(), "['jinja2']")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from subprocess import CompletedProcess
+from types import SimpleNamespace
+from unittest import mock
+import sysfacts
+
+PHP_FACTS = {'version': '8.1', 'release': '8.1.2', 'ini_file': '/etc/php/8.1/cli/php.ini',
+             'ini_scanned_files': '/etc/php/8.1/cli/conf.d/10-opcache.ini,\n/etc/php/8.1/cli/conf.d/20-gd.ini',
+             'extension_dir': '/usr/lib/php/20210902', 'extensions': ['core', 'gd']}
+
+
+class TestSysFacts(unittest.TestCase):
+    """
+    Unittests for the cached system facts.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        os_release = Path(self.tmpdir.name, 'os-release')
+        os_release.write_text('NAME="Ubuntu"\nID=ubuntu\nVERSION_ID="22.04"\nVERSION_CODENAME=jammy\n')
+        patcher = mock.patch.object(sysfacts, 'OS_RELEASE', str(os_release))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stored = SimpleNamespace(system_facts='')
+        sysfacts.bind(self.stored)
+        self.addCleanup(sysfacts.bind, None)
+
+    @mock.patch('sysfacts.sp.run')
+    def test_probed_once_and_stored(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=0, stdout=json.dumps(PHP_FACTS), stderr='')
+        self.assertEqual(sysfacts.php_version(), '8.1')
+        self.assertEqual(sysfacts.distro_codename(), 'jammy')
+        self.assertEqual(sysfacts.php()['ini_scanned_files'],
+                         ['/etc/php/8.1/cli/conf.d/10-opcache.ini', '/etc/php/8.1/cli/conf.d/20-gd.ini'])
+        run.assert_called_once()
+
+        # A later hook reads the stored facts.
+        sysfacts.bind(self.stored)
+        self.assertEqual(sysfacts.php_version(), '8.1')
+        run.assert_called_once()
+
+    @mock.patch('sysfacts.sp.run', side_effect=FileNotFoundError)
+    def test_php_probed_again_once_installed(self, run) -> None:
+        self.assertEqual(sysfacts.distro_codename(), 'jammy')
+        self.assertIsNone(sysfacts.php_version())
+        run.side_effect = None
+        run.return_value = CompletedProcess(args=[], returncode=0, stdout=json.dumps(PHP_FACTS), stderr='')
+        self.assertEqual(sysfacts.php_version(), '8.1')
+        self.assertEqual(json.loads(self.stored.system_facts)['php']['version'], '8.1')
+
+    @mock.patch('sysfacts.sp.run')
+    def test_outdated_facts_are_reprobed(self, run) -> None:
+        run.return_value = CompletedProcess(args=[], returncode=0, stdout=json.dumps(PHP_FACTS), stderr='')
+        self.stored.system_facts = json.dumps({'facts_version': 0, 'php': {'version': '7.4'}})
+        sysfacts.bind(self.stored)
+        self.assertEqual(sysfacts.php_version(), '8.1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import upgrade
+
+UNITS = [f'nextcloud/{i}' for i in range(6)]
+
+
+def _states(plan, **states):
+    return {u.replace('_', '/'): {'id': plan['id'], 'state': s} for u, s in states.items()}
+
+
+class TestRollingUpgrade(unittest.TestCase):
+    """
+    Unittests for the rolling upgrade plan.
+    """
+
+    def setUp(self) -> None:
+        self.plan = {'id': '1', 'version': '26.0.0', 'phase': upgrade.STAGE, 'switch': []}
+
+    def test_batch_size(self) -> None:
+        self.assertEqual(upgrade.batch_size(6, 0.5), 3)
+        self.assertEqual(upgrade.batch_size(5, 0.5), 2)
+        self.assertEqual(upgrade.batch_size(10, 0.7), 3)
+        self.assertEqual(upgrade.batch_size(3, 1.0), 1)
+        self.assertEqual(upgrade.batch_size(1, 0.5), 1)
+
+    def test_stage_waits_for_all_units(self) -> None:
+        states = _states(self.plan, **{f'nextcloud_{i}': upgrade.STAGED for i in range(5)})
+        self.assertEqual(upgrade.advance(self.plan, states, UNITS, 0.5)['phase'], upgrade.STAGE)
+        # A state reported for an older plan doesn't count.
+        states['nextcloud/5'] = {'id': '0', 'state': upgrade.STAGED}
+        self.assertEqual(upgrade.advance(self.plan, states, UNITS, 0.5)['phase'], upgrade.STAGE)
+        states['nextcloud/5'] = {'id': '1', 'state': upgrade.STAGED}
+        self.assertEqual(upgrade.advance(self.plan, states, UNITS, 0.5)['phase'], upgrade.UPGRADE)
+
+    def test_switch_in_batches(self) -> None:
+        self.plan['phase'] = upgrade.SWITCH
+        states = _states(self.plan, **{f'nextcloud_{i}': upgrade.STAGED for i in range(6)})
+        states['nextcloud/0']['state'] = upgrade.SWITCHED
+        plan = upgrade.advance(self.plan, states, UNITS, 0.7)
+        self.assertEqual(plan['switch'], ['nextcloud/1'])
+        plan = upgrade.advance(self.plan, states, UNITS, 0.5)
+        self.assertEqual(plan['switch'], ['nextcloud/1', 'nextcloud/2', 'nextcloud/3'])
+
+        # The next batch only starts when the whole batch switched.
+        states['nextcloud/1']['state'] = upgrade.SWITCHED
+        self.assertEqual(upgrade.advance(plan, states, UNITS, 0.5), plan)
+        for u in plan['switch']:
+            states[u]['state'] = upgrade.SWITCHED
+        plan = upgrade.advance(plan, states, UNITS, 0.5)
+        self.assertEqual(plan['switch'], ['nextcloud/4', 'nextcloud/5'])
+        for u in plan['switch']:
+            states[u]['state'] = upgrade.SWITCHED
+        plan = upgrade.advance(plan, states, UNITS, 0.5)
+        self.assertEqual((plan['phase'], plan['switch']), (upgrade.DONE, []))
+
+    def test_failure_stops_the_plan(self) -> None:
+        states = _states(self.plan, nextcloud_0=upgrade.STAGED, nextcloud_3=upgrade.FAILED)
+        plan = upgrade.advance(self.plan, states, UNITS, 0.5)
+        self.assertEqual((plan['phase'], plan['failed']), (upgrade.FAILED, ['nextcloud/3']))
+
+
+if __name__ == '__main__':
+    unittest.main()
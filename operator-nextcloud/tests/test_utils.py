@@ -1,10 +1,17 @@
 # import sys
 import os
+import functools
+import hashlib
+import tempfile
 import unittest
 import threading
 from http.server import SimpleHTTPRequestHandler, HTTPServer
+from unittest import mock
 # sys.path.append('./src')
 import utils
+from artifact_cache import ArtifactCache, ArtifactError
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 class TestUtils(unittest.TestCase):
@@ -12,26 +19,86 @@ class TestUtils(unittest.TestCase):
     Unittests for utils functions
     """
 
-    def setUp(self) -> None:
+    @classmethod
+    def setUpClass(cls) -> None:
         """
         Launch a local webserver to serve a fake nextcloud.tar.bz2 file
         :return:
         """
-        os.chdir('tests')
-        handler = SimpleHTTPRequestHandler
-        httpd = HTTPServer(("", 8081), handler)
-        self.httpd_thread = threading.Thread(target=httpd.serve_forever)
-        self.httpd_thread.daemon = True
-        self.httpd_thread.start()
+        handler = functools.partial(SimpleHTTPRequestHandler, directory=TESTS_DIR)
+        cls.httpd = HTTPServer(("", 8081), handler)
+        cls.httpd_thread = threading.Thread(target=cls.httpd.serve_forever)
+        cls.httpd_thread.daemon = True
+        cls.httpd_thread.start()
 
-    def tearDown(self) -> None:
-        pass
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cachedir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cachedir.cleanup)
+        self.cache = ArtifactCache(self.cachedir.name)
 
     def test_fetch_and_extract_nextcloud(self) -> None:
         """
         Test fetching a tarfile containing an empty nextcloud and extract it.
         """
-        utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2')
+        utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2', dst=self.tmpdir.name,
+                                          cache=self.cache)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir.name, 'slask.py')))
+
+    def test_fetch_and_extract_nextcloud_checksum(self) -> None:
+        """
+        Test that a checksum is verified before the tarfile is put in place.
+        """
+        with open(os.path.join(TESTS_DIR, 'nextcloud.tar.bz2'), 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        with self.assertRaises(ArtifactError):
+            utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2', '0' * 64,
+                                              dst=self.tmpdir.name, cache=self.cache)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+        utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2', checksum,
+                                          dst=self.tmpdir.name, cache=self.cache)
+        self.assertEqual(os.listdir(self.tmpdir.name), ['slask.py'])
+        self.assertIsNotNone(self.cache.get(checksum))
+
+    def test_fetch_and_extract_nextcloud_mirrors(self) -> None:
+        """
+        Test that mirrors are tried first and a bad mirror falls back to the next source.
+        """
+        with open(os.path.join(TESTS_DIR, 'nextcloud.tar.bz2'), 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        url = 'http://localhost:8081/nextcloud.tar.bz2'
+        digest = utils.fetch_and_extract_nextcloud('http://localhost:1/nextcloud.tar.bz2', dst=self.tmpdir.name,
+                                                   cache=self.cache, mirrors=[(url, checksum)])
+        self.assertEqual(digest, checksum)
+
+        cache = ArtifactCache(os.path.join(self.cachedir.name, 'other'))
+        digest = utils.fetch_and_extract_nextcloud(url, dst=self.tmpdir.name, cache=cache,
+                                                   mirrors=[('http://localhost:1/x', checksum), (url, '0' * 64)])
+        self.assertEqual(digest, checksum)
+        self.assertEqual(os.listdir(self.tmpdir.name), ['slask.py'])
+
+    @mock.patch('utils.SystemConfigReconciler')
+    @mock.patch('utils.getTrustedProxies')
+    def test_sync_trusted_proxies(self, get_proxies, reconciler) -> None:
+        """
+        Test that proxies are written as a set in one batch.
+        """
+        get_proxies.return_value = {'1': '10.0.0.2', '2': '10.0.0.1', '3': '10.0.0.9'}
+        utils.syncTrustedProxies({'10.0.0.1', '10.0.0.2', '10.0.0.3'})
+        batch = reconciler.return_value.reconcile.call_args.args[0]
+        self.assertEqual(batch.changes, {'trusted_proxies': ['10.0.0.2', '10.0.0.1', '10.0.0.3']})
+
+        get_proxies.return_value = ''
+        utils.syncTrustedProxies(set())
+        batch = reconciler.return_value.reconcile.call_args.args[0]
+        self.assertEqual(batch.changes, {'trusted_proxies': None})
 
 
 if __name__ == '__main__':